@@ -0,0 +1,126 @@
+import os
+import asyncio
+from collections import deque
+import metrics
+
+# Через сколько секунд клиенту стоит повторить отклонённый запрос (заголовок Retry-After)
+RETRY_AFTER = int(os.getenv('FSTR_ADMISSION_RETRY_AFTER', '1'))
+
+
+class Overloaded(Exception):
+    """Запрос не допущен: все слоты заняты и очередь полна, или слот не освободился вовремя"""
+
+    def __init__(self, budget: str, reason: str):
+        super().__init__(f"{budget}: {reason}")
+        self.budget = budget
+        self.reason = reason
+
+
+class Limiter:
+    """Не больше limit одновременных запросов; ещё до queue_size ждут слота не дольше timeout секунд.
+
+    Остальные сразу получают Overloaded: при медленной БД запросы не копятся
+    до таймаута пула, а быстро отклоняются с 503. Освободившийся слот
+    передаётся первому в очереди. limit=0 — без ограничений.
+    """
+
+    def __init__(self, name: str, limit: int, queue_size: int, timeout: float):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self._waiters = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _reject(self, reason: str) -> Overloaded:
+        metrics.ADMISSION_REJECTED.inc(budget=self.name, reason=reason)
+        return Overloaded(self.name, reason)
+
+    async def acquire(self):
+        if not self.limit or (self.active < self.limit and not self._waiters):
+            self.active += 1
+            return
+        if len(self._waiters) >= self.queue_size:
+            raise self._reject('queue_full')
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._waiters.append(future)
+        timer = loop.call_later(self.timeout, self._expire, future)
+        try:
+            admitted = await future
+        except asyncio.CancelledError:
+            # Клиент ушёл; если слот уже был передан ему — отдаём следующему.
+            # Отменённую future release() мог уже вынуть из очереди
+            if future.cancelled():
+                if future in self._waiters:
+                    self._waiters.remove(future)
+            elif future.result():
+                self.release()
+            raise
+        finally:
+            timer.cancel()
+        if not admitted:
+            raise self._reject('timeout')
+
+    def _expire(self, future):
+        if not future.done():
+            if future in self._waiters:
+                self._waiters.remove(future)
+            future.set_result(False)
+
+    def release(self):
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(True)
+                return
+        self.active -= 1
+
+
+# Чтения, записи с изображениями и выгрузки не отнимают слоты друг у друга. Вместе
+# лимиты не должны превышать FSTR_DB_POOL_MAX (по умолчанию 6 + 2 + 2 = 10): тогда
+# лишние запросы ждут здесь, с коротким таймаутом, а не соединение в пуле
+READS = Limiter(
+    'read',
+    limit=int(os.getenv('FSTR_ADMISSION_READ_LIMIT', '6')),
+    queue_size=int(os.getenv('FSTR_ADMISSION_READ_QUEUE', '64')),
+    timeout=float(os.getenv('FSTR_ADMISSION_READ_TIMEOUT', '2'))
+)
+WRITES = Limiter(
+    'write',
+    limit=int(os.getenv('FSTR_ADMISSION_WRITE_LIMIT', '2')),
+    queue_size=int(os.getenv('FSTR_ADMISSION_WRITE_QUEUE', '16')),
+    timeout=float(os.getenv('FSTR_ADMISSION_WRITE_TIMEOUT', '5'))
+)
+# GET /export держит соединение всю выгрузку, поэтому слот занимается вручную
+# и освобождается, когда ответ дописан или клиент ушёл
+EXPORTS = Limiter(
+    'export',
+    limit=int(os.getenv('FSTR_ADMISSION_EXPORT_LIMIT', '2')),
+    queue_size=int(os.getenv('FSTR_ADMISSION_EXPORT_QUEUE', '4')),
+    timeout=float(os.getenv('FSTR_ADMISSION_EXPORT_TIMEOUT', '5'))
+)
+
+
+def _budget(limiter: Limiter):
+    async def admit():
+        await limiter.acquire()
+        try:
+            yield
+        finally:
+            limiter.release()
+    return admit
+
+
+# Зависимости маршрутов: dependencies=[Depends(admission.read)]
+read = _budget(READS)
+write = _budget(WRITES)
+
+metrics.Gauge("admission_queue_depth", "Запросы, ждущие слота", ("budget",),
+              collect=lambda: {(limiter.name,): limiter.waiting for limiter in (READS, WRITES, EXPORTS)})
+metrics.Gauge("admission_in_flight", "Запросы, занявшие слот", ("budget",),
+              collect=lambda: {(limiter.name,): limiter.active for limiter in (READS, WRITES, EXPORTS)})
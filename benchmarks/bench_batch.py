@@ -0,0 +1,77 @@
+"""Пропускная способность: POST /submitData по одному против пакетной загрузки.
+
+Пишет в БД из .env, поэтому запускать на тестовой базе:
+
+    python -m benchmarks.bench_batch --count 2000 --users 50
+"""
+import argparse
+import base64
+import os
+import random
+import time
+
+import database
+
+PNG = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=="
+
+
+def make_items(count: int, users: int, seed: int = 1) -> list:
+    rnd = random.Random(seed)
+    items = []
+    for n in range(count):
+        u = rnd.randrange(users)
+        items.append({
+            "beauty_title": "пер.",
+            "title": f"Перевал {n}",
+            "other_titles": "",
+            "connect": "",
+            "add_time": "2024-07-01 12:00:00",
+            "user": {"email": f"bench{u}@example.com", "fam": "Иванов", "name": "Петр", "otc": None,
+                     "phone": "+7 999 000 00 00"},
+            "coords": {"latitude": f"{rnd.uniform(40, 45):.4f}", "longitude": f"{rnd.uniform(40, 45):.4f}",
+                       "height": str(rnd.randrange(500, 5000))},
+            "level": {"winter": "", "summer": "1A", "autumn": "1A", "spring": ""},
+            # Уникальное содержимое, чтобы хранилище не схлопывало файлы
+            "images": [{"data": base64.b64encode(base64.b64decode(PNG) + os.urandom(64)).decode(), "title": "фото"}],
+        })
+    return items
+
+
+def cleanup(db: database.Database, ids: list):
+    conn = db.pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM pereval_added WHERE id = ANY(%s)", (ids,))
+        conn.commit()
+    finally:
+        db.pool.putconn(conn)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=1000, help="перевалов на каждый способ")
+    parser.add_argument("--users", type=int, default=50, help="различных пользователей среди перевалов")
+    parser.add_argument("--chunk-size", type=int, default=200)
+    args = parser.parse_args()
+
+    db = database.Database()
+
+    items = make_items(args.count, args.users, seed=1)
+    started = time.perf_counter()
+    single_ids = [db.submit_data(item) for item in items]
+    single = args.count / (time.perf_counter() - started)
+    cleanup(db, single_ids)
+
+    items = make_items(args.count, args.users, seed=2)
+    started = time.perf_counter()
+    results = db.submit_batch(items, args.chunk_size)
+    batch = args.count / (time.perf_counter() - started)
+    cleanup(db, [r["id"] for r in results if "id" in r])
+
+    print(f"single: {single:10.1f} passes/sec")
+    print(f"batch:  {batch:10.1f} passes/sec (chunk {args.chunk_size}, x{batch / single:.1f})")
+    database.close_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""Нагрузочный бенчмарк основных методов API: пропускная способность и p50/p95/p99.
+
+Наполняет БД из .env набором перевалов (--dataset) через /submitData/batch и
+для каждого сценария и уровня параллельности (--concurrency) выполняет
+--requests запросов:
+
+    submit   POST /submitData с фотографией случайного размера из --image-mb
+    get      GET /submitData/{id} по случайным перевалам набора
+    patch    PATCH /submitData/{id} с новым названием
+    by_email GET /submitDataByEmail — первая страница перевалов пользователя
+
+По умолчанию приложение работает в этом же процессе (httpx.ASGITransport);
+с --url запросы идут на запущенный сервер, который смотрит в ту же БД.
+Результаты пишутся в JSON (--output), их можно сравнить с прошлым запуском:
+с --baseline и --threshold скрипт завершается с кодом 1, если p95 вырос или
+пропускная способность упала больше чем на threshold:
+
+    python -m benchmarks.bench_load --dataset 10000 --concurrency 1,8,32 --output before.json
+    python -m benchmarks.bench_load --dataset 10000 --concurrency 1,8,32 --baseline before.json --threshold 0.2
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+import database
+import storage
+
+SCENARIOS = ("submit", "get", "patch", "by_email")
+MARKER = "bench-load"
+PNG = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==")
+
+
+def pereval(rnd: random.Random, n: int, users: int, image: str) -> dict:
+    return {
+        "beauty_title": "пер.",
+        "title": f"Нагрузка {n}",
+        "other_titles": "",
+        "connect": MARKER,
+        "add_time": f"2024-07-{1 + n % 28:02d} 12:00:00",
+        "user": {"email": f"{MARKER}-{rnd.randrange(users)}@example.com", "fam": "Иванов", "name": "Петр",
+                 "otc": None, "phone": "+7 999 000 00 00"},
+        "coords": {"latitude": f"{rnd.uniform(40, 45):.6f}", "longitude": f"{rnd.uniform(40, 45):.6f}",
+                   "height": str(rnd.randrange(500, 5000))},
+        "level": {"winter": "", "summer": "1A", "autumn": "1A", "spring": ""},
+        "images": [{"data": image, "title": "фото"}],
+    }
+
+
+class Photos:
+    """Фотографии заданного размера без дорогого base64 на каждый запрос.
+
+    Хвост размером до max_mb кодируется один раз; у каждой фотографии свой
+    48-байтный заголовок (кратно 3, поэтому base64 частей можно склеить),
+    так что хранилище не схлопывает одинаковые файлы.
+    """
+
+    def __init__(self, rnd: random.Random, min_mb: float, max_mb: float):
+        self.rnd = rnd
+        self.min_size = int(min_mb * 1024 * 1024) // 3 * 3
+        self.max_size = int(max_mb * 1024 * 1024) // 3 * 3
+        self.tail = base64.b64encode(os.urandom(max(self.max_size - 48, 0))).decode()
+        self.counter = 0
+
+    def next(self) -> str:
+        self.counter += 1
+        head = (PNG[:8] + self.counter.to_bytes(8, "big") + os.urandom(32))[:48]
+        size = self.rnd.randrange(self.min_size, self.max_size + 1, 3)
+        return base64.b64encode(head).decode() + self.tail[:(size - 48) // 3 * 4]
+
+
+async def seed(client: httpx.AsyncClient, count: int, users: int, rnd: random.Random) -> list:
+    ids = []
+    tiny = base64.b64encode(PNG).decode()
+    for offset in range(0, count, 1000):
+        items = [pereval(rnd, n, users, tiny) for n in range(offset, min(offset + 1000, count))]
+        response = await client.post("/submitData/batch", json=items, timeout=600)
+        response.raise_for_status()
+        ids += [r["id"] for r in response.json()["results"] if r["status"] == 200]
+    return ids
+
+
+def request_factory(scenario: str, ids: list, users: int, rnd: random.Random, photos: Photos):
+    """Функция, выполняющая один запрос сценария; возвращает True при успехе"""
+    if scenario == "submit":
+        async def run(client, n):
+            response = await client.post("/submitData", json=pereval(rnd, n, users, photos.next()))
+            return response.status_code == 200 and response.json()["status"] == 200
+    elif scenario == "get":
+        async def run(client, n):
+            response = await client.get(f"/submitData/{rnd.choice(ids)}")
+            return response.status_code == 200
+    elif scenario == "patch":
+        async def run(client, n):
+            response = await client.patch(f"/submitData/{rnd.choice(ids)}", json={"title": f"Правка {n}"})
+            return response.status_code == 200 and response.json()["status"] == 1
+    else:
+        async def run(client, n):
+            response = await client.get("/submitDataByEmail",
+                                        params={"user_email": f"{MARKER}-{rnd.randrange(users)}@example.com"})
+            return response.status_code == 200
+    return run
+
+
+def percentile(samples: list, q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+async def drive(client: httpx.AsyncClient, run, requests: int, concurrency: int) -> dict:
+    latencies, errors = [], 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for n in counter:
+            started = time.perf_counter()
+            try:
+                ok = await run(client, n)
+            except httpx.HTTPError:
+                ok = False
+            latencies.append(time.perf_counter() - started)
+            errors += not ok
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": requests / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+    }
+
+
+def cleanup(first_coord: int):
+    """Удаляет перевалы, пользователей, координаты и файлы, созданные бенчмарком"""
+    db = database.Database()
+    conn = db.pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                DELETE FROM pereval_images WHERE id IN (
+                    SELECT l.image_id FROM pereval_image_links l
+                    JOIN pereval_added p ON p.id = l.pereval_id
+                    WHERE p.connect = %s
+                ) RETURNING sha256
+                """,
+                (MARKER,)
+            )
+            hashes = sorted({row[0] for row in cursor.fetchall() if row[0]})
+            cursor.execute("DELETE FROM pereval_added WHERE connect = %s", (MARKER,))
+            cursor.execute("DELETE FROM users WHERE email LIKE %s", (f"{MARKER}-%",))
+            cursor.execute("DELETE FROM coords WHERE id > %s AND id NOT IN (SELECT coord_id FROM pereval_added)",
+                           (first_coord,))
+        conn.commit()
+    finally:
+        db.pool.putconn(conn)
+    store = storage.get_store()
+    for offset in range(0, len(hashes), 1000):
+        for sha256 in db.unreferenced_blobs(hashes[offset:offset + 1000]):
+            store.delete(sha256)
+
+
+def compare(results: list, baseline: dict, threshold: float) -> list:
+    """Сравнивает с прошлым запуском; возвращает описания регрессий"""
+    previous = {(r["scenario"], r["concurrency"]): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        old = previous.get((r["scenario"], r["concurrency"]))
+        if old is None:
+            continue
+        name = f"{r['scenario']} x{r['concurrency']}"
+        if r["p95_ms"] > old["p95_ms"] * (1 + threshold):
+            regressions.append(f"{name}: p95 {old['p95_ms']:.1f} -> {r['p95_ms']:.1f} ms")
+        if r["throughput_rps"] < old["throughput_rps"] * (1 - threshold):
+            regressions.append(f"{name}: throughput {old['throughput_rps']:.1f} -> {r['throughput_rps']:.1f} rps")
+        if r["errors"] > old["errors"]:
+            regressions.append(f"{name}: errors {old['errors']} -> {r['errors']}")
+    return regressions
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+async def run_all(args) -> list:
+    rnd = random.Random(args.seed)
+    min_mb, max_mb = (float(v) for v in args.image_mb.split(","))
+    photos = Photos(rnd, min_mb, max_mb)
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=120)
+    else:
+        from main import app
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=120)
+
+    results = []
+    async with client:
+        print(f"seeding {args.dataset} perevals...", file=sys.stderr)
+        ids = await seed(client, args.dataset, args.users, rnd)
+        print(f"{'scenario':>10} {'conc':>5} {'rps':>9} {'p50, ms':>9} {'p95, ms':>9} {'p99, ms':>9} {'errors':>7}")
+        for scenario in args.scenarios.split(","):
+            run = request_factory(scenario, ids, args.users, rnd, photos)
+            for concurrency in (int(c) for c in args.concurrency.split(",")):
+                # Прогрев: соединения пула, кеш, JIT планов
+                await drive(client, run, min(args.warmup, args.requests), concurrency)
+                stats = await drive(client, run, args.requests, concurrency)
+                results.append({"scenario": scenario, "concurrency": concurrency, **stats})
+                print(f"{scenario:>10} {concurrency:>5} {stats['throughput_rps']:>9.1f} {stats['p50_ms']:>9.1f} "
+                      f"{stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f} {stats['errors']:>7}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="адрес запущенного сервера; по умолчанию приложение в этом процессе")
+    parser.add_argument("--dataset", type=int, default=10000, help="перевалов в наборе перед замерами")
+    parser.add_argument("--users", type=int, default=100, help="различных пользователей в наборе")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--concurrency", default="1,8,32", help="уровни параллельности")
+    parser.add_argument("--requests", type=int, default=200, help="запросов на сценарий и уровень")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--image-mb", default="2,10", help="размер фотографий для submit: от,до (МБ)")
+    parser.add_argument("--seed", type=int, default=17)
+    parser.add_argument("--output", help="записать результаты в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого запуска для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимое ухудшение, доля")
+    parser.add_argument("--keep", action="store_true", help="не удалять созданные данные")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios.split(",")) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+
+    conn = database.get_pool().getconn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT coalesce(max(id), 0) FROM coords")
+            first_coord = cursor.fetchone()[0]
+    finally:
+        database.get_pool().putconn(conn)
+
+    try:
+        results = asyncio.run(run_all(args))
+    finally:
+        if not args.keep:
+            cleanup(first_coord)
+        database.shutdown_executor()
+        database.close_pool()
+
+    report = {
+        "commit": git_commit(),
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "keep")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions beyond {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
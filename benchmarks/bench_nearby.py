@@ -0,0 +1,128 @@
+"""Время поиска /perevals/nearby в зависимости от числа точек в coords.
+
+Наполняет таблицы случайными точками по всему земному шару ступенями
+(--sizes) и на каждой ступени замеряет медиану запроса с индексом и без
+него (последовательное сканирование). С индексом время должно расти
+заметно медленнее числа строк. Пишет в БД из .env, после себя удаляет
+добавленные строки:
+
+    python -m benchmarks.bench_nearby --sizes 10000,100000,1000000
+"""
+import argparse
+import random
+import statistics
+import time
+
+import database
+
+
+def seed(cursor, count: int, user_id: int, seed_value: float):
+    cursor.execute("SELECT setseed(%s)", (seed_value,))
+    cursor.execute(
+        """
+        WITH c AS (
+            INSERT INTO coords (latitude, longitude, height)
+            SELECT round((random() * 170 - 85)::numeric, 6), round((random() * 360 - 180)::numeric, 6),
+                   (random() * 8000)::int
+            FROM generate_series(1, %s)
+            ON CONFLICT DO NOTHING
+            RETURNING id
+        )
+        INSERT INTO pereval_added (beauty_title, title, other_titles, connect, add_time, user_id, coord_id,
+                                   status, level_summer, level_autumn)
+        SELECT 'пер.', 'bench-nearby', '', '', now(), %s, id, 'new', '1A', '1A' FROM c
+        """,
+        (count, user_id)
+    )
+    cursor.execute("ANALYZE coords")
+    cursor.execute("ANALYZE pereval_added")
+
+
+def set_index_scans(pool: database.ConnectionPool, value: str):
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SET enable_indexscan = {value}")
+            cursor.execute(f"SET enable_bitmapscan = {value}")
+        conn.commit()
+    finally:
+        pool.putconn(conn)
+
+
+def timed(db: database.Database, queries: list, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        for lat, lon, radius in queries:
+            started = time.perf_counter()
+            db.get_perevals_nearby(lat, lon, radius, 50, 0)
+            samples.append(time.perf_counter() - started)
+    return statistics.median(samples) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="общее число точек на каждой ступени")
+    parser.add_argument("--radius-km", type=float, default=50)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-seqscan", action="store_true", help="не замерять вариант без индекса")
+    args = parser.parse_args()
+
+    rnd = random.Random(7)
+    queries = [(rnd.uniform(-60, 60), rnd.uniform(-180, 180), args.radius_km) for _ in range(args.queries)]
+
+    pool = database.ConnectionPool(minconn=1, maxconn=1, **database._connection_params())
+    db = database.Database(pool=pool)
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT coalesce(max(id), 0) FROM coords")
+            first_coord = cursor.fetchone()[0]
+            cursor.execute(
+                """
+                INSERT INTO users (email, fam, name, phone) VALUES ('bench-nearby@example.com', '-', '-', '-')
+                ON CONFLICT (email) DO UPDATE SET email = EXCLUDED.email RETURNING id
+                """
+            )
+            user_id = cursor.fetchone()[0]
+        conn.commit()
+    finally:
+        pool.putconn(conn)
+
+    total = 0
+    print(f"{'coords':>10} {'index, ms':>10} {'seqscan, ms':>12}")
+    try:
+        for step, size in enumerate(int(s) for s in args.sizes.split(",")):
+            conn = pool.getconn()
+            try:
+                with conn.cursor() as cursor:
+                    seed(cursor, size - total, user_id, step / 10)
+                conn.commit()
+            finally:
+                pool.putconn(conn)
+            total = size
+
+            indexed = timed(db, queries, args.repeat)
+            seqscan = float("nan")
+            if not args.no_seqscan:
+                # В пуле одно соединение, так что SET действует на запросы db
+                set_index_scans(pool, "off")
+                try:
+                    seqscan = timed(db, queries, 1)
+                finally:
+                    set_index_scans(pool, "on")
+            print(f"{total:>10} {indexed:>10.2f} {seqscan:>12.2f}")
+    finally:
+        conn = pool.getconn()
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM pereval_added WHERE user_id = %s", (user_id,))
+            cursor.execute("DELETE FROM coords WHERE id > %s AND id NOT IN (SELECT coord_id FROM pereval_added)",
+                           (first_coord,))
+            cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
+        conn.commit()
+        pool.putconn(conn)
+        pool.closeall()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""CPU на горячие запросы: подготовленные (PREPARE/EXECUTE) против текста SQL на каждый вызов.
+
+Для каждого сценария делает --count вызовов метода Database через пул из одного
+соединения — с подготовкой запросов и без (FSTR_DB_PREPARE=0) — и считает
+на вызов:
+
+  app — процессорное время этого процесса (time.process_time);
+  db  — процессорное время обслуживающего процесса PostgreSQL (utime + stime
+        из /proc/<pg_backend_pid>/stat; только если сервер на этой же машине).
+
+Сценарии: submit — POST /submitData с одним изображением (пять INSERT),
+get — GET /submitData/{id}, image — метаданные GET /images/{id}.
+Пишет в БД из .env, изображения кладёт во временный каталог и после себя
+удаляет добавленные строки:
+
+    python -m benchmarks.bench_prepared --count 2000 --rounds 3
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+import database
+import storage
+
+EMAIL = "bench-prepared@example.com"
+PNG = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=="
+TICK = os.sysconf("SC_CLK_TCK")
+
+
+def item(n: int) -> dict:
+    return {
+        "beauty_title": "пер.",
+        "title": f"Перевал {n}",
+        "other_titles": "",
+        "connect": "",
+        "add_time": "2024-07-01 12:00:00",
+        "user": {"email": EMAIL, "fam": "Иванов", "name": "Петр", "otc": None, "phone": "+7 999 000 00 00"},
+        "coords": {"latitude": "43.1000", "longitude": "42.5000", "height": "3000"},
+        "level": {"winter": "", "summer": "1A", "autumn": "1A", "spring": ""},
+        "images": [{"data": PNG, "title": "фото"}],
+    }
+
+
+def backend_cpu(pid: int) -> float:
+    """Секунды CPU процесса PostgreSQL или nan, если его не видно"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return float("nan")
+    return (int(fields[11]) + int(fields[12])) / TICK
+
+
+def run(db: database.Database, pid: int, func, count: int) -> tuple:
+    """(app мкс, db мкс, wall мкс) на вызов"""
+    app, server, wall = time.process_time(), backend_cpu(pid), time.perf_counter()
+    for n in range(count):
+        func(n)
+    return tuple((end - start) / count * 1e6 for start, end in (
+        (app, time.process_time()), (server, backend_cpu(pid)), (wall, time.perf_counter())
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=2000, help="вызовов на сценарий в каждом раунде")
+    parser.add_argument("--rounds", type=int, default=3, help="раундов; в таблице — медиана")
+    args = parser.parse_args()
+
+    store = storage.LocalBlobStore(tempfile.mkdtemp(prefix="bench-prepared-"))
+    databases = {}
+    for prepare in (False, True):
+        pool = database.ConnectionPool(minconn=1, maxconn=1, prepare=prepare, **database._connection_params())
+        with pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_backend_pid()")
+                pid = cursor.fetchone()[0]
+            conn.commit()
+        databases[prepare] = (database.Database(pool=pool, store=store), pid)
+
+    ids = []
+    try:
+        db = databases[False][0]
+        pereval_id = db.submit_data(item(0))
+        ids.append(pereval_id)
+        image_id = db.get_pereval_by_id(pereval_id)["images"][0]["id"]
+        scenarios = {
+            "submit": lambda db: lambda n: ids.append(db.submit_data(item(n))),
+            "get": lambda db: lambda n: db.get_pereval_by_id(pereval_id),
+            "image": lambda db: lambda n: db.get_image(image_id),
+        }
+
+        print(f"{'scenario':<8} {'mode':<9} {'app, us':>9} {'db, us':>9} {'wall, us':>9}")
+        for name, make in scenarios.items():
+            results = {False: [], True: []}
+            for _ in range(args.rounds):
+                # Раунды чередуются, чтобы фоновые колебания нагрузки делились поровну
+                for prepare, (db, pid) in databases.items():
+                    func = make(db)
+                    func(0)  # первый вызов на соединении готовит запросы
+                    results[prepare].append(run(db, pid, func, args.count))
+            for prepare in (False, True):
+                app, server, wall = (statistics.median(values) for values in zip(*results[prepare]))
+                print(f"{name:<8} {'prepared' if prepare else 'text':<9} {app:>9.1f} {server:>9.1f} {wall:>9.1f}")
+    finally:
+        db = databases[False][0]
+        with db.pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    DELETE FROM pereval_images WHERE id IN (
+                        SELECT image_id FROM pereval_image_links WHERE pereval_id = ANY(%s)
+                    )
+                """, (ids,))
+                cursor.execute("DELETE FROM users WHERE email = %s", (EMAIL,))
+            conn.commit()
+        for db, _ in databases.values():
+            db.pool.closeall()
+
+
+if __name__ == "__main__":
+    main()
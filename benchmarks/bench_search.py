@@ -0,0 +1,140 @@
+"""Нечёткий поиск /perevals/search против последовательного ILIKE.
+
+Наполняет pereval_added синтетическими названиями из слогов до размеров
+--sizes и на каждой ступени замеряет медиану поиска по триграммному
+индексу и запроса ILIKE '%q%' по тем же названиям. Пишет в БД из .env,
+после себя удаляет добавленные строки:
+
+    python -m benchmarks.bench_search --sizes 10000,100000,1000000
+"""
+import argparse
+import random
+import statistics
+import time
+
+from psycopg2.extras import execute_values
+
+import database
+
+# Слоги «согласная + гласная»: словарь триграмм примерно как у настоящих названий
+SYLLABLES = [c + v for c in "бвгджзклмнпрстфхцчшщ" for v in "аеиоуыэюя"]
+
+
+def title(rnd: random.Random, syllables: int) -> str:
+    return "".join(rnd.choice(SYLLABLES) for _ in range(syllables)).capitalize()
+
+
+def seed(cursor, count: int, user_id: int, coord_id: int, rnd: random.Random):
+    # Названия из 2–4 слогов, у трети — альтернативное название
+    rows = (
+        (title(rnd, rnd.randint(2, 4)), title(rnd, 3) if rnd.random() < 0.3 else "", user_id, coord_id)
+        for _ in range(count)
+    )
+    execute_values(
+        cursor,
+        """
+        INSERT INTO pereval_added (beauty_title, title, other_titles, connect, add_time, user_id, coord_id,
+                                   status, level_summer, level_autumn)
+        VALUES %s
+        """,
+        rows,
+        template="('пер.', %s, %s, 'bench-search', now(), %s, %s, 'new', '1A', '1A')",
+        page_size=10000
+    )
+    # Новые строки копятся в pending list GIN-индекса; в проде его разбирает autovacuum
+    cursor.execute("SELECT gin_clean_pending_list('pereval_added_search_idx')")
+    cursor.execute("ANALYZE pereval_added")
+
+
+def ilike(pool: database.ConnectionPool, query: str, limit: int):
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT id, beauty_title, title, other_titles, status
+                FROM pereval_added
+                WHERE beauty_title ILIKE %s OR title ILIKE %s OR other_titles ILIKE %s
+                ORDER BY id
+                LIMIT %s
+                """,
+                (f"%{query}%", f"%{query}%", f"%{query}%", limit)
+            )
+            return cursor.fetchall()
+    finally:
+        pool.putconn(conn)
+
+
+def median_ms(func, queries: list, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        for q in queries:
+            started = time.perf_counter()
+            func(q)
+            samples.append(time.perf_counter() - started)
+    return statistics.median(samples) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="число записей на каждой ступени")
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--threshold", type=float, default=0.5)
+    args = parser.parse_args()
+
+    rnd = random.Random(11)
+    queries = [title(rnd, 3).lower() for _ in range(args.queries)]
+
+    pool = database.ConnectionPool(minconn=1, maxconn=1, **database._connection_params())
+    db = database.Database(pool=pool)
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO users (email, fam, name, phone) VALUES ('bench-search@example.com', '-', '-', '-')
+                ON CONFLICT (email) DO UPDATE SET email = EXCLUDED.email RETURNING id
+                """
+            )
+            user_id = cursor.fetchone()[0]
+            cursor.execute(
+                """
+                INSERT INTO coords (latitude, longitude, height) VALUES (0, 0, 0)
+                ON CONFLICT (latitude, longitude, height) DO UPDATE SET height = EXCLUDED.height RETURNING id
+                """
+            )
+            coord_id = cursor.fetchone()[0]
+        conn.commit()
+    finally:
+        pool.putconn(conn)
+
+    total = 0
+    print(f"{'rows':>10} {'trigram, ms':>12} {'ILIKE, ms':>10}")
+    try:
+        for size in (int(s) for s in args.sizes.split(",")):
+            conn = pool.getconn()
+            try:
+                with conn.cursor() as cursor:
+                    seed(cursor, size - total, user_id, coord_id, rnd)
+                conn.commit()
+            finally:
+                pool.putconn(conn)
+            total = size
+
+            trigram = median_ms(lambda q: db.search_perevals(q, 20, 0, args.threshold), queries, args.repeat)
+            seq = median_ms(lambda q: ilike(pool, q, 20), queries, 1)
+            print(f"{total:>10} {trigram:>12.2f} {seq:>10.2f}")
+    finally:
+        conn = pool.getconn()
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM pereval_added WHERE user_id = %s AND connect = 'bench-search'", (user_id,))
+            cursor.execute("DELETE FROM users WHERE id = %s AND NOT EXISTS "
+                           "(SELECT 1 FROM pereval_added WHERE user_id = %s)", (user_id, user_id))
+        conn.commit()
+        pool.putconn(conn)
+        pool.closeall()
+
+
+if __name__ == "__main__":
+    main()
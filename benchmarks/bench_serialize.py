@@ -0,0 +1,206 @@
+"""Процессорное время на сборку JSON-ответа: прежний путь против FastJSONResponse.
+
+Наполняет БД из .env перевалами одного пользователя рядом с одной точкой
+(столько, каков наибольший из --sizes) и для каждого размера ответа замеряет CPU процесса
+(time.process_time, без времени самого PostgreSQL) на выборку, сборку
+записей и кодирование тела для двух списков:
+
+  by_email — GET /submitDataByEmail: раньше strftime на каждой записи
+             и json.dumps в JSONResponse;
+  nearby   — GET /perevals/nearby: раньше float(Decimal) на каждой записи,
+             а эндпоинт возвращал список, и FastAPI копировал его
+             jsonable_encoder перед json.dumps.
+
+Прежний путь воспроизведён здесь как эталон. После себя удаляет добавленные строки:
+
+    python -m benchmarks.bench_serialize --sizes 1,100,10000
+"""
+import argparse
+import random
+import statistics
+import time
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from psycopg2.extras import execute_values
+
+import database
+from serialization import FastJSONResponse
+
+EMAIL = "bench-serialize@example.com"
+LAT, LON = 43.0, 42.5
+
+
+def seed(cursor, count: int, rnd: random.Random) -> list:
+    cursor.execute(
+        "INSERT INTO users (email, fam, name, otc, phone) VALUES (%s, 'Иванов', 'Пётр', 'Сидорович', '-') "
+        "RETURNING id", (EMAIL,)
+    )
+    user_id = cursor.fetchone()[0]
+    # Точки в пределах ~10 км; высота у каждой своя, чтобы не упереться в UNIQUE
+    coord_ids = execute_values(
+        cursor,
+        "INSERT INTO coords (latitude, longitude, height) VALUES %s RETURNING id",
+        [(round(LAT + rnd.uniform(-0.05, 0.05), 6), round(LON + rnd.uniform(-0.05, 0.05), 6), 9000 + n)
+         for n in range(count)],
+        page_size=10000, fetch=True
+    )
+    execute_values(
+        cursor,
+        """
+        INSERT INTO pereval_added (beauty_title, title, other_titles, connect, add_time, user_id, coord_id,
+                                   status, level_winter, level_summer, level_autumn, level_spring)
+        VALUES %s
+        """,
+        [(f"Перевал {n}", now_minus(n), user_id, coord_id) for n, (coord_id,) in enumerate(coord_ids)],
+        template="('пер.', %s, 'Дятлова', 'bench-serialize', %s, %s, %s, 'new', '', '1А', '1А', '')",
+        page_size=10000
+    )
+    cursor.execute("ANALYZE pereval_added")
+    cursor.execute("ANALYZE coords")
+    return [coord_id for coord_id, in coord_ids]
+
+
+def now_minus(seconds: int) -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time.time() - seconds))
+
+
+def by_email_before(pool: database.ConnectionPool, limit: int) -> bytes:
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT p.id, p.beauty_title, p.title, p.other_titles, p.connect, p.add_time, p.status,
+                       p.level_winter, p.level_summer, p.level_autumn, p.level_spring
+                FROM pereval_added p
+                JOIN users u ON u.id = p.user_id
+                WHERE u.email = %s
+                ORDER BY p.add_time, p.id
+                LIMIT %s
+            """, (EMAIL, limit + 1))
+            rows = cursor.fetchall()
+        perevals = [{
+            'id': row[0],
+            'beauty_title': row[1],
+            'title': row[2],
+            'other_titles': row[3],
+            'connect': row[4],
+            'add_time': row[5].strftime("%Y-%m-%d %H:%M:%S"),
+            'status': row[6],
+            'level': {
+                'winter': row[7],
+                'summer': row[8],
+                'autumn': row[9],
+                'spring': row[10]
+            }
+        } for row in rows[:limit]]
+    finally:
+        pool.putconn(conn)
+    return JSONResponse(content=perevals).body
+
+
+def by_email_after(db: database.Database, limit: int) -> bytes:
+    perevals, _ = db.get_pereval_by_email(EMAIL, limit)
+    return FastJSONResponse(content=perevals).body
+
+
+def nearby_before(pool: database.ConnectionPool, limit: int) -> bytes:
+    boxes = database._radius_boxes(LAT, LON, 50)
+    box_sql = " OR ".join(
+        "point(c.longitude::float8, c.latitude::float8) <@ box(point(%s, %s), point(%s, %s))" for _ in boxes
+    )
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT p.id, p.beauty_title, p.title, p.status,
+                       c.latitude, c.longitude, c.height, d.km
+                FROM coords c
+                CROSS JOIN LATERAL (
+                    SELECT 2 * %s * asin(sqrt(
+                        power(sin(radians(c.latitude::float8 - %s) / 2), 2)
+                        + cos(radians(%s)) * cos(radians(c.latitude::float8))
+                          * power(sin(radians(c.longitude::float8 - %s) / 2), 2)
+                    )) AS km
+                ) d
+                JOIN pereval_added p ON p.coord_id = c.id
+                WHERE ({box_sql}) AND d.km <= %s
+                ORDER BY d.km, p.id
+                LIMIT %s
+            """, (database.EARTH_RADIUS_KM, LAT, LAT, LON, *[v for box in boxes for v in box], 50, limit))
+            perevals = [{
+                'id': row[0],
+                'beauty_title': row[1],
+                'title': row[2],
+                'status': row[3],
+                'coords': {
+                    'latitude': float(row[4]),
+                    'longitude': float(row[5]),
+                    'height': row[6]
+                },
+                'distance_km': round(row[7], 3)
+            } for row in cursor.fetchall()]
+    finally:
+        pool.putconn(conn)
+    # Так FastAPI обрабатывал возвращённый из эндпоинта список
+    return JSONResponse(content=jsonable_encoder(perevals)).body
+
+
+def nearby_after(db: database.Database, limit: int) -> bytes:
+    return FastJSONResponse(db.get_perevals_nearby(LAT, LON, 50, limit)).body
+
+
+def cpu_ms(func, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        started = time.process_time()
+        func()
+        samples.append(time.process_time() - started)
+    return statistics.median(samples) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1,100,10000", help="число записей в ответе")
+    parser.add_argument("--repeat", type=int, default=0,
+                        help="замеров на точку (по умолчанию — больше для маленьких ответов)")
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(",")]
+
+    pool = database.ConnectionPool(minconn=1, maxconn=1, **database._connection_params())
+    db = database.Database(pool=pool)
+    coord_ids = []
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            coord_ids = seed(cursor, max(sizes), random.Random(20))
+        conn.commit()
+    finally:
+        pool.putconn(conn)
+
+    scenarios = [
+        ("by_email", lambda n: by_email_before(pool, n), lambda n: by_email_after(db, n)),
+        ("nearby", lambda n: nearby_before(pool, n), lambda n: nearby_after(db, n)),
+    ]
+    print(f"{'scenario':<10} {'rows':>6} {'before, ms':>11} {'after, ms':>10} {'speedup':>8}")
+    try:
+        for name, before, after in scenarios:
+            for size in sizes:
+                # Ответ не должен измениться ни на байт
+                assert before(size) == after(size)
+                repeat = args.repeat or max(5, min(500, 20000 // size))
+                old = cpu_ms(lambda: before(size), repeat)
+                new = cpu_ms(lambda: after(size), repeat)
+                print(f"{name:<10} {size:>6} {old:>11.3f} {new:>10.3f} {old / new:>7.1f}x")
+    finally:
+        conn = pool.getconn()
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM users WHERE email = %s", (EMAIL,))
+            cursor.execute("DELETE FROM coords WHERE id = ANY(%s)", (coord_ids,))
+        conn.commit()
+        pool.putconn(conn)
+        pool.closeall()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import os
+import importlib
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def pereval_key(pereval_id: int) -> str:
+    return f"pereval:{pereval_id}"
+
+
+class CacheBackend(ABC):
+    """Кеш сериализованных ответов (bytes) с TTL и счётчиками попаданий.
+
+    token(key)/set(..., token=) защищают от гонки чтения с инвалидацией: значение,
+    прочитанное из БД до delete(key), не попадёт в кеш после него.
+    blocking — вызовы ходят по сети, и из event loop их нужно выполнять в потоке;
+    enabled — значения действительно сохраняются (False у NullCache).
+    """
+    blocking = False
+    enabled = True
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    @abstractmethod
+    def _get(self, key: str) -> Optional[bytes]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: bytes, token: int = None):
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+    def token(self, key: str) -> Optional[int]:
+        return None
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class LRUCache(CacheBackend):
+    """Кеш в памяти процесса: LRU-вытеснение по суммарному размеру значений и TTL"""
+
+    def __init__(self, max_bytes: int, ttl: float):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._items = OrderedDict()  # key -> (expires_at, value)
+        self._bytes = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _drop(self, key: str):
+        _, value = self._items.pop(key)
+        self._bytes -= len(value)
+
+    def _get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                self._drop(key)
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes, token: int = None):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if token is not None and token != self._generation:
+                return
+            if key in self._items:
+                self._drop(key)
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._bytes += len(value)
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._items)))
+
+    def delete(self, key: str):
+        with self._lock:
+            self._generation += 1
+            if key in self._items:
+                self._drop(key)
+
+    def token(self, key: str) -> int:
+        # Одно поколение на весь кеш: любая инвалидация отменяет все начатые заполнения
+        with self._lock:
+            return self._generation
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**super().stats(), "items": len(self._items), "bytes": self._bytes}
+
+
+class RedisCache(CacheBackend):
+    """Общий для нескольких воркеров кеш на локальном Redis (нужен пакет redis).
+
+    У каждого ключа есть счётчик поколений (key:gen), который delete() увеличивает.
+    set() с токеном записывает значение, только если счётчик не изменился с
+    token(key), — проверка и запись идут одним скриптом на стороне Redis.
+    """
+    blocking = True
+
+    # Счётчик должен пережить самое долгое чтение из БД между token() и set()
+    GENERATION_TTL = 24 * 3600
+
+    _SET_IF_GENERATION = """
+        if (redis.call('GET', KEYS[2]) or '0') == ARGV[2] then
+            return redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+        end
+        return false
+    """
+
+    def __init__(self, url: str, ttl: float):
+        super().__init__()
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("Для FSTR_CACHE_BACKEND=redis установите пакет redis") from e
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self._set_if_generation = self.client.register_script(self._SET_IF_GENERATION)
+
+    @staticmethod
+    def _generation_key(key: str) -> str:
+        return f"{key}:gen"
+
+    def _get(self, key: str) -> Optional[bytes]:
+        return self.client.get(key)
+
+    def set(self, key: str, value: bytes, token: int = None):
+        ttl = max(int(self.ttl), 1)
+        if token is None:
+            self.client.set(key, value, ex=ttl)
+        else:
+            self._set_if_generation(keys=[key, self._generation_key(key)], args=[value, token, ttl])
+
+    def delete(self, key: str):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.incr(self._generation_key(key))
+        pipe.expire(self._generation_key(key), self.GENERATION_TTL)
+        pipe.delete(key)
+        pipe.execute()
+
+    def token(self, key: str) -> int:
+        return int(self.client.get(self._generation_key(key)) or 0)
+
+
+class NullCache(CacheBackend):
+    """Кеш выключен (FSTR_CACHE_BACKEND=none)"""
+    enabled = False
+
+    def _get(self, key: str) -> Optional[bytes]:
+        return None
+
+    def set(self, key: str, value: bytes, token: int = None):
+        pass
+
+    def delete(self, key: str):
+        pass
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> CacheBackend:
+    """Кеш документов перевалов для процесса.
+
+    FSTR_CACHE_BACKEND — memory (по умолчанию), redis, none или свой класс
+    'package.module:ClassName' (конструктор получает FSTR_CACHE_URL и TTL).
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            backend = os.getenv('FSTR_CACHE_BACKEND', 'memory')
+            ttl = float(os.getenv('FSTR_CACHE_TTL', '300'))
+            url = os.getenv('FSTR_CACHE_URL', 'redis://localhost:6379/0')
+            if backend == 'memory':
+                _cache = LRUCache(int(os.getenv('FSTR_CACHE_MAX_BYTES', str(64 * 1024 * 1024))), ttl)
+            elif backend == 'redis':
+                _cache = RedisCache(url, ttl)
+            elif backend == 'none':
+                _cache = NullCache()
+            else:
+                module_name, _, class_name = backend.partition(':')
+                _cache = getattr(importlib.import_module(module_name), class_name)(url, ttl)
+        return _cache
@@ -0,0 +1,208 @@
+import os
+import asyncio
+import logging
+import select
+import threading
+from typing import Optional
+import psycopg2
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'pereval_changes'
+BATCH_SIZE = 1000
+# Уведомления за это время (секунд) сливаются в одно чтение таблицы:
+# при частых записях лента не просыпается на каждый коммит
+COALESCE_INTERVAL = 0.05
+
+# Пульс в потоке SSE, секунд без событий; размер очереди одного подписчика
+HEARTBEAT = float(os.getenv('FSTR_CHANGES_HEARTBEAT', '15'))
+QUEUE_SIZE = int(os.getenv('FSTR_CHANGES_QUEUE_SIZE', '1000'))
+
+_OVERFLOW = object()
+
+
+class ResyncRequired(Exception):
+    """Позиция вне хранимой ленты: изменения уже удалены или БД пересоздана"""
+
+
+class Subscription:
+    """Очередь событий одного подписчика; наполняется в его event loop"""
+
+    def __init__(self, maxsize: int):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize)
+
+    def push(self, events: list):
+        for event in events:
+            if self.queue.full():
+                # Подписчик не успевает: он дочитает пропущенное из таблицы по seq
+                self.clear()
+                self.queue.put_nowait(_OVERFLOW)
+                return
+            self.queue.put_nowait(event)
+
+    def clear(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+
+class ChangeFeed(threading.Thread):
+    """Одно соединение LISTEN на процесс, раздающее новые изменения всем подписчикам.
+
+    Уведомление только будит поток, сами изменения читаются из pereval_changes
+    по seq. Поэтому уведомление, потерянное при переподключении, ничего не
+    теряет, а без уведомлений таблица перечитывается раз в poll_interval.
+    """
+
+    def __init__(self, db: database.Database, poll_interval: float):
+        super().__init__(name='change-feed', daemon=True)
+        self.db = db
+        self.poll_interval = poll_interval
+        self.last_seq = None
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._wake_read, self._wake_write = os.pipe()
+
+    def run(self):
+        while not self._stopping.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**database._connection_params())
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CHANNEL}")
+                self._listen(conn)
+            except Exception as e:
+                logger.error(f"Change feed error: {e}")
+                self._stopping.wait(self.poll_interval)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def _listen(self, conn):
+        while not self._stopping.is_set():
+            # После (пере)подключения сначала дочитываем всё, что появилось без нас
+            self._fetch()
+            ready, _, _ = select.select([conn, self._wake_read], [], [], self.poll_interval)
+            if conn in ready:
+                self._stopping.wait(COALESCE_INTERVAL)
+                conn.poll()
+                conn.notifies.clear()
+
+    def _fetch(self):
+        if self.last_seq is None:
+            self.last_seq = self.db.change_bounds()[1] or 0
+        while True:
+            events = self.db.get_changes(self.last_seq, BATCH_SIZE)
+            if not events:
+                return
+            self.last_seq = events[-1]['seq']
+            with self._lock:
+                subscribers = list(self._subscribers)
+            for subscription in subscribers:
+                try:
+                    subscription.loop.call_soon_threadsafe(subscription.push, events)
+                except RuntimeError:
+                    pass  # event loop подписчика уже закрыт
+            if len(events) < BATCH_SIZE:
+                return
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription(QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def stop(self):
+        self._stopping.set()
+        os.write(self._wake_write, b'x')
+        self.join()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+
+_feed = None
+_feed_lock = threading.Lock()
+
+
+def get_feed() -> ChangeFeed:
+    """Лента процесса; поток с LISTEN запускается при первом подписчике"""
+    global _feed
+    with _feed_lock:
+        if _feed is None:
+            _feed = ChangeFeed(database.Database(), float(os.getenv('FSTR_CHANGES_POLL_INTERVAL', '5')))
+            _feed.start()
+        return _feed
+
+
+def stop_feed():
+    global _feed
+    with _feed_lock:
+        if _feed is not None:
+            _feed.stop()
+            _feed = None
+
+
+metrics.Gauge("change_feed_subscribers", "Открытые потоки GET /changes/stream",
+              collect=lambda: _feed.subscribers if _feed is not None else 0)
+
+
+async def check_position(db: database.AsyncDatabase, after: int):
+    """ResyncRequired, если продолжить с after нельзя: изменения после него уже удалены"""
+    low, high = await db.change_bounds()
+    if after > (high or 0) or (low is not None and after < low - 1):
+        raise ResyncRequired("Изменения после этой позиции не сохранились, нужна полная синхронизация")
+
+
+async def follow(after: Optional[int] = None, heartbeat: float = HEARTBEAT):
+    """Асинхронный генератор изменений с seq больше after (None — только новых).
+
+    Пропущенное до подписки дочитывается из таблицы, дальше события идут
+    из ленты процесса. Если событий нет heartbeat секунд, отдаёт None.
+    """
+    db = database.AsyncDatabase()
+    if after is not None:
+        await check_position(db, after)
+    feed = get_feed()
+    subscription = feed.subscribe()
+    try:
+        last = after if after is not None else feed.last_seq
+        # Лента ещё не прочитала свою начальную позицию — начинаем с текущего конца таблицы
+        catch_up = last is None or after is not None
+        if last is None:
+            last = (await db.change_bounds())[1] or 0
+        while True:
+            if catch_up:
+                # Всё, что уже в очереди, есть и в таблице; новое после clear() останется в очереди
+                subscription.clear()
+                while True:
+                    events = await db.get_changes(last, BATCH_SIZE)
+                    for event in events:
+                        yield event
+                        last = event['seq']
+                    if len(events) < BATCH_SIZE:
+                        break
+                catch_up = False
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), heartbeat)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if event is _OVERFLOW:
+                catch_up = True
+            elif event['seq'] > last:
+                yield event
+                last = event['seq']
+    finally:
+        feed.unsubscribe(subscription)
@@ -1,82 +1,771 @@
 import os
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+from psycopg2.extras import Json, execute_values
 from dotenv import load_dotenv
 import logging
 import base64
+import hashlib
+import math
+import metrics
+import re
+import storage
+import sys
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+from typing import NamedTuple, Optional
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
 
-class Database:
-    def __init__(self):
-        self.conn = psycopg2.connect(
-            host=os.getenv('FSTR_DB_HOST', 'localhost'),
-            port=os.getenv('FSTR_DB_PORT', '5432'),
-            dbname=os.getenv('FSTR_DB_NAME', 'pereval'),
-            user=os.getenv('FSTR_DB_LOGIN', 'pereval_user'),
-            password=os.getenv('FSTR_DB_PASS', 'pereval_password')
+class PoolTimeout(Exception):
+    """Не удалось получить соединение из пула за отведённое время"""
+
+
+class IdempotentReplay(Exception):
+    """Запрос с этим Idempotency-Key уже выполнен: результат первой попытки"""
+
+    def __init__(self, pereval_id: Optional[int], job_id: Optional[int]):
+        super().__init__("Запрос уже выполнен")
+        self.pereval_id = pereval_id
+        self.job_id = job_id
+
+
+class IdempotencyKeyReused(Exception):
+    """Idempotency-Key уже использован с другим телом запроса"""
+
+
+class IdempotencyKey(NamedTuple):
+    """Заголовок Idempotency-Key и sha256 тела запроса, которым ключ закреплён"""
+    key: str
+    request_hash: bytes
+
+
+# Запросы дольше порога (мс) пишутся в лог с меткой; 0 — не писать
+SLOW_QUERY_MS = float(os.getenv('FSTR_SLOW_QUERY_MS', '500'))
+
+# Сколько секунд помнить Idempotency-Key; позже тот же ключ считается новым
+IDEMPOTENCY_TTL = float(os.getenv('FSTR_IDEMPOTENCY_TTL', str(24 * 3600)))
+
+_SQL_VERB = re.compile(r'\b(SELECT|INSERT|UPDATE|DELETE|DECLARE|SAVEPOINT|ROLLBACK|RELEASE)\b', re.I)
+_SQL_TABLE = re.compile(r'\b(?:INTO|UPDATE|FROM)\s+(\w+)', re.I)
+
+
+def _query_label(sql) -> str:
+    """Метка запроса для метрик: метод модуля, из которого он выполнен, действие и таблица.
+
+    Например 'submit_data:INSERT users' — мало различных значений, в отличие от самого SQL.
+    """
+    frame = sys._getframe(2)
+    while frame is not None and (frame.f_code.co_filename != __file__ or frame.f_code in _CURSOR_CODE):
+        frame = frame.f_back
+    caller = frame.f_code.co_name if frame is not None else 'other'
+    # execute_values передаёт уже собранный запрос в bytes; метке хватает начала
+    head = sql[:300].decode('utf-8', 'replace') if isinstance(sql, bytes) else str(sql)[:300]
+    head = re.sub(r'^\s*SET LOCAL [^;]*;', '', head)
+    verb = _SQL_VERB.search(head)
+    table = _SQL_TABLE.search(head)
+    return ' '.join(filter(None, (
+        f"{caller}:{verb.group(1).upper() if verb else 'SQL'}", table.group(1) if table else None
+    )))
+
+
+class Statement:
+    """Запрос, который на каждом соединении пула готовится один раз (PREPARE) и дальше
+    выполняется по имени (EXECUTE): PostgreSQL не разбирает и не планирует его заново.
+
+    sql — с плейсхолдерами %s, как для cursor.execute. Типы параметров PREPARE
+    выводит из запроса (id = $1 — integer), поэтому id из URL приводите явно:
+    id = %s::bigint, иначе id вне int4 — ошибка вместо «не найдено».
+    """
+
+    def __init__(self, name: str, sql: str):
+        if '%(' in sql:
+            raise ValueError("Именованные параметры в подготовленных запросах не поддерживаются")
+        self.name = name
+        self.sql = sql
+        parts = sql.split('%%')
+        count = sum(part.count('%s') for part in parts)
+        numbers = iter(range(1, count + 1))
+        self.prepare_sql = f"PREPARE {name} AS " + '%'.join(
+            re.sub(r'%s', lambda _: f"${next(numbers)}", part) for part in parts
         )
-        self.conn.autocommit = False
+        self.execute_sql = f"EXECUTE {name}" + (f" ({', '.join(['%s'] * count)})" if count else "")
+
+
+_statements = {}
+
+
+def prepared(name: str, sql: str) -> Statement:
+    """Регистрирует именованный горячий запрос для cursor.execute_prepared"""
+    if name in _statements:
+        raise ValueError(f"Запрос {name} уже зарегистрирован")
+    _statements[name] = Statement(name, sql)
+    return _statements[name]
 
-    def submit_data(self, data: dict) -> int:
-        """Добавляет запись о перевале в БД и возвращает ID перевала"""
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """Соединение пула, помнящее, какие запросы на нём уже подготовлены.
+
+    prepared — имена подготовленных запросов (None — не готовить, выполнять текст
+    как есть). Новое соединение начинает с пустого набора, поэтому после
+    переподключения запросы готовятся заново.
+    """
+    prepared = None
+    # Подготовленные запросы на сервере разошлись с prepared: перед следующим PREPARE — DEALLOCATE ALL
+    reset_prepared = False
+
+
+# Подготовленный запрос пропал на сервере (DISCARD ALL, пулер соединений) или
+# перестал подходить после изменения схемы: его нужно подготовить заново
+_STALE_STATEMENT_ERRORS = (
+    psycopg2.errors.InvalidSqlStatementName,
+    psycopg2.errors.DuplicatePreparedStatement,
+    psycopg2.errors.FeatureNotSupported,
+)
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Курсор, замеряющий каждый execute в db_query_duration_seconds и пишущий медленные в лог"""
+
+    def execute(self, query, vars=None):
+        return self._timed(query, super().execute, query, vars)
+
+    def execute_prepared(self, statement: Statement, vars=None):
+        """execute зарегистрированного запроса: по имени, если соединение готовит запросы"""
+        if getattr(self.connection, 'prepared', None) is None:
+            return self.execute(statement.sql, vars)
+        return self._timed(statement.sql, self._execute_prepared, statement, vars)
+
+    def _execute_prepared(self, statement: Statement, vars):
+        conn = self.connection
+        execute = super().execute
+        at_start = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        try:
+            return self._run_prepared(execute, statement, vars)
+        except _STALE_STATEMENT_ERRORS as e:
+            if isinstance(e, psycopg2.errors.FeatureNotSupported) and 'cached plan' not in str(e):
+                raise
+            logger.warning(f"Prepared statement {statement.name} is stale, re-preparing: {str(e).strip()}")
+            conn.prepared.clear()
+            conn.reset_prepared = True
+            if not at_start:
+                # Транзакция уже прервана, и повторить её начало нельзя — ошибка уходит вызывающему
+                raise
+            conn.rollback()
+            return self._run_prepared(execute, statement, vars)
+
+    def _run_prepared(self, execute, statement: Statement, vars):
+        conn = self.connection
+        if conn.reset_prepared:
+            execute("DEALLOCATE ALL")
+            conn.reset_prepared = False
+        if statement.name not in conn.prepared:
+            execute(statement.prepare_sql)
+            # PREPARE не откатывается вместе с транзакцией, так что набор остаётся верным
+            conn.prepared.add(statement.name)
+            metrics.DB_STATEMENT_PREPARES.inc(statement=statement.name)
+        return execute(statement.execute_sql, vars)
+
+    def _timed(self, sql, run, *args):
+        started = time.perf_counter()
+        failed = False
         try:
-            with self.conn.cursor() as cursor:
+            return run(*args)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            label = _query_label(sql)
+            if failed:
+                metrics.DB_QUERY_ERRORS.inc(query=label)
+            else:
+                metrics.DB_QUERY_DURATION.observe(elapsed, query=label)
+            if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+                logger.warning(f"Slow query {label}: {elapsed * 1000:.1f} ms")
+
+
+# Методы курсора, которые _query_label пропускает, ища вызывающий метод Database
+_CURSOR_CODE = {
+    TimedCursor.execute.__code__, TimedCursor.execute_prepared.__code__, TimedCursor._execute_prepared.__code__,
+    TimedCursor._run_prepared.__code__, TimedCursor._timed.__code__,
+}
+
+
+class ConnectionPool:
+    """Пул соединений с PostgreSQL.
+
+    Соединение проверяется при выдаче (если простаивало дольше check_idle секунд)
+    и закрывается по истечении max_lifetime секунд с момента открытия.
+    С prepare=True на соединениях готовятся запросы, выполняемые через execute_prepared.
+
+    Под блокировкой пула только резервируется слот; подключение, проверка
+    и откат идут без неё, так что медленный сервер не задерживает остальные
+    выдачи и возвраты.
+    """
+
+    def __init__(self, minconn: int, maxconn: int, max_lifetime: float = 3600.0,
+                 check_idle: float = 30.0, timeout: float = 30.0, prepare: bool = True, **conn_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Некорректные размеры пула соединений")
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.max_lifetime = max_lifetime
+        self.check_idle = check_idle
+        self.timeout = timeout
+        self.prepare = prepare
+        self._conn_kwargs = conn_kwargs
+        self._idle = deque()  # (conn, created_at, last_used)
+        self._created = {}  # id(conn) -> created_at
+        self._opening = 0  # слоты, зарезервированные под открываемые соединения
+        self._cond = threading.Condition()
+        self._closed = False
+        for _ in range(minconn):
+            conn = self._connect()
+            self._created[id(conn)] = created_at = time.monotonic()
+            self._idle.append((conn, created_at, created_at))
+
+    def _connect(self):
+        conn = psycopg2.connect(**{
+            'cursor_factory': TimedCursor, 'connection_factory': PreparingConnection, **self._conn_kwargs
+        })
+        conn.autocommit = False
+        if self.prepare:
+            conn.prepared = set()
+        return conn
+
+    def _discard(self, conn):
+        with self._cond:
+            self._created.pop(id(conn), None)
+            self._cond.notify()
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _expired(self, created_at: float) -> bool:
+        return self.max_lifetime > 0 and time.monotonic() - created_at > self.max_lifetime
+
+    def _healthy(self, conn, last_used: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.check_idle:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @property
+    def size(self) -> int:
+        return len(self._created)
+
+    @property
+    def idle(self) -> int:
+        return len(self._idle)
+
+    def getconn(self):
+        started = time.monotonic()
+        try:
+            return self._getconn(started + self.timeout)
+        finally:
+            metrics.DB_POOL_WAIT.observe(time.monotonic() - started)
+
+    def _reserve(self, deadline: float):
+        """Простаивающее соединение (conn, created_at, last_used) или None — слот под новое"""
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout("Пул соединений закрыт")
+                if self._idle:
+                    return self._idle.pop()
+                if len(self._created) + self._opening < self.maxconn:
+                    self._opening += 1
+                    return None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout("Нет свободных соединений с БД")
+                self._cond.wait(remaining)
+
+    def _getconn(self, deadline: float):
+        while True:
+            idle = self._reserve(deadline)
+            if idle is not None:
+                conn, created_at, last_used = idle
+                if self._expired(created_at) or not self._healthy(conn, last_used):
+                    self._discard(conn)
+                    continue
+                return conn
+            try:
+                conn = self._connect()
+            except BaseException:
+                with self._cond:
+                    self._opening -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._opening -= 1
+                self._created[id(conn)] = time.monotonic()
+                closed = self._closed
+            if closed:
+                self._discard(conn)
+                raise PoolTimeout("Пул соединений закрыт")
+            return conn
+
+    def putconn(self, conn, close: bool = False):
+        with self._cond:
+            created_at = self._created.get(id(conn))
+            if created_at is None:
+                return
+        broken = close or self._closed or conn.closed or self._expired(created_at)
+        if not broken and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        if not broken:
+            with self._cond:
+                if not self._closed:
+                    self._idle.append((conn, created_at, time.monotonic()))
+                    self._cond.notify()
+                    return
+        self._discard(conn)
+
+    @contextmanager
+    def connection(self):
+        """Выдаёт соединение на время блока и возвращает его в пул"""
+        conn = self.getconn()
+        try:
+            yield conn
+        except psycopg2.InterfaceError:
+            self.putconn(conn, close=True)
+            raise
+        except BaseException:
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, deque()
+            self._cond.notify_all()
+        for conn, _, _ in idle:
+            self._discard(conn)
+
+
+class ReplicaSet:
+    """Пулы соединений с репликами для чтения.
+
+    Реплики выдаются по кругу. Недоступная реплика и реплика, отставшая
+    больше max_lag секунд, исключаются на eject_time секунд. Если подходящей
+    реплики нет, getconn возвращает None и чтение идёт на основной сервер.
+    """
+
+    def __init__(self, pools: list, max_lag: float = 10.0, eject_time: float = 30.0,
+                 check_interval: float = 5.0):
+        if not pools:
+            raise ValueError("Нужна хотя бы одна реплика")
+        self.pools = pools
+        self.max_lag = max_lag
+        self.eject_time = eject_time
+        self.check_interval = check_interval
+        self._ejected_until = [0.0] * len(pools)
+        self._checked_at = [0.0] * len(pools)
+        self._owners = {}  # id(conn) -> номер реплики
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _order(self) -> list:
+        now = time.monotonic()
+        with self._lock:
+            start = self._next
+            self._next = (start + 1) % len(self.pools)
+            candidates = ((start + n) % len(self.pools) for n in range(len(self.pools)))
+            return [index for index in candidates if self._ejected_until[index] <= now]
+
+    def available(self, index: int) -> bool:
+        return self._ejected_until[index] <= time.monotonic()
+
+    def eject(self, index: int, reason: str):
+        with self._lock:
+            self._ejected_until[index] = time.monotonic() + self.eject_time
+            self._checked_at[index] = 0.0
+        logger.warning(f"Replica {index} ejected for {self.eject_time:.0f} s: {reason}")
+
+    def _fresh(self, index: int, conn, min_lsn: Optional[str]) -> bool:
+        """Отставание не больше max_lag (проверяется раз в check_interval) и min_lsn уже воспроизведён"""
+        now = time.monotonic()
+        if self.max_lag and now - self._checked_at[index] >= self.check_interval:
+            with conn.cursor() as cursor:
+                # Всё полученное воспроизведено — реплика догнала, даже если записей давно не было
+                cursor.execute("""
+                    SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                                ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END
+                """)
+                lag = cursor.fetchone()[0]
+            self._checked_at[index] = now
+            if lag is not None and lag > self.max_lag:
+                self.eject(index, f"lag {lag:.1f} s")
+                return False
+        if min_lsn is None:
+            return True
+        with conn.cursor() as cursor:
+            # Не физическая реплика не может подтвердить позицию основного сервера
+            cursor.execute("SELECT pg_is_in_recovery() AND pg_last_wal_replay_lsn() >= %s::pg_lsn", (min_lsn,))
+            return bool(cursor.fetchone()[0])
+
+    def getconn(self, min_lsn: str = None):
+        """Соединение с живой, не отставшей репликой, догнавшей min_lsn; None, если такой нет"""
+        for index in self._order():
+            pool = self.pools[index]
+            try:
+                conn = pool.getconn()
+            except PoolTimeout:
+                continue  # реплика жива, просто занята
+            except psycopg2.Error as e:
+                self.eject(index, str(e).strip().splitlines()[0])
+                continue
+            try:
+                fresh = self._fresh(index, conn, min_lsn)
+            except psycopg2.Error as e:
+                pool.putconn(conn, close=True)
+                self.eject(index, str(e).strip().splitlines()[0])
+                continue
+            if not fresh:
+                pool.putconn(conn)
+                continue
+            with self._lock:
+                self._owners[id(conn)] = index
+            return conn
+        return None
+
+    def putconn(self, conn) -> bool:
+        """Возвращает соединение в пул его реплики; False, если оно выдано не репликой"""
+        with self._lock:
+            index = self._owners.pop(id(conn), None)
+        if index is None:
+            return False
+        if conn.closed:
+            self.eject(index, "connection lost")
+        self.pools[index].putconn(conn)
+        return True
+
+    def closeall(self):
+        for pool in self.pools:
+            pool.closeall()
+
+
+def _connection_params() -> dict:
+    return dict(
+        host=os.getenv('FSTR_DB_HOST', 'localhost'),
+        port=os.getenv('FSTR_DB_PORT', '5432'),
+        dbname=os.getenv('FSTR_DB_NAME', 'pereval'),
+        user=os.getenv('FSTR_DB_LOGIN', 'pereval_user'),
+        password=os.getenv('FSTR_DB_PASS', 'pereval_password')
+    )
+
+
+def _pool_options() -> dict:
+    return dict(
+        maxconn=int(os.getenv('FSTR_DB_POOL_MAX', '10')),
+        max_lifetime=float(os.getenv('FSTR_DB_POOL_MAX_LIFETIME', '3600')),
+        check_idle=float(os.getenv('FSTR_DB_POOL_CHECK_IDLE', '30')),
+        timeout=float(os.getenv('FSTR_DB_POOL_TIMEOUT', '30')),
+        prepare=os.getenv('FSTR_DB_PREPARE', '1') != '0'
+    )
+
+
+_pool = None
+_replicas = None
+_pool_lock = threading.Lock()
+
+# Позиция WAL основного сервера, которую должна воспроизвести реплика,
+# чтобы читать с неё в текущем запросе (заголовок X-Session-Token)
+session_lsn = contextvars.ContextVar('session_lsn', default=None)
+
+
+def init_pool() -> ConnectionPool:
+    """Создаёт общий для процесса пул соединений (настройки из FSTR_DB_POOL_*).
+
+    Если задан FSTR_DB_REPLICAS (DSN через запятую), создаёт и пулы реплик для чтения.
+    """
+    global _pool, _replicas
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                minconn=int(os.getenv('FSTR_DB_POOL_MIN', '1')),
+                **_pool_options(),
+                **_connection_params()
+            )
+            dsns = [dsn.strip() for dsn in os.getenv('FSTR_DB_REPLICAS', '').split(',') if dsn.strip()]
+            if dsns:
+                # Соединения с репликами открываются по требованию: недоступная реплика не мешает старту
+                _replicas = ReplicaSet(
+                    [ConnectionPool(minconn=0, dsn=dsn, **_pool_options()) for dsn in dsns],
+                    max_lag=float(os.getenv('FSTR_DB_REPLICA_MAX_LAG', '10')),
+                    eject_time=float(os.getenv('FSTR_DB_REPLICA_EJECT_TIME', '30'))
+                )
+        return _pool
+
+
+def get_pool() -> ConnectionPool:
+    return _pool if _pool is not None else init_pool()
+
+
+def get_replicas() -> Optional[ReplicaSet]:
+    """Реплики общего пула или None, если они не настроены"""
+    get_pool()
+    return _replicas
+
+
+def _pool_stats() -> dict:
+    pool = _pool
+    if pool is None:
+        return {}
+    return {('idle',): pool.idle, ('in_use',): pool.size - pool.idle, ('max',): pool.maxconn}
+
+
+metrics.Gauge("db_pool_connections", "Соединения общего пула по состоянию", ("state",), collect=_pool_stats)
+
+
+def _replica_stats() -> dict:
+    replicas = _replicas
+    if replicas is None:
+        return {}
+    return {(str(index),): int(replicas.available(index)) for index in range(len(replicas.pools))}
+
+
+metrics.Gauge("db_replica_up", "1 — реплика принимает чтения, 0 — исключена", ("replica",), collect=_replica_stats)
+
+
+def close_pool():
+    global _pool, _replicas
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+        if _replicas is not None:
+            _replicas.closeall()
+            _replicas = None
+
+
+_COORD_SCALE = Decimal('0.000001')
+
+
+def _coords_key(coords: dict) -> tuple:
+    """Координаты в том виде, в каком их сохранит NUMERIC(9,6): для дедупликации в пачке"""
+    return (
+        Decimal(repr(float(coords['latitude']))).quantize(_COORD_SCALE, ROUND_HALF_UP),
+        Decimal(repr(float(coords['longitude']))).quantize(_COORD_SCALE, ROUND_HALF_UP),
+        int(coords['height'])
+    )
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def _lon_boxes(min_lon: float, min_lat: float, max_lon: float, max_lat: float) -> list:
+    """Делит прямоугольник, пересекающий ±180°, на два; долготы нормализует в [-180, 180]"""
+    if max_lon - min_lon >= 360:
+        return [(-180.0, min_lat, 180.0, max_lat)]
+    if min_lon < -180:
+        return [(min_lon + 360, min_lat, 180.0, max_lat), (-180.0, min_lat, max_lon, max_lat)]
+    if max_lon > 180:
+        return [(min_lon, min_lat, 180.0, max_lat), (-180.0, min_lat, max_lon - 360, max_lat)]
+    return [(min_lon, min_lat, max_lon, max_lat)]
+
+
+def _radius_boxes(lat: float, lon: float, radius_km: float) -> list:
+    """Прямоугольники (min_lon, min_lat, max_lon, max_lat), покрывающие круг на сфере"""
+    angle = radius_km / EARTH_RADIUS_KM
+    min_lat, max_lat = lat - math.degrees(angle), lat + math.degrees(angle)
+    if min_lat <= -90 or max_lat >= 90 or angle >= math.pi / 2:
+        # Круг накрывает полюс — нужны все долготы
+        return [(-180.0, max(min_lat, -90.0), 180.0, min(max_lat, 90.0))]
+    ratio = math.sin(angle) / math.cos(math.radians(lat))
+    if ratio >= 1:
+        return [(-180.0, min_lat, 180.0, max_lat)]
+    dlon = math.degrees(math.asin(ratio))
+    return _lon_boxes(lon - dlon, min_lat, lon + dlon, max_lat)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Ограниченный пул потоков для блокирующих вызовов psycopg2 (FSTR_DB_MAX_CONCURRENCY)"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = int(os.getenv('FSTR_DB_MAX_CONCURRENCY', os.getenv('FSTR_DB_POOL_MAX', '10')))
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db')
+        return _executor
+
+
+def shutdown_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+
+
+class Database:
+    def __init__(self, pool: ConnectionPool = None, store: storage.BlobStore = None,
+                 replicas: ReplicaSet = None):
+        # С явно переданным пулом общие реплики не подключаются: пул может смотреть в другую БД
+        self.replicas = replicas if replicas is not None or pool is not None else get_replicas()
+        self.pool = pool or get_pool()
+        self.store = store or storage.get_store()
+
+    def _read_getconn(self, current: bool = False):
+        """Соединение для чтения: с реплики, догнавшей сессию (session_lsn), иначе с основного сервера.
+
+        current=True — только с реплики, догнавшей текущую позицию WAL основного
+        сервера: она видит всё, что уже видно на нём.
+        """
+        if self.replicas is not None:
+            conn = self.replicas.getconn(self.session_token() if current else session_lsn.get())
+            if conn is not None:
+                metrics.DB_READS.inc(target='replica')
+                return conn
+        metrics.DB_READS.inc(target='primary')
+        return self.pool.getconn()
+
+    def _read_putconn(self, conn):
+        if self.replicas is None or not self.replicas.putconn(conn):
+            self.pool.putconn(conn)
+
+    def session_token(self) -> Optional[str]:
+        """Текущая позиция WAL основного сервера; None, если реплик нет.
+
+        Запрашивается после записи: реплика, воспроизведшая эту позицию,
+        уже видит записанное.
+        """
+        if self.replicas is None:
+            return None
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_current_wal_lsn()::text")
+                return cursor.fetchone()[0]
+        finally:
+            self.pool.putconn(conn)
+
+    def _store_image(self, image: dict) -> storage.StoredBlob:
+        """Кладёт изображение из запроса (base64) в хранилище файлов"""
+        if 'blob' in image:
+            # Уже записано потоково при multipart-загрузке
+            return image['blob']
+        blob = self.store.put(base64.b64decode(image['data']))
+        metrics.IMAGE_BYTES.inc(blob.size, direction='in')
+        return blob
+
+    # Горячие запросы одиночной загрузки: готовятся на соединении один раз (см. Statement)
+    _UPSERT_USER = prepared('upsert_user', """
+        INSERT INTO users (email, fam, name, otc, phone)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (email) DO UPDATE SET email = EXCLUDED.email
+        RETURNING id
+    """)
+    _UPSERT_COORDS = prepared('upsert_coords', """
+        INSERT INTO coords (latitude, longitude, height)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (latitude, longitude, height) DO UPDATE SET height = EXCLUDED.height
+        RETURNING id
+    """)
+    _INSERT_PEREVAL = prepared('insert_pereval', """
+        INSERT INTO pereval_added (
+            beauty_title, title, other_titles, connect, add_time,
+            user_id, coord_id, status,
+            level_winter, level_summer, level_autumn, level_spring
+        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        RETURNING id
+    """)
+    _INSERT_IMAGE = prepared('insert_image', """
+        INSERT INTO pereval_images (sha256, size, content_type, title)
+        VALUES (%s, %s, %s, %s)
+        RETURNING id
+    """)
+    _LINK_IMAGE = prepared('link_image', """
+        INSERT INTO pereval_image_links (pereval_id, image_id)
+        VALUES (%s, %s)
+    """)
+
+    def _claim_idempotency_key(self, cursor, idempotency: IdempotencyKey):
+        """Закрепляет ключ за текущей транзакцией или сообщает результат прошлой попытки.
+
+        Если ключ вставляет параллельная транзакция, INSERT ждёт её завершения:
+        после COMMIT будет IdempotentReplay с её результатом, после ROLLBACK
+        ключ достаётся нам. Просроченный ключ переиспользуется.
+        """
+        cursor.execute("""
+            INSERT INTO idempotency_keys (key, request_hash) VALUES (%s, %s)
+            ON CONFLICT (key) DO UPDATE
+                SET request_hash = EXCLUDED.request_hash, pereval_id = NULL, job_id = NULL, created_at = now()
+                WHERE idempotency_keys.created_at < now() - make_interval(secs => %s)
+            RETURNING key
+        """, (idempotency.key, idempotency.request_hash, IDEMPOTENCY_TTL))
+        if cursor.fetchone() is not None:
+            return
+        cursor.execute("SELECT request_hash, pereval_id, job_id FROM idempotency_keys WHERE key = %s",
+                       (idempotency.key,))
+        recorded_hash, pereval_id, job_id = cursor.fetchone()
+        if bytes(recorded_hash) != idempotency.request_hash:
+            raise IdempotencyKeyReused("Idempotency-Key уже использован с другими данными")
+        raise IdempotentReplay(pereval_id, job_id)
+
+    def submit_data(self, data: dict, idempotency: IdempotencyKey = None) -> int:
+        """Добавляет запись о перевале в БД и возвращает ID перевала.
+
+        С idempotency повтор уже выполненного запроса ничего не пишет
+        и поднимает IdempotentReplay с результатом первой попытки.
+        """
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                if idempotency is not None:
+                    self._claim_idempotency_key(cursor, idempotency)
+
                 # 1. Сохраняем пользователя или получаем существующего
                 user = data['user']
-                cursor.execute(
-                    "SELECT id FROM users WHERE email = %s",
-                    (user['email'],)
+                # Upsert за один запрос: без гонки на UNIQUE(email) между параллельными запросами.
+                # Пустой DO UPDATE нужен, чтобы RETURNING вернул id и для уже существующей строки
+                cursor.execute_prepared(
+                    self._UPSERT_USER,
+                    (user['email'], user['fam'], user['name'], user.get('otc'), user['phone'])
                 )
-                existing_user = cursor.fetchone()
-                if existing_user:
-                    user_id = existing_user[0]
-                else:
-                    cursor.execute(
-                        """
-                        INSERT INTO users (email, fam, name, otc, phone)
-                        VALUES (%s, %s, %s, %s, %s)
-                        RETURNING id;
-                        """,
-                        (user['email'], user['fam'], user['name'], user.get('otc'), user['phone'])
-                    )
-                    user_id = cursor.fetchone()[0]
+                user_id = cursor.fetchone()[0]
 
-                # 2. Сохраняем координаты (с проверкой на существование)
+                # 2. Сохраняем координаты или получаем существующие
                 coords = data['coords']
                 latitude = float(coords['latitude'])
                 longitude = float(coords['longitude'])
                 height = int(coords['height'])
-                cursor.execute(
-                    "SELECT id FROM coords WHERE latitude = %s AND longitude = %s AND height = %s",
-                    (latitude, longitude, height)
-                )
-                existing_coord = cursor.fetchone()
-                if existing_coord:
-                    coord_id = existing_coord[0]
-                else:
-                    cursor.execute(
-                        """
-                        INSERT INTO coords (latitude, longitude, height)
-                        VALUES (%s, %s, %s)
-                        RETURNING id;
-                        """,
-                        (latitude, longitude, height)
-                    )
-                    coord_id = cursor.fetchone()[0]
+                cursor.execute_prepared(self._UPSERT_COORDS, (latitude, longitude, height))
+                coord_id = cursor.fetchone()[0]
 
                 # 3. Сохраняем перевал
-                cursor.execute(
-                    """
-                    INSERT INTO pereval_added (
-                        beauty_title, title, other_titles, connect, add_time,
-                        user_id, coord_id, status,
-                        level_winter, level_summer, level_autumn, level_spring
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    RETURNING id;
-                    """,
+                cursor.execute_prepared(
+                    self._INSERT_PEREVAL,
                     (
                         data['beauty_title'], data['title'], data['other_titles'], data['connect'], data['add_time'],
                         user_id, coord_id, 'new',
@@ -88,94 +777,561 @@ class Database:
 
                 # 4. Сохраняем изображения
                 for image in data['images']:
-                    img_binary = base64.b64decode(image['data'])
-                    cursor.execute(
-                        """
-                        INSERT INTO pereval_images (img, title)
-                        VALUES (%s, %s)
-                        RETURNING id;
-                        """,
-                        (img_binary, image['title'])
+                    blob = self._store_image(image)
+                    cursor.execute_prepared(
+                        self._INSERT_IMAGE, (blob.sha256, blob.size, blob.content_type, image['title'])
                     )
                     image_id = cursor.fetchone()[0]
-                    cursor.execute(
-                        """
-                        INSERT INTO pereval_image_links (pereval_id, image_id)
-                        VALUES (%s, %s);
-                        """,
-                        (pereval_id, image_id)
-                    )
+                    cursor.execute_prepared(self._LINK_IMAGE, (pereval_id, image_id))
+
+                if idempotency is not None:
+                    cursor.execute("UPDATE idempotency_keys SET pereval_id = %s WHERE key = %s",
+                                   (pereval_id, idempotency.key))
 
-                self.conn.commit()
+                conn.commit()
                 return pereval_id
 
+        except (IdempotentReplay, IdempotencyKeyReused):
+            conn.rollback()
+            raise
         except Exception as e:
             logger.error(f"Database error: {e}")
-            self.conn.rollback()
+            conn.rollback()
             raise
         finally:
-            self.conn.close()
+            self.pool.putconn(conn)
+
+    def submit_batch(self, items: list, chunk_size: int = 200) -> list:
+        """Добавляет пачку перевалов; на каждую запись — {'id': ...} или {'status': ..., 'error': ...}.
+
+        Записи пишутся порциями по chunk_size: одна транзакция и по одному
+        многострочному INSERT на таблицу, пользователи (по email) и координаты
+        дедуплицируются внутри порции. Если транзакция порции не прошла, её
+        записи добавляются по одной, чтобы ошибка досталась только виновной.
+        """
+        results = [None] * len(items)
+        for offset in range(0, len(items), chunk_size):
+            chunk = []
+            for n in range(offset, min(offset + chunk_size, len(items))):
+                data = items[n]
+                try:
+                    blobs = [{'blob': self._store_image(image), 'title': image['title']} for image in data['images']]
+                except ValueError as e:
+                    results[n] = {'status': 400, 'error': str(e)}
+                    continue
+                chunk.append((n, {**data, 'images': blobs}))
+            if not chunk:
+                continue
+
+            try:
+                pereval_ids = self._insert_chunk([data for _, data in chunk])
+            except Exception as e:
+                logger.error(f"Batch chunk failed, retrying items one by one: {e}")
+                for n, data in chunk:
+                    try:
+                        results[n] = {'id': self.submit_data(data)}
+                    except (ValueError, psycopg2.DataError, psycopg2.IntegrityError) as item_error:
+                        results[n] = {'status': 400, 'error': str(item_error).strip()}
+                    except Exception:
+                        results[n] = {'status': 500, 'error': "Внутренняя ошибка сервера"}
+                continue
+
+            for (n, _), pereval_id in zip(chunk, pereval_ids):
+                results[n] = {'id': pereval_id}
+        return results
 
-    def get_pereval_by_id(self, pereval_id: int) -> dict:
+    def _insert_chunk(self, chunk: list) -> list:
+        """Пишет порцию перевалов одной транзакцией и возвращает их ID в том же порядке"""
+        conn = self.pool.getconn()
         try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("SELECT * FROM pereval_added WHERE id = %s", (pereval_id,))
-                pereval = cursor.fetchone()
-                if not pereval:
-                    return None
+            with conn.cursor() as cursor:
+                pereval_ids = self._insert_rows(cursor, chunk)
+            conn.commit()
+            return pereval_ids
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
 
-                cursor.execute("SELECT * FROM coords WHERE id = %s", (pereval[7],))
-                coords_data = cursor.fetchone()
+    def _insert_rows(self, cursor, chunk: list) -> list:
+        """Многострочные INSERT порции в текущей транзакции; изображения уже в хранилище ('blob')"""
+        # 1. Пользователи: по одной строке на email. Ключи сортируем, чтобы
+        # параллельные пачки брали блокировки в одном порядке и не ловили deadlock
+        users = {}
+        for data in chunk:
+            users.setdefault(data['user']['email'], data['user'])
+        user_ids = dict(execute_values(
+            cursor,
+            """
+            INSERT INTO users (email, fam, name, otc, phone) VALUES %s
+            ON CONFLICT (email) DO UPDATE SET email = EXCLUDED.email
+            RETURNING email, id
+            """,
+            [(u['email'], u['fam'], u['name'], u.get('otc'), u['phone']) for _, u in sorted(users.items())],
+            page_size=len(users), fetch=True
+        ))
 
-                cursor.execute("SELECT * FROM users WHERE id = %s", (pereval[6],))
-                user_data = cursor.fetchone()
+        # 2. Координаты: по одной строке на (latitude, longitude, height)
+        keys = sorted(set(_coords_key(data['coords']) for data in chunk))
+        coord_ids = {
+            (lat, lon, height): coord_id
+            for lat, lon, height, coord_id in execute_values(
+                cursor,
+                """
+                INSERT INTO coords (latitude, longitude, height) VALUES %s
+                ON CONFLICT (latitude, longitude, height) DO UPDATE SET height = EXCLUDED.height
+                RETURNING latitude, longitude, height, id
+                """,
+                keys, page_size=len(keys), fetch=True
+            )
+        }
 
-                cursor.execute("""
-                    SELECT i.id, i.title, i.img
-                    FROM pereval_image_links l
-                    JOIN pereval_images i ON l.image_id = i.id
-                    WHERE l.pereval_id = %s
-                """, (pereval_id,))
-                images = []
+        # 3. Перевалы: ID берём из последовательности заранее, чтобы не зависеть от порядка RETURNING
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence('pereval_added', 'id')) FROM generate_series(1, %s)",
+            (len(chunk),)
+        )
+        pereval_ids = [row[0] for row in cursor.fetchall()]
+        execute_values(
+            cursor,
+            """
+            INSERT INTO pereval_added (
+                id, beauty_title, title, other_titles, connect, add_time,
+                user_id, coord_id, status,
+                level_winter, level_summer, level_autumn, level_spring
+            ) VALUES %s
+            """,
+            [
+                (
+                    pereval_id, data['beauty_title'], data['title'], data['other_titles'], data['connect'],
+                    data['add_time'], user_ids[data['user']['email']], coord_ids[_coords_key(data['coords'])],
+                    'new', data['level'].get('winter'), data['level']['summer'],
+                    data['level']['autumn'], data['level'].get('spring')
+                )
+                for pereval_id, data in zip(pereval_ids, chunk)
+            ],
+            page_size=len(chunk)
+        )
+
+        # 4. Изображения и связи
+        images = [(pereval_id, image) for pereval_id, data in zip(pereval_ids, chunk) for image in data['images']]
+        if images:
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence('pereval_images', 'id')) FROM generate_series(1, %s)",
+                (len(images),)
+            )
+            image_ids = [row[0] for row in cursor.fetchall()]
+            execute_values(
+                cursor,
+                "INSERT INTO pereval_images (id, sha256, size, content_type, title) VALUES %s",
+                [
+                    (image_id, image['blob'].sha256, image['blob'].size, image['blob'].content_type, image['title'])
+                    for image_id, (_, image) in zip(image_ids, images)
+                ],
+                page_size=len(images)
+            )
+            execute_values(
+                cursor,
+                "INSERT INTO pereval_image_links (pereval_id, image_id) VALUES %s",
+                [(pereval_id, image_id) for image_id, (pereval_id, _) in zip(image_ids, images)],
+                page_size=len(images)
+            )
+
+        return pereval_ids
+
+    def enqueue_submission(self, data: dict, idempotency: IdempotencyKey = None) -> int:
+        """Ставит перевал в очередь ingest_jobs и возвращает ID задания.
+
+        Изображения сразу уходят в хранилище файлов, в очередь попадают только
+        их sha256 — задание остаётся небольшим JSON-документом. idempotency —
+        как в submit_data: повтор не сохраняет изображения заново.
+        """
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                if idempotency is not None:
+                    self._claim_idempotency_key(cursor, idempotency)
+                images = [
+                    {'title': image['title'], **self._store_image(image)._asdict()}
+                    for image in data['images']
+                ]
+                cursor.execute(
+                    "INSERT INTO ingest_jobs (payload) VALUES (%s) RETURNING id;",
+                    (Json({**data, 'images': images}),)
+                )
+                job_id = cursor.fetchone()[0]
+                if idempotency is not None:
+                    cursor.execute("UPDATE idempotency_keys SET job_id = %s WHERE key = %s",
+                                   (job_id, idempotency.key))
+            conn.commit()
+            return job_id
+        except (IdempotentReplay, IdempotencyKeyReused):
+            conn.rollback()
+            raise
+        except Exception as e:
+            logger.error(f"Database error: {e}")
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
+    def process_ingest_batch(self, limit: int = 100) -> int:
+        """Разбирает до limit заданий из очереди одной транзакцией; возвращает их число.
+
+        Задания блокируются FOR UPDATE SKIP LOCKED, так что несколько воркеров
+        (и процессов) берут разные пачки. Пачка пишется многострочными INSERT;
+        если она не прошла, задания повторяются по одному под SAVEPOINT и
+        ошибка достаётся только виновному заданию.
+        """
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT id, payload FROM ingest_jobs
+                    WHERE status = 'queued'
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED;
+                    """,
+                    (limit,)
+                )
+                jobs = cursor.fetchall()
+                if not jobs:
+                    conn.commit()
+                    return 0
+
+                chunk = [
+                    {**payload, 'images': [
+                        {'title': image['title'],
+                         'blob': storage.StoredBlob(image['sha256'], image['size'], image['content_type'])}
+                        for image in payload['images']
+                    ]}
+                    for _, payload in jobs
+                ]
+                cursor.execute("SAVEPOINT ingest_batch;")
+                try:
+                    pereval_ids = self._insert_rows(cursor, chunk)
+                    results = [(job_id, 'done', pereval_id, None)
+                               for (job_id, _), pereval_id in zip(jobs, pereval_ids)]
+                except Exception as e:
+                    logger.error(f"Ingest batch failed, retrying jobs one by one: {e}")
+                    cursor.execute("ROLLBACK TO SAVEPOINT ingest_batch;")
+                    results = []
+                    for (job_id, _), data in zip(jobs, chunk):
+                        cursor.execute("SAVEPOINT ingest_job;")
+                        try:
+                            results.append((job_id, 'done', self._insert_rows(cursor, [data])[0], None))
+                        except Exception as job_error:
+                            cursor.execute("ROLLBACK TO SAVEPOINT ingest_job;")
+                            results.append((job_id, 'failed', None, str(job_error).strip()))
+
+                # Данные выполненных заданий уже в таблицах — payload оставляем только у упавших
+                execute_values(
+                    cursor,
+                    """
+                    UPDATE ingest_jobs AS j
+                    SET status = v.status, pereval_id = v.pereval_id, error = v.error, finished_at = now(),
+                        payload = CASE WHEN v.status = 'done' THEN '{}'::jsonb ELSE j.payload END
+                    FROM (VALUES %s) AS v (id, status, pereval_id, error)
+                    WHERE j.id = v.id
+                    """,
+                    results,
+                    template="(%s, %s, %s::integer, %s)",
+                    page_size=len(results)
+                )
+            conn.commit()
+            return len(jobs)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
+    def get_job(self, job_id: int) -> Optional[dict]:
+        """Состояние задания очереди загрузки"""
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT id, status, pereval_id, error, created_at, finished_at
+                    FROM ingest_jobs WHERE id = %s;
+                    """,
+                    (job_id,)
+                )
+                row = cursor.fetchone()
+            conn.commit()
+            if row is None:
+                return None
+            return {
+                "id": row[0],
+                "status": row[1],
+                "pereval_id": row[2],
+                "error": row[3],
+                "created_at": row[4],
+                "finished_at": row[5]
+            }
+        except Exception as e:
+            logger.error(f"Database error: {e}")
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
+    # Документ перевала одним запросом: перевал, координаты, пользователь и изображения.
+    # Параметры: отдавать ли байты изображений, выбирать ли сами изображения, затем условие WHERE.
+    # Байты — через FILTER, а не CASE: агрегат внутри CASE всё равно читал бы старые img
+    _DOCUMENT_SELECT = """
+        SELECT p.id, p.beauty_title, p.title, p.other_titles, p.connect,
+               to_char(p.add_time, 'YYYY-MM-DD HH24:MI:SS'), p.status,
+               p.level_winter, p.level_summer, p.level_autumn, p.level_spring,
+               c.latitude::float8, c.longitude::float8, c.height,
+               u.email, u.fam, u.name, u.otc, u.phone,
+               i.image_ids, i.image_titles, i.image_hashes, i.image_sizes, i.image_types,
+               i.image_data
+        FROM pereval_added p
+        JOIN coords c ON c.id = p.coord_id
+        JOIN users u ON u.id = p.user_id
+        LEFT JOIN LATERAL (
+            SELECT array_agg(pi.id ORDER BY pi.id) AS image_ids,
+                   array_agg(pi.title ORDER BY pi.id) AS image_titles,
+                   array_agg(pi.sha256 ORDER BY pi.id) AS image_hashes,
+                   array_agg(COALESCE(pi.size, octet_length(pi.img)) ORDER BY pi.id) AS image_sizes,
+                   array_agg(pi.content_type ORDER BY pi.id) AS image_types,
+                   array_agg(pi.img ORDER BY pi.id) FILTER (WHERE %s) AS image_data
+            FROM pereval_image_links l
+            JOIN pereval_images pi ON pi.id = l.image_id
+            WHERE l.pereval_id = p.id AND %s
+        ) i ON TRUE
+    """
+
+    _DOCUMENT_BY_ID = prepared('pereval_document', _DOCUMENT_SELECT + " WHERE p.id = %s::bigint")
+
+    def _pereval_document(self, row: tuple, include_data: bool) -> dict:
+        (id_, beauty_title, title, other_titles, connect, add_time, status,
+         level_winter, level_summer, level_autumn, level_spring,
+         latitude, longitude, height,
+         email, fam, name, otc, phone,
+         image_ids, image_titles, image_hashes, image_sizes, image_types, image_data) = row
+
+        images = []
+        for n, image_id in enumerate(image_ids or []):
+            image = {
+                'id': image_id,
+                'title': image_titles[n],
+                'content_type': image_types[n],
+                'size': image_sizes[n],
+                'sha256': image_hashes[n],
+                'url': f"/images/{image_id}",
+                'thumbnail_url': f"/images/{image_id}/thumbnail"
+            }
+            if include_data:
+                # Старые записи хранят байты в БД, новые — в хранилище файлов
+                img = image_data[n] if image_data[n] is not None else self.store.read(image_hashes[n])
+                image['data'] = base64.b64encode(img).decode('utf-8')
+            images.append(image)
+
+        return {
+            'id': id_,
+            'beauty_title': beauty_title,
+            'title': title,
+            'other_titles': other_titles,
+            'connect': connect,
+            'add_time': add_time,
+            'status': status,
+            'level': {
+                'winter': level_winter,
+                'summer': level_summer,
+                'autumn': level_autumn,
+                'spring': level_spring
+            },
+            'coords': {
+                'latitude': latitude,
+                'longitude': longitude,
+                'height': height
+            },
+            'user': {
+                'email': email,
+                'fam': fam,
+                'name': name,
+                'otc': otc,
+                'phone': phone
+            },
+            'images': images
+        }
+
+    def get_pereval_by_id(self, pereval_id: int, include_data: bool = False, current: bool = False) -> dict:
+        """Документ перевала; изображения — метаданные и URL, base64 только при include_data.
+
+        current=True — не старее основного сервера (см. _read_getconn).
+        """
+        conn = self._read_getconn(current)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute_prepared(self._DOCUMENT_BY_ID, (include_data, True, pereval_id))
+                row = cursor.fetchone()
+                if not row:
+                    return None
+                return self._pereval_document(row, include_data)
+        finally:
+            self._read_putconn(conn)
+
+    def get_perevals_by_ids(self, ids: list, fields: set = None) -> dict:
+        """Документы нескольких перевалов одним запросом: {id: документ}, отсутствующих ID нет.
+
+        fields — какие из блоков 'user', 'level', 'coords', 'images' включить
+        (по умолчанию все); без 'images' изображения из БД не читаются.
+        """
+        blocks = {'user', 'level', 'coords', 'images'}
+        skip = blocks - set(fields) if fields is not None else set()
+        conn = self._read_getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(self._DOCUMENT_SELECT + " WHERE p.id = ANY(%s)",
+                               (False, 'images' not in skip, list(ids)))
+                documents = {}
                 for row in cursor.fetchall():
-                    img_data = base64.b64encode(row[2]).decode('utf-8')
-                    images.append({'id': row[0], 'title': row[1], 'data': img_data})
+                    document = self._pereval_document(row, False)
+                    for block in skip:
+                        del document[block]
+                    documents[document['id']] = document
+                return documents
+        finally:
+            self._read_putconn(conn)
+
+    def export_perevals(self, status: str = None, updated_since: datetime = None,
+                        include_images: bool = False, chunk_size: int = 1000):
+        """Генератор всего каталога порциями по chunk_size плоских записей, в порядке id.
+
+        Строки читаются именованным (серверным) курсором, так что в памяти
+        процесса одновременно не больше одной порции. Соединение занято, пока
+        генератор не исчерпан или не закрыт.
+        """
+        conditions, params = [], [include_images]
+        if status is not None:
+            conditions.append("p.status = %s")
+            params.append(status)
+        if updated_since is not None:
+            conditions.append("p.updated_at >= %s")
+            params.append(updated_since)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        conn = self._read_getconn()
+        try:
+            with conn.cursor(name='pereval_export') as cursor:
+                cursor.execute(f"""
+                    SELECT p.id, p.beauty_title, p.title, p.other_titles, p.connect,
+                           to_char(p.add_time, 'YYYY-MM-DD HH24:MI:SS'), p.updated_at,
+                           p.status, p.level_winter, p.level_summer, p.level_autumn, p.level_spring,
+                           c.latitude::float8, c.longitude::float8, c.height,
+                           u.email, u.fam, u.name, u.otc, u.phone,
+                           CASE WHEN %s THEN (
+                               SELECT coalesce(json_agg(json_build_object(
+                                          'id', pi.id, 'title', pi.title, 'content_type', pi.content_type,
+                                          'size', COALESCE(pi.size, octet_length(pi.img)), 'sha256', pi.sha256,
+                                          'url', '/images/' || pi.id
+                                      ) ORDER BY pi.id), '[]')
+                               FROM pereval_image_links l
+                               JOIN pereval_images pi ON pi.id = l.image_id
+                               WHERE l.pereval_id = p.id
+                           ) END
+                    FROM pereval_added p
+                    JOIN coords c ON c.id = p.coord_id
+                    JOIN users u ON u.id = p.user_id
+                    {where}
+                    ORDER BY p.id
+                """, params)
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    chunk = []
+                    for row in rows:
+                        item = {
+                            'id': row[0],
+                            'beauty_title': row[1],
+                            'title': row[2],
+                            'other_titles': row[3],
+                            'connect': row[4],
+                            'add_time': row[5],
+                            'updated_at': row[6].isoformat(),
+                            'status': row[7],
+                            'level_winter': row[8],
+                            'level_summer': row[9],
+                            'level_autumn': row[10],
+                            'level_spring': row[11],
+                            'latitude': row[12],
+                            'longitude': row[13],
+                            'height': row[14],
+                            'user_email': row[15],
+                            'user_fam': row[16],
+                            'user_name': row[17],
+                            'user_otc': row[18],
+                            'user_phone': row[19]
+                        }
+                        if include_images:
+                            item['images'] = row[20]
+                        chunk.append(item)
+                    yield chunk
+            conn.commit()
+        finally:
+            self._read_putconn(conn)
 
+    _IMAGE_BY_ID = prepared('image', """
+        SELECT id, title, sha256, size, content_type,
+               CASE WHEN sha256 IS NULL THEN img END
+        FROM pereval_images
+        WHERE id = %s::bigint
+    """)
+
+    def get_image(self, image_id: int) -> dict:
+        """Метаданные изображения; у старых записей без sha256 — ещё и байты из БД"""
+        conn = self._read_getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute_prepared(self._IMAGE_BY_ID, (image_id,))
+                row = cursor.fetchone()
+                if not row:
+                    return None
+                id_, title, sha256, size, content_type, img = row
+                if img is not None:
+                    img = bytes(img)
+                    sha256 = hashlib.sha256(img).hexdigest()
+                    size = len(img)
+                    content_type = storage.sniff_content_type(img[:16])
                 return {
-                    'id': pereval[0],
-                    'beauty_title': pereval[1],
-                    'title': pereval[2],
-                    'other_titles': pereval[3],
-                    'connect': pereval[4],
-                    'add_time': pereval[5].strftime("%Y-%m-%d %H:%M:%S"),
-                    'status': pereval[8],
-                    'level': {
-                        'winter': pereval[9],
-                        'summer': pereval[10],
-                        'autumn': pereval[11],
-                        'spring': pereval[12]
-                    },
-                    'coords': {
-                        'latitude': float(coords_data[1]),
-                        'longitude': float(coords_data[2]),
-                        'height': coords_data[3]
-                    },
-                    'user': {
-                        'email': user_data[1],
-                        'fam': user_data[2],
-                        'name': user_data[3],
-                        'otc': user_data[4],
-                        'phone': user_data[5]
-                    },
-                    'images': images
+                    'id': id_,
+                    'title': title,
+                    'sha256': sha256,
+                    'size': size,
+                    'content_type': content_type,
+                    'img': img
                 }
         finally:
-            self.conn.close()
+            self._read_putconn(conn)
+
+    _PEREVAL_STATUS = prepared('pereval_status', "SELECT status FROM pereval_added WHERE id = %s::bigint")
+    _UPDATE_PEREVAL = prepared('update_pereval', """
+        UPDATE pereval_added
+        SET beauty_title = COALESCE(%s, beauty_title),
+            title = COALESCE(%s, title),
+            other_titles = COALESCE(%s, other_titles),
+            connect = COALESCE(%s, connect),
+            level_winter = COALESCE(%s, level_winter),
+            level_summer = COALESCE(%s, level_summer),
+            level_autumn = COALESCE(%s, level_autumn),
+            level_spring = COALESCE(%s, level_spring),
+            updated_at = now()
+        WHERE id = %s::bigint
+    """)
 
     def update_pereval(self, pereval_id: int, data: dict) -> bool:
+        conn = self.pool.getconn()
         try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("SELECT status FROM pereval_added WHERE id = %s", (pereval_id,))
+            with conn.cursor() as cursor:
+                cursor.execute_prepared(self._PEREVAL_STATUS, (pereval_id,))
                 result = cursor.fetchone()
                 if not result:
                     raise ValueError("Запись не найдена")
@@ -189,19 +1345,8 @@ class Database:
                         (float(coords['latitude']), float(coords['longitude']), int(coords['height']), pereval_id)
                     )
 
-                cursor.execute(
-                    """
-                    UPDATE pereval_added
-                    SET beauty_title = COALESCE(%s, beauty_title),
-                        title = COALESCE(%s, title),
-                        other_titles = COALESCE(%s, other_titles),
-                        connect = COALESCE(%s, connect),
-                        level_winter = COALESCE(%s, level_winter),
-                        level_summer = COALESCE(%s, level_summer),
-                        level_autumn = COALESCE(%s, level_autumn),
-                        level_spring = COALESCE(%s, level_spring)
-                    WHERE id = %s
-                    """,
+                cursor.execute_prepared(
+                    self._UPDATE_PEREVAL,
                     (
                         data.get('beauty_title'), data.get('title'), data.get('other_titles'), data.get('connect'),
                         data.get('level', {}).get('winter') if 'level' in data else None,
@@ -213,51 +1358,166 @@ class Database:
                 )
 
                 if 'images' in data:
-                    cursor.execute("DELETE FROM pereval_image_links WHERE pereval_id = %s", (pereval_id,))
-                    cursor.execute("DELETE FROM pereval_images WHERE id IN (SELECT image_id FROM pereval_image_links WHERE pereval_id = %s)", (pereval_id,))
-                    for image in data['images']:
-                        img_binary = base64.b64decode(image['data'])
-                        cursor.execute(
-                            "INSERT INTO pereval_images (img, title) VALUES (%s, %s) RETURNING id",
-                            (img_binary, image['title'])
-                        )
-                        image_id = cursor.fetchone()[0]
-                        cursor.execute(
-                            "INSERT INTO pereval_image_links (pereval_id, image_id) VALUES (%s, %s)",
-                            (pereval_id, image_id)
-                        )
-
-                self.conn.commit()
+                    self._update_images(cursor, pereval_id, data['images'])
+
+                conn.commit()
                 return True
         except Exception as e:
-            self.conn.rollback()
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
+    def _update_images(self, cursor, pereval_id: int, images: list):
+        """Приводит изображения перевала к списку images, сравнивая их по sha256.
+
+        Совпавшие изображения остаются как есть (меняется только подпись), в
+        хранилище пишутся только новые, убранные удаляются вместе со связями.
+        """
+        cursor.execute(
+            """
+            SELECT i.id, COALESCE(i.sha256, encode(sha256(i.img), 'hex')), i.title
+            FROM pereval_image_links l
+            JOIN pereval_images i ON i.id = l.image_id
+            WHERE l.pereval_id = %s
+            ORDER BY i.id
+            FOR UPDATE OF i;
+            """,
+            (pereval_id,)
+        )
+        current = {}  # sha256 -> [(id, title), ...]
+        for image_id, sha256, title in cursor.fetchall():
+            current.setdefault(sha256, []).append((image_id, title))
+
+        for image in images:
+            if 'blob' in image:
+                raw, sha256 = None, image['blob'].sha256
+            else:
+                raw = base64.b64decode(image['data'])
+                sha256 = hashlib.sha256(raw).hexdigest()
+            if current.get(sha256):
+                image_id, title = current[sha256].pop(0)
+                if title != image['title']:
+                    cursor.execute("UPDATE pereval_images SET title = %s WHERE id = %s", (image['title'], image_id))
+                continue
+            if raw is None:
+                blob = image['blob']
+            else:
+                blob = self.store.put(raw)
+                metrics.IMAGE_BYTES.inc(blob.size, direction='in')
+            cursor.execute(
+                "INSERT INTO pereval_images (sha256, size, content_type, title) VALUES (%s, %s, %s, %s) RETURNING id",
+                (blob.sha256, blob.size, blob.content_type, image['title'])
+            )
+            image_id = cursor.fetchone()[0]
+            cursor.execute(
+                "INSERT INTO pereval_image_links (pereval_id, image_id) VALUES (%s, %s)",
+                (pereval_id, image_id)
+            )
+
+        # Оставшиеся в current больше не нужны; связи удалятся каскадом, файлы — уборщиком
+        removed = [image_id for rows in current.values() for image_id, _ in rows]
+        if removed:
+            cursor.execute("DELETE FROM pereval_images WHERE id = ANY(%s)", (removed,))
+
+    def delete_orphan_images(self, limit: int = 1000) -> int:
+        """Удаляет до limit строк pereval_images без связей с перевалами; возвращает их число"""
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    DELETE FROM pereval_images WHERE id IN (
+                        SELECT i.id FROM pereval_images i
+                        WHERE NOT EXISTS (SELECT 1 FROM pereval_image_links l WHERE l.image_id = i.id)
+                        LIMIT %s
+                    );
+                    """,
+                    (limit,)
+                )
+                deleted = cursor.rowcount
+            conn.commit()
+            return deleted
+        except Exception as e:
+            logger.error(f"Database error: {e}")
+            conn.rollback()
             raise
         finally:
-            self.conn.close()
+            self.pool.putconn(conn)
 
-    def get_pereval_by_email(self, email: str) -> list:
+    def unreferenced_blobs(self, hashes: list) -> list:
+        """Хеши из hashes, на которые не ссылаются ни изображения, ни ожидающие задания очереди"""
+        conn = self.pool.getconn()
         try:
-            with self.conn.cursor() as cursor:
-                cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
-                user = cursor.fetchone()
-                if not user:
-                    return []
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT h FROM unnest(%s::char(64)[]) AS h
+                    WHERE NOT EXISTS (SELECT 1 FROM pereval_images i WHERE i.sha256 = h)
+                      AND NOT EXISTS (
+                          SELECT 1 FROM ingest_jobs j, jsonb_array_elements(j.payload -> 'images') AS image
+                          WHERE j.status = 'queued' AND image ->> 'sha256' = h
+                      );
+                    """,
+                    (hashes,)
+                )
+                rows = cursor.fetchall()
+            conn.commit()
+            return [row[0] for row in rows]
+        except Exception as e:
+            logger.error(f"Database error: {e}")
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
 
-                user_id = user[0]
-                cursor.execute("""
-                    SELECT id, beauty_title, title, other_titles, connect, add_time, status,
-                           level_winter, level_summer, level_autumn, level_spring
-                    FROM pereval_added
-                    WHERE user_id = %s
-                """, (user_id,))
+    def get_pereval_by_email(self, email: str, limit: int = 100, after: tuple = None,
+                             status: str = None, date_from: datetime = None,
+                             date_to: datetime = None) -> tuple:
+        """Страница перевалов пользователя в порядке (add_time, id).
 
+        after — ключ (add_time, id) последней записи предыдущей страницы.
+        Возвращает (записи, ключ для следующей страницы или None).
+        """
+        conditions = ["u.email = %s"]
+        params = [email]
+        if status is not None:
+            conditions.append("p.status = %s")
+            params.append(status)
+        if date_from is not None:
+            conditions.append("p.add_time >= %s")
+            params.append(date_from)
+        if date_to is not None:
+            conditions.append("p.add_time < %s")
+            params.append(date_to)
+        if after is not None:
+            conditions.append("(p.add_time, p.id) > (%s, %s)")
+            params.extend(after)
+
+        conn = self._read_getconn()
+        try:
+            with conn.cursor() as cursor:
+                # Берём на одну запись больше, чтобы понять, есть ли следующая страница
+                cursor.execute(f"""
+                    SELECT p.id, p.beauty_title, p.title, p.other_titles, p.connect, p.add_time, p.status,
+                           p.level_winter, p.level_summer, p.level_autumn, p.level_spring,
+                           to_char(p.add_time, 'YYYY-MM-DD HH24:MI:SS')
+                    FROM pereval_added p
+                    JOIN users u ON u.id = p.user_id
+                    WHERE {' AND '.join(conditions)}
+                    ORDER BY p.add_time, p.id
+                    LIMIT %s
+                """, (*params, limit + 1))
+                rows = cursor.fetchall()
+
+                next_key = (rows[limit - 1][5], rows[limit - 1][0]) if len(rows) > limit else None
                 return [{
                     'id': row[0],
                     'beauty_title': row[1],
                     'title': row[2],
                     'other_titles': row[3],
                     'connect': row[4],
-                    'add_time': row[5].strftime("%Y-%m-%d %H:%M:%S"),
+                    'add_time': row[11],
                     'status': row[6],
                     'level': {
                         'winter': row[7],
@@ -265,6 +1525,320 @@ class Database:
                         'autumn': row[9],
                         'spring': row[10]
                     }
+                } for row in rows[:limit]], next_key
+        finally:
+            self._read_putconn(conn)
+
+    def get_perevals_nearby(self, lat: float, lon: float, radius_km: float,
+                            limit: int = 50, offset: int = 0) -> list:
+        """Перевалы в радиусе radius_km от точки, ближние первыми"""
+        return self._perevals_in_boxes(_radius_boxes(lat, lon, radius_km), lat, lon, radius_km, limit, offset)
+
+    def get_perevals_in_bbox(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float,
+                             limit: int = 50, offset: int = 0) -> list:
+        """Перевалы в прямоугольнике, ближние к его центру первыми.
+
+        min_lon > max_lon означает прямоугольник через линию перемены дат.
+        """
+        if min_lon > max_lon:
+            max_lon += 360
+        center_lon = (min_lon + max_lon) / 2
+        center_lon = center_lon - 360 if center_lon > 180 else center_lon
+        boxes = _lon_boxes(min_lon, min_lat, max_lon, max_lat)
+        return self._perevals_in_boxes(boxes, (min_lat + max_lat) / 2, center_lon, None, limit, offset)
+
+    def _perevals_in_boxes(self, boxes: list, lat: float, lon: float, radius_km: Optional[float],
+                           limit: int, offset: int) -> list:
+        # Прямоугольники отбираются по GiST-индексу coords_point_idx, точное расстояние — по гаверсинусу
+        box_sql = " OR ".join(
+            "point(c.longitude::float8, c.latitude::float8) <@ box(point(%s, %s), point(%s, %s))" for _ in boxes
+        )
+        params = [value for box in boxes for value in box]
+        radius_sql = ""
+        if radius_km is not None:
+            radius_sql = "AND d.km <= %s"
+            params.append(radius_km)
+
+        conn = self._read_getconn()
+        try:
+            with conn.cursor() as cursor:
+                # LEAST: у почти антиподов округление даёт под корнем чуть больше 1, а asin(>1) — ошибка
+                cursor.execute(f"""
+                    SELECT p.id, p.beauty_title, p.title, p.status,
+                           c.latitude::float8, c.longitude::float8, c.height, d.km
+                    FROM coords c
+                    CROSS JOIN LATERAL (
+                        SELECT 2 * %s * asin(LEAST(1.0, sqrt(
+                            power(sin(radians(c.latitude::float8 - %s) / 2), 2)
+                            + cos(radians(%s)) * cos(radians(c.latitude::float8))
+                              * power(sin(radians(c.longitude::float8 - %s) / 2), 2)
+                        ))) AS km
+                    ) d
+                    JOIN pereval_added p ON p.coord_id = c.id
+                    WHERE ({box_sql}) {radius_sql}
+                    ORDER BY d.km, p.id
+                    LIMIT %s OFFSET %s
+                """, (EARTH_RADIUS_KM, lat, lat, lon, *params, limit, offset))
+
+                return [{
+                    'id': row[0],
+                    'beauty_title': row[1],
+                    'title': row[2],
+                    'status': row[3],
+                    'coords': {
+                        'latitude': row[4],
+                        'longitude': row[5],
+                        'height': row[6]
+                    },
+                    'distance_km': round(row[7], 3)
+                } for row in cursor.fetchall()]
+        finally:
+            self._read_putconn(conn)
+
+    def search_perevals(self, query: str, limit: int = 20, offset: int = 0,
+                        threshold: float = 0.5) -> list:
+        """Нечёткий поиск по beauty_title, title и other_titles, лучшие совпадения первыми.
+
+        score — word_similarity (pg_trgm) запроса и названий, от threshold до 1.
+        """
+        conn = self._read_getconn()
+        try:
+            with conn.cursor() as cursor:
+                # <% отбирает кандидатов по GIN-индексу, ранжируем уже только их
+                cursor.execute("""
+                    SET LOCAL pg_trgm.word_similarity_threshold = %s;
+                    SELECT p.id, p.beauty_title, p.title, p.other_titles, p.status,
+                           word_similarity(%s, p.search_text) AS score
+                    FROM pereval_added p
+                    WHERE %s <%% p.search_text
+                    ORDER BY score DESC, p.id
+                    LIMIT %s OFFSET %s
+                """, (threshold, query, query, limit, offset))
+
+                return [{
+                    'id': row[0],
+                    'beauty_title': row[1],
+                    'title': row[2],
+                    'other_titles': row[3],
+                    'status': row[4],
+                    'score': round(row[5], 3)
+                } for row in cursor.fetchall()]
+        finally:
+            self._read_putconn(conn)
+
+    def claim_perevals(self, moderator: str, limit: int = 10) -> list:
+        """Выдаёт модератору до limit самых старых записей 'new', переводя их в 'pending'.
+
+        FOR UPDATE SKIP LOCKED пропускает строки, которые в этот момент забирает
+        другой модератор, так что одна запись никогда не достаётся двоим.
+        """
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                # MATERIALIZED: подзапрос с LIMIT выполняется ровно один раз. В IN (...) планировщик
+                # мог повторять его во вложенном цикле, и записей выдавалось больше limit
+                cursor.execute(
+                    """
+                    WITH claimed AS MATERIALIZED (
+                        SELECT id FROM pereval_added
+                        WHERE status = 'new'
+                        ORDER BY add_time, id
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    UPDATE pereval_added p
+                    SET status = 'pending', moderator = %s, claimed_at = now(), updated_at = now()
+                    FROM claimed c, users u
+                    WHERE p.id = c.id AND u.id = p.user_id
+                    RETURNING p.id, p.beauty_title, p.title, p.other_titles, p.status, p.add_time, u.email;
+                    """,
+                    (limit, moderator)
+                )
+                rows = sorted(cursor.fetchall(), key=lambda row: (row[5], row[0]))
+            conn.commit()
+            return [{
+                'id': row[0],
+                'beauty_title': row[1],
+                'title': row[2],
+                'other_titles': row[3],
+                'status': row[4],
+                'add_time': row[5].isoformat(),
+                'user_email': row[6]
+            } for row in rows]
+        except Exception as e:
+            logger.error(f"Database error: {e}")
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
+    def moderate_perevals(self, moderator: str, ids: list, status: str) -> list:
+        """Переводит выданные модератору записи из 'pending' в status; возвращает ID изменённых.
+
+        Записи не в 'pending' или выданные другому модератору пропускаются.
+        """
+        if status not in ('accepted', 'rejected'):
+            raise ValueError("Недопустимый статус модерации")
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    UPDATE pereval_added
+                    SET status = %s, updated_at = now()
+                    WHERE id = ANY(%s) AND status = 'pending' AND moderator = %s
+                    RETURNING id;
+                    """,
+                    (status, ids, moderator)
+                )
+                updated = sorted(row[0] for row in cursor.fetchall())
+            conn.commit()
+            return updated
+        except Exception as e:
+            logger.error(f"Database error: {e}")
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
+    def get_changes(self, after: int, limit: int = 1000) -> list:
+        """Изменения перевалов с seq больше after, по возрастанию seq.
+
+        Читается с основного сервера: лента должна догонять уведомления LISTEN.
+        """
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT seq, pereval_id, op, status, to_char(changed_at, 'YYYY-MM-DD HH24:MI:SS')
+                    FROM pereval_changes
+                    WHERE seq > %s
+                    ORDER BY seq
+                    LIMIT %s
+                """, (after, limit))
+                return [{
+                    'seq': row[0],
+                    'pereval_id': row[1],
+                    'op': row[2],
+                    'status': row[3],
+                    'changed_at': row[4]
                 } for row in cursor.fetchall()]
         finally:
-            self.conn.close()
\ No newline at end of file
+            self.pool.putconn(conn)
+
+    def change_bounds(self) -> tuple:
+        """(наименьший, наибольший) хранимый seq ленты изменений; (None, None), если она пуста"""
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT min(seq), max(seq) FROM pereval_changes")
+                return cursor.fetchone()
+        finally:
+            self.pool.putconn(conn)
+
+    def purge_idempotency_keys(self) -> int:
+        """Удаляет просроченные Idempotency-Key"""
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM idempotency_keys WHERE created_at < now() - make_interval(secs => %s)",
+                    (IDEMPOTENCY_TTL,)
+                )
+                deleted = cursor.rowcount
+            conn.commit()
+            return deleted
+        except Exception as e:
+            logger.error(f"Database error: {e}")
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
+    def purge_changes(self, older_than: float) -> int:
+        """Удаляет изменения старше older_than секунд; последнее остаётся как отметка seq"""
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    DELETE FROM pereval_changes
+                    WHERE changed_at < now() - make_interval(secs => %s)
+                      AND seq < (SELECT max(seq) FROM pereval_changes)
+                """, (older_than,))
+                deleted = cursor.rowcount
+            conn.commit()
+            return deleted
+        except Exception as e:
+            logger.error(f"Database error: {e}")
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
+
+class AsyncDatabase:
+    """Неблокирующий доступ к Database для async-обработчиков.
+
+    Методы те же, что у Database, но выполняются в ограниченном пуле потоков
+    и возвращают корутины, поэтому медленный запрос не блокирует event loop.
+    """
+
+    def __init__(self, db: Database = None):
+        self.db = db or Database()
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        if not callable(method):
+            return method
+
+        @functools.wraps(method)
+        async def run(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            # Контекст запроса (session_lsn) переносим в поток пула
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(
+                get_executor(), functools.partial(context.run, method, *args, **kwargs)
+            )
+
+        return run
+
+
+_LSN = re.compile(r'^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$')
+_WRITE_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+
+class SessionTokenMiddleware:
+    """ASGI-middleware: чтение своих записей при работе с репликами.
+
+    Успешный ответ на изменяющий запрос получает заголовок X-Session-Token —
+    позицию WAL основного сервера после записи. Запрос с этим заголовком
+    читает только с реплик, которые её уже воспроизвели, иначе с основного
+    сервера. Без FSTR_DB_REPLICAS ничего не делает.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or _replicas is None:
+            await self.app(scope, receive, send)
+            return
+
+        token = dict(scope["headers"]).get(b"x-session-token", b"").decode("latin-1").strip()
+        reset = session_lsn.set(token if _LSN.match(token) else None)
+        write = scope["method"] in _WRITE_METHODS
+
+        async def send_with_token(message):
+            if write and message["type"] == "http.response.start" and message["status"] < 400:
+                try:
+                    lsn = await AsyncDatabase().session_token()
+                    message = {**message, "headers": [*message.get("headers", []),
+                                                      (b"x-session-token", lsn.encode())]}
+                except Exception as e:
+                    logger.error(f"Session token error: {e}")
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_token)
+        finally:
+            session_lsn.reset(reset)
@@ -0,0 +1,66 @@
+import os
+import logging
+import threading
+import database
+
+logger = logging.getLogger(__name__)
+
+
+class IngestWorker(threading.Thread):
+    """Фоновый поток, разбирающий очередь ingest_jobs пачками.
+
+    Каждая пачка — одна транзакция (групповой коммит). Пока очередь не пуста,
+    пачки идут одна за другой; потом поток ждёт poll_interval или wake().
+    """
+
+    def __init__(self, db: database.Database, batch_size: int, poll_interval: float):
+        super().__init__(name='ingest', daemon=True)
+        self.db = db
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._stopping = threading.Event()
+        self._wakeup = threading.Event()
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                processed = self.db.process_ingest_batch(self.batch_size)
+            except Exception as e:
+                logger.error(f"Ingest error: {e}")
+                processed = 0
+            if processed < self.batch_size:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        self.join()
+
+
+_workers = []
+
+
+def start_workers():
+    """Запускает FSTR_INGEST_WORKERS потоков (0 — очередь обрабатывает другой процесс)"""
+    count = int(os.getenv('FSTR_INGEST_WORKERS', '1'))
+    batch_size = int(os.getenv('FSTR_INGEST_BATCH_SIZE', '100'))
+    poll_interval = float(os.getenv('FSTR_INGEST_POLL_INTERVAL', '1'))
+    for _ in range(count):
+        worker = IngestWorker(database.Database(), batch_size, poll_interval)
+        worker.start()
+        _workers.append(worker)
+
+
+def stop_workers():
+    while _workers:
+        _workers.pop().stop()
+
+
+def wake_workers():
+    """Будит потоки этого процесса сразу после постановки задания в очередь"""
+    for worker in _workers:
+        worker.wake()
@@ -1,3 +1,6 @@
+-- Нечёткий поиск по названиям перевалов (триграммы)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
 -- 1. Таблица пользователей
 CREATE TABLE users (
     id SERIAL PRIMARY KEY,
@@ -17,6 +20,9 @@ CREATE TABLE coords (
     UNIQUE (latitude, longitude, height)
 );
 
+-- Поиск по местоположению: GiST по точке (долгота, широта), встроен в PostgreSQL без расширений
+CREATE INDEX coords_point_idx ON coords USING gist (point(longitude::float8, latitude::float8));
+
 -- 3. Основная таблица перевалов
 CREATE TABLE pereval_added (
     id SERIAL PRIMARY KEY,
@@ -31,17 +37,49 @@ CREATE TABLE pereval_added (
     level_winter VARCHAR(10),
     level_summer VARCHAR(10) NOT NULL,
     level_autumn VARCHAR(10) NOT NULL,
-    level_spring VARCHAR(10)
+    level_spring VARCHAR(10),
+    -- Кто и когда взял запись на модерацию (POST /moderation/claim)
+    moderator VARCHAR(255),
+    claimed_at TIMESTAMP WITHOUT TIME ZONE,
+    -- Время последнего изменения: выгрузка изменений (GET /export?updated_since=)
+    updated_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    -- Все названия одной строкой для триграммного поиска (GET /perevals/search)
+    search_text TEXT GENERATED ALWAYS AS (
+        beauty_title || ' ' || title || ' ' || coalesce(other_titles, '')
+    ) STORED
 );
 
+CREATE INDEX pereval_added_coord_idx ON pereval_added (coord_id);
+
+CREATE INDEX pereval_added_search_idx ON pereval_added USING gin (search_text gin_trgm_ops);
+
+-- Выборка перевалов пользователя страницами по (add_time, id), в том числе с фильтром по статусу
+CREATE INDEX pereval_added_user_time_idx ON pereval_added (user_id, add_time, id);
+CREATE INDEX pereval_added_user_status_time_idx ON pereval_added (user_id, status, add_time, id);
+
+-- Выгрузка изменений (GET /export?updated_since=)
+CREATE INDEX pereval_added_updated_idx ON pereval_added (updated_at);
+
+-- Очередь модерации: частичный индекс только по ожидающим записям остаётся
+-- маленьким, сколько бы ни накопилось обработанных
+CREATE INDEX pereval_added_moderation_idx ON pereval_added (add_time, id) WHERE status = 'new';
+
 -- 4. Таблица изображений
+-- Содержимое хранится вне БД (storage.py) и адресуется по sha256;
+-- колонка img заполнена только у старых записей, сделанных до выноса файлов
 CREATE TABLE pereval_images (
     id SERIAL PRIMARY KEY,
-    img BYTEA NOT NULL,
+    img BYTEA,
+    sha256 CHAR(64),
+    size BIGINT,
+    content_type VARCHAR(100),
     title VARCHAR(255) NOT NULL,
-    date_added TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    date_added TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    CHECK (img IS NOT NULL OR sha256 IS NOT NULL)
 );
 
+CREATE INDEX pereval_images_sha256_idx ON pereval_images (sha256);
+
 -- 5. Таблица связи перевалов и изображений
 CREATE TABLE pereval_image_links (
     pereval_id INTEGER NOT NULL REFERENCES pereval_added(id) ON DELETE CASCADE,
@@ -49,6 +87,71 @@ CREATE TABLE pereval_image_links (
     PRIMARY KEY (pereval_id, image_id)
 );
 
+-- Поиск сирот и каскадное удаление связей при удалении изображения
+CREATE INDEX pereval_image_links_image_idx ON pereval_image_links (image_id);
+
+
+-- 6. Очередь асинхронной загрузки (POST /submitData с Prefer: respond-async)
+CREATE TABLE ingest_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    status VARCHAR(10) NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'done', 'failed')),
+    payload JSONB NOT NULL,
+    pereval_id INTEGER REFERENCES pereval_added(id) ON DELETE SET NULL,
+    error TEXT,
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP WITHOUT TIME ZONE
+);
+
+-- Воркеры выбирают только ожидающие задания
+CREATE INDEX ingest_jobs_queued_idx ON ingest_jobs (id) WHERE status = 'queued';
+
+
+-- 7. Лента изменений перевалов (GET /changes, GET /changes/stream)
+-- Строку пишет триггер при каждом INSERT/UPDATE pereval_added, подписчики читают по seq
+CREATE TABLE pereval_changes (
+    seq BIGSERIAL PRIMARY KEY,
+    pereval_id INTEGER NOT NULL,
+    op VARCHAR(10) NOT NULL CHECK (op IN ('insert', 'update')),
+    status VARCHAR(20) NOT NULL,
+    changed_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT clock_timestamp()
+);
+
+CREATE INDEX pereval_changes_changed_idx ON pereval_changes (changed_at);
+
+CREATE FUNCTION pereval_changes_publish() RETURNS trigger AS $$
+BEGIN
+    -- Триггер отложенный и срабатывает при COMMIT, а блокировка держится до его конца:
+    -- номера seq выдаются в порядке фиксации, и подписчик, продолжающий с seq,
+    -- не пропустит транзакцию, которая получила номер раньше, а зафиксировалась позже
+    PERFORM pg_advisory_xact_lock(hashtext('pereval_changes'));
+    INSERT INTO pereval_changes (pereval_id, op, status) VALUES (NEW.id, lower(TG_OP), NEW.status);
+    -- Одинаковые уведомления в транзакции сливаются в одно
+    PERFORM pg_notify('pereval_changes', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE CONSTRAINT TRIGGER pereval_added_changes
+    AFTER INSERT OR UPDATE ON pereval_added
+    DEFERRABLE INITIALLY DEFERRED
+    FOR EACH ROW EXECUTE FUNCTION pereval_changes_publish();
+
+
+-- 8. Ключи идемпотентности POST /submitData (заголовок Idempotency-Key)
+-- Повтор запроса с тем же ключом получает результат первой попытки: ID перевала
+-- или, при асинхронной загрузке, ID задания. Внешних ключей нет — это журнал
+-- ответов, и удаление перевала не должно менять ответ на повтор
+CREATE TABLE idempotency_keys (
+    key VARCHAR(255) PRIMARY KEY,
+    request_hash BYTEA NOT NULL,
+    pereval_id INTEGER,
+    job_id BIGINT,
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Уборка просроченных ключей
+CREATE INDEX idempotency_keys_created_idx ON idempotency_keys (created_at);
+
 
 -- Предоставление прав пользователю pereval_user
 GRANT ALL PRIVILEGES ON ALL TABLES IN SCHEMA public TO pereval_user;
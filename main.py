@@ -1,17 +1,87 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Any, Dict, List, Literal, Optional, get_args
 from datetime import datetime
+from contextlib import asynccontextmanager
+import admission
+import cache
+import changes
 import database
+import ingest
 import logging
+import os
+import re
+import base64
+import csv
+import hashlib
+import io
+import itertools
+import metrics
+import threading
+import serialization
+from fastapi.concurrency import run_in_threadpool
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from pydantic import ValidationError
+from starlette.datastructures import UploadFile
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from serialization import FastJSONResponse
+import storage
+import sweeper
+import thumbnails
 
-app = FastAPI(title="FSTR Pereval API")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Пул соединений живёт столько же, сколько приложение
+    database.init_pool()
+    ingest.start_workers()
+    sweeper.start_sweeper()
+    try:
+        yield
+    finally:
+        sweeper.stop_sweeper()
+        changes.stop_feed()
+        ingest.stop_workers()
+        thumbnails.shutdown_executor()
+        database.shutdown_executor()
+        database.close_pool()
+
+
+app = FastAPI(title="FSTR Pereval API", lifespan=lifespan, default_response_class=FastJSONResponse)
+app.add_middleware(database.SessionTokenMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# Ограничения multipart-загрузки изображений
+UPLOAD_MAX_IMAGE_BYTES = int(os.getenv('FSTR_UPLOAD_MAX_IMAGE_BYTES', str(20 * 1024 * 1024)))
+UPLOAD_MAX_REQUEST_BYTES = int(os.getenv('FSTR_UPLOAD_MAX_REQUEST_BYTES', str(100 * 1024 * 1024)))
+UPLOAD_MAX_FILES = int(os.getenv('FSTR_UPLOAD_MAX_FILES', '20'))
+
+# Порог похожести для GET /perevals/search (pg_trgm word_similarity)
+SEARCH_THRESHOLD = float(os.getenv('FSTR_SEARCH_THRESHOLD', '0.5'))
+
+# Пакетная загрузка: максимум записей в запросе и размер транзакции
+BATCH_MAX_ITEMS = int(os.getenv('FSTR_BATCH_MAX_ITEMS', '1000'))
+BATCH_CHUNK_SIZE = int(os.getenv('FSTR_BATCH_CHUNK_SIZE', '200'))
+
+# Сколько перевалов можно запросить одним GET/POST /perevals
+MULTIGET_MAX_IDS = int(os.getenv('FSTR_MULTIGET_MAX_IDS', '200'))
+
+# Выгрузка каталога: строк на одну выборку из серверного курсора
+EXPORT_CHUNK_SIZE = int(os.getenv('FSTR_EXPORT_CHUNK_SIZE', '1000'))
+
+# Сколько изменений отдаёт один GET /changes
+CHANGES_MAX_LIMIT = int(os.getenv('FSTR_CHANGES_MAX_LIMIT', '1000'))
+
+# Длина заголовка Idempotency-Key (колонка idempotency_keys.key)
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+# Асинхронная загрузка: async — всегда через очередь, sync — только по заголовку Prefer: respond-async
+INGEST_MODE = os.getenv('FSTR_INGEST_MODE', 'sync')
+
 # Модели данных
 class User(BaseModel):
     email: str
@@ -35,7 +105,8 @@ class Image(BaseModel):
     data: str  # base64 encoded image
     title: str
 
-class PerevalInput(BaseModel):
+class PerevalMeta(BaseModel):
+    """Данные перевала без изображений (метаданные multipart-загрузки)"""
     beauty_title: str
     title: str
     other_titles: str = ""
@@ -44,6 +115,8 @@ class PerevalInput(BaseModel):
     user: User
     coords: Coords
     level: Level
+
+class PerevalInput(PerevalMeta):
     images: List[Image] = Field(..., min_items=1)
 
 
@@ -57,16 +130,293 @@ class PerevalUpdate(BaseModel):
     level: Optional[Level] = None
     images: Optional[List[Image]] = None
 
-@app.post("/submitData", summary="Submit new pereval data")
-async def submit_data(pereval: PerevalInput):
+
+PerevalBlock = Literal['user', 'level', 'coords', 'images']
+
+
+class PerevalIds(BaseModel):
+    """Тело POST /perevals: список ID и необязательный выбор блоков документа"""
+    ids: List[int] = Field(..., min_items=1)
+    fields: Optional[List[PerevalBlock]] = None
+
+
+class ModerationClaim(BaseModel):
+    moderator: str = Field(..., min_length=1, max_length=255)
+    limit: int = Field(10, ge=1, le=100)
+
+
+class ModerationDecision(BaseModel):
+    moderator: str = Field(..., min_length=1, max_length=255)
+    ids: List[int] = Field(..., min_items=1, max_items=1000)
+
+
+# Модели ответов — схема для OpenAPI. Списки эндпоинты отдают готовым
+# FastJSONResponse, поэтому FastAPI не прогоняет каждую запись через модель
+class CoordsOut(BaseModel):
+    latitude: float
+    longitude: float
+    height: int
+
+
+class ImageRef(BaseModel):
+    id: int
+    title: str
+    content_type: Optional[str] = None
+    size: Optional[int] = None
+    sha256: Optional[str] = None
+    url: str
+    thumbnail_url: str
+
+
+class PerevalSummary(BaseModel):
+    id: int
+    beauty_title: str
+    title: str
+    other_titles: Optional[str] = None
+    connect: Optional[str] = None
+    add_time: str = Field(..., examples=["2021-09-22 13:18:13"])
+    status: str
+    level: Level
+
+
+class PerevalDocument(BaseModel):
+    """Документ перевала; блоки, не выбранные в fields, отсутствуют"""
+    id: int
+    beauty_title: str
+    title: str
+    other_titles: Optional[str] = None
+    connect: Optional[str] = None
+    add_time: str = Field(..., examples=["2021-09-22 13:18:13"])
+    status: str
+    level: Optional[Level] = None
+    coords: Optional[CoordsOut] = None
+    user: Optional[User] = None
+    images: Optional[List[ImageRef]] = None
+
+
+class PerevalList(BaseModel):
+    status: int
+    perevals: List[PerevalDocument]
+    missing: List[int]
+
+
+class PerevalNearby(BaseModel):
+    id: int
+    beauty_title: str
+    title: str
+    status: str
+    coords: CoordsOut
+    distance_km: float
+
+
+class PerevalSearchHit(BaseModel):
+    id: int
+    beauty_title: str
+    title: str
+    other_titles: Optional[str] = None
+    status: str
+    score: float
+
+def _respond_async(request: Request) -> bool:
+    return INGEST_MODE == 'async' or 'respond-async' in request.headers.get("prefer", "")
+
+
+def _accepted(job_id: int, headers: dict = None) -> JSONResponse:
+    return JSONResponse(
+        status_code=202,
+        content={"status": 202, "message": "Принято в обработку", "id": None, "job_id": job_id},
+        headers={"Location": f"/jobs/{job_id}", **(headers or {})}
+    )
+
+
+async def _enqueue(data: dict, idempotency: database.IdempotencyKey = None) -> JSONResponse:
+    """Ставит перевал в очередь загрузки и отвечает 202 со ссылкой на задание"""
+    db = database.AsyncDatabase()
+    job_id = await db.enqueue_submission(data, idempotency)
+    ingest.wake_workers()
+    return _accepted(job_id)
+
+
+def _replayed(replay: database.IdempotentReplay) -> JSONResponse:
+    """Ответ первой попытки запроса с тем же Idempotency-Key"""
+    headers = {"Idempotent-Replayed": "true"}
+    if replay.job_id is not None:
+        return _accepted(replay.job_id, headers)
+    return FastJSONResponse(
+        content={"status": 200, "message": "Отправлено успешно", "id": replay.pereval_id},
+        headers=headers
+    )
+
+
+def _fingerprint(pereval: PerevalInput) -> bytes:
+    """sha256 тела для Idempotency-Key.
+
+    Только присланные поля: add_time по умолчанию у каждой попытки своё.
+    """
+    return hashlib.sha256(serialization.dumps(pereval.dict(exclude_unset=True), sort_keys=True)).digest()
+
+
+@app.post("/submitData", summary="Submit new pereval data", dependencies=[Depends(admission.write)])
+async def submit_data(pereval: PerevalInput, request: Request):
+    """С заголовком Prefer: respond-async (или FSTR_INGEST_MODE=async) запись ставится в очередь.
+
+    Повтор запроса с тем же заголовком Idempotency-Key возвращает ответ первой
+    попытки, не добавляя перевал заново; параллельный повтор ждёт её завершения.
+    """
+    idempotency = None
+    key = request.headers.get("idempotency-key")
+    if key is not None:
+        if not 0 < len(key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+            return JSONResponse(
+                status_code=400,
+                content={"status": 400, "message": "Некорректный Idempotency-Key", "id": None}
+            )
+        # Тело с base64-изображениями может весить мегабайты — хешируем не в event loop
+        idempotency = database.IdempotencyKey(key, await run_in_threadpool(_fingerprint, pereval))
+    try:
+        if _respond_async(request):
+            return await _enqueue(pereval.dict(), idempotency)
+        db = database.AsyncDatabase()
+        pereval_id = await db.submit_data(pereval.dict(), idempotency)
+        return {
+            "status": 200,
+            "message": "Отправлено успешно",
+            "id": pereval_id
+        }
+    except database.IdempotentReplay as replay:
+        return _replayed(replay)
+    except database.IdempotencyKeyReused as e:
+        return JSONResponse(status_code=422, content={"status": 422, "message": str(e), "id": None})
+    except ValueError as e:
+        return {
+            "status": 400,
+            "message": str(e),
+            "id": None
+        }
+    except Exception as e:
+        logger.error(f"API error: {e}")
+        return {
+            "status": 500,
+            "message": f"Внутренняя ошибка сервера",
+            "id": None
+        }
+
+class RequestTooLarge(ValueError):
+    """Тело запроса больше UPLOAD_MAX_REQUEST_BYTES"""
+
+    def __init__(self, limit: int):
+        super().__init__(f"Запрос больше {limit} байт")
+
+
+def _limit_body(request: Request, limit: int) -> Request:
+    """Тот же запрос, но чтение тела обрывается RequestTooLarge после limit байт.
+
+    Content-Length может не быть (chunked), а без счётчика лимит сработал бы
+    только после того, как всё тело разобрано и сброшено на диск.
+    """
+    received = 0
+
+    async def receive():
+        nonlocal received
+        message = await request.receive()
+        if message["type"] == "http.request":
+            received += len(message.get("body", b""))
+            if received > limit:
+                raise RequestTooLarge(limit)
+        return message
+
+    return Request(request.scope, receive)
+
+
+def _store_uploads(uploads: List[UploadFile]) -> list:
+    """Потоково переносит загруженные файлы в хранилище с лимитом на одно изображение.
+
+    Лимит на весь запрос уже проверен при чтении тела (_limit_body).
+    """
+    store = storage.get_store()
+    blobs = []
+    for upload in uploads:
+        upload.file.seek(0)
+        blob = store.put_stream(upload.file, max_size=UPLOAD_MAX_IMAGE_BYTES)
+        metrics.IMAGE_BYTES.inc(blob.size, direction="in")
+        blobs.append(blob)
+    return blobs
+
+
+@app.post(
+    "/submitData/upload",
+    summary="Submit new pereval data with multipart images",
+    dependencies=[Depends(admission.write)],
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {"multipart/form-data": {"schema": {
+                "type": "object",
+                "required": ["metadata", "images"],
+                "properties": {
+                    "metadata": {"type": "string", "description": "JSON с полями перевала, без images"},
+                    "images": {"type": "array", "items": {"type": "string", "format": "binary"}},
+                    "titles": {"type": "array", "items": {"type": "string"},
+                               "description": "Подписи к изображениям в том же порядке"},
+                },
+            }}},
+        }
+    },
+)
+async def submit_data_upload(request: Request):
+    """Метаданные — JSON в поле metadata, изображения — файлы в полях images"""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > UPLOAD_MAX_REQUEST_BYTES:
+        return JSONResponse(
+            status_code=413,
+            content={"status": 413, "message": str(RequestTooLarge(UPLOAD_MAX_REQUEST_BYTES)), "id": None}
+        )
     try:
-        db = database.Database()
-        pereval_id = db.submit_data(pereval.dict())
+        async with _limit_body(request, UPLOAD_MAX_REQUEST_BYTES).form(max_files=UPLOAD_MAX_FILES) as form:
+            uploads = [f for f in form.getlist("images") if isinstance(f, UploadFile)]
+            titles = form.getlist("titles")
+            try:
+                meta = PerevalMeta.model_validate_json(form.get("metadata") or "")
+            except ValidationError:
+                meta = None
+            if meta is None or not uploads:
+                return JSONResponse(
+                    status_code=400,
+                    content={"status": 400, "message": "Bad Request: недостаточно данных", "id": None},
+                )
+            try:
+                blobs = await run_in_threadpool(_store_uploads, uploads)
+            except storage.BlobTooLarge as e:
+                return JSONResponse(
+                    status_code=413,
+                    content={"status": 413, "message": str(e), "id": None}
+                )
+
+        data = meta.dict()
+        data['images'] = [
+            {'blob': blob, 'title': titles[n] if n < len(titles) else (upload.filename or "")}
+            for n, (blob, upload) in enumerate(zip(blobs, uploads))
+        ]
+        if _respond_async(request):
+            return await _enqueue(data)
+        db = database.AsyncDatabase()
+        pereval_id = await db.submit_data(data)
         return {
             "status": 200,
             "message": "Отправлено успешно",
             "id": pereval_id
         }
+    except RequestTooLarge as e:
+        return JSONResponse(
+            status_code=413,
+            content={"status": 413, "message": str(e), "id": None}
+        )
+    except StarletteHTTPException as e:
+        # Ошибки разбора multipart (повреждённое тело, слишком много файлов)
+        return JSONResponse(
+            status_code=400,
+            content={"status": 400, "message": f"Bad Request: {e.detail}", "id": None}
+        )
     except ValueError as e:
         return {
             "status": 400,
@@ -81,6 +431,48 @@ async def submit_data(pereval: PerevalInput):
             "id": None
         }
 
+
+@app.post("/submitData/batch", summary="Submit many perevals at once", dependencies=[Depends(admission.write)])
+async def submit_data_batch(items: List[Dict[str, Any]]):
+    """Каждая запись проверяется и сохраняется отдельно; результат — по записи на каждую"""
+    if not items or len(items) > BATCH_MAX_ITEMS:
+        return JSONResponse(
+            status_code=400,
+            content={"status": 400, "message": f"Bad Request: от 1 до {BATCH_MAX_ITEMS} записей", "results": []}
+        )
+
+    results = [None] * len(items)
+    valid = []
+    for n, item in enumerate(items):
+        try:
+            valid.append((n, PerevalInput.model_validate(item).dict()))
+        except ValidationError:
+            results[n] = {"index": n, "status": 400, "message": "Bad Request: недостаточно данных", "id": None}
+
+    try:
+        if valid:
+            db = database.AsyncDatabase()
+            stored = await db.submit_batch([data for _, data in valid], BATCH_CHUNK_SIZE)
+            for (n, _), result in zip(valid, stored):
+                if 'id' in result:
+                    results[n] = {"index": n, "status": 200, "message": "Отправлено успешно", "id": result['id']}
+                else:
+                    results[n] = {"index": n, "status": result['status'], "message": result['error'], "id": None}
+    except Exception as e:
+        logger.error(f"API error: {e}")
+        return JSONResponse(
+            status_code=500,
+            content={"status": 500, "message": "Внутренняя ошибка сервера", "results": []}
+        )
+
+    accepted = sum(1 for r in results if r["status"] == 200)
+    return {
+        "status": 200,
+        "message": f"Сохранено {accepted} из {len(items)}",
+        "results": results
+    }
+
+
 @app.get("/")
 async def read_root():
     return {"message": "FSTR Pereval API is running"}
@@ -93,17 +485,78 @@ async def validation_exception_handler(request, exc):
     )
 
 
-@app.get("/submitData/{pereval_id}", summary="Get pereval by ID")
-async def get_pereval(pereval_id: int):
+@app.exception_handler(admission.Overloaded)
+async def overloaded_exception_handler(request, exc):
+    return JSONResponse(
+        status_code=503,
+        content={"status": 503, "message": "Сервер перегружен, повторите запрос позже"},
+        headers={"Retry-After": str(admission.RETRY_AFTER)}
+    )
+
+
+def _etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def _etag_response(body: bytes, request: Request) -> Response:
+    """JSON-ответ с ETag; при совпадении If-None-Match — 304 без тела"""
+    headers = {"ETag": _etag(body), "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and headers["ETag"] in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+async def _cache_call(backend: cache.CacheBackend, method: str, *args, **kwargs):
+    """Вызов кеша; сетевые бэкенды (blocking) — в пуле потоков, а не в event loop"""
+    func = getattr(backend, method)
+    if backend.blocking:
+        return await run_in_threadpool(func, *args, **kwargs)
+    return func(*args, **kwargs)
+
+
+async def _invalidate_pereval(pereval_id: int):
+    try:
+        await _cache_call(cache.get_cache(), "delete", cache.pereval_key(pereval_id))
+    except Exception as e:
+        logger.error(f"Cache error: {e}")
+
+
+@app.get("/submitData/{pereval_id}", summary="Get pereval by ID", dependencies=[Depends(admission.read)])
+async def get_pereval(pereval_id: int, request: Request, include_data: bool = False):
+    """Изображения возвращаются ссылками на /images/{id}; include_data=true добавляет base64.
+
+    Документ без include_data кешируется; ETag позволяет клиенту получить 304.
+    """
+    pereval_cache = cache.get_cache()
+    key = cache.pereval_key(pereval_id)
+    token = None
+    if not include_data:
+        try:
+            body = await _cache_call(pereval_cache, "get", key)
+            if body is not None:
+                return _etag_response(body, request)
+            token = await _cache_call(pereval_cache, "token", key)
+        except Exception as e:
+            logger.error(f"Cache error: {e}")
     try:
-        db = database.Database()
-        pereval = db.get_pereval_by_id(pereval_id)
+        db = database.AsyncDatabase()
+        # Документ с отставшей реплики пролежал бы в общем кеше весь TTL,
+        # поэтому то, что будет закешировано, читаем с реплики, догнавшей основной сервер
+        cacheable = not include_data and pereval_cache.enabled
+        pereval = await db.get_pereval_by_id(pereval_id, include_data, current=cacheable)
         if not pereval:
             return JSONResponse(
                 status_code=404,
                 content={"status": 404, "message": "Запись не найдена", "id": pereval_id}
             )
-        return pereval
+        body = serialization.dumps(pereval)
+        if not include_data:
+            try:
+                await _cache_call(pereval_cache, "set", key, body, token=token)
+            except Exception as e:
+                logger.error(f"Cache error: {e}")
+        return _etag_response(body, request)
     except Exception as e:
         logger.error(f"API error: {e}")
         return JSONResponse(
@@ -112,7 +565,378 @@ async def get_pereval(pereval_id: int):
         )
 
 
-@app.patch("/submitData/{pereval_id}", summary="Update pereval data")
+async def _get_perevals(ids: List[int], fields: Optional[List[str]]):
+    unique = list(dict.fromkeys(ids))
+    if len(unique) > MULTIGET_MAX_IDS:
+        return JSONResponse(
+            status_code=400,
+            content={"status": 400, "message": f"Bad Request: не больше {MULTIGET_MAX_IDS} ID за запрос"}
+        )
+    try:
+        db = database.AsyncDatabase()
+        documents = await db.get_perevals_by_ids(unique, set(fields) if fields is not None else None)
+        return FastJSONResponse({
+            "status": 200,
+            "perevals": [documents[pereval_id] for pereval_id in unique if pereval_id in documents],
+            "missing": [pereval_id for pereval_id in unique if pereval_id not in documents]
+        })
+    except Exception as e:
+        logger.error(f"API error: {e}")
+        return JSONResponse(
+            status_code=500,
+            content={"status": 500, "message": "Внутренняя ошибка сервера"}
+        )
+
+
+@app.get(
+    "/perevals", summary="Get many perevals by ID", response_model=PerevalList,
+    dependencies=[Depends(admission.read)]
+)
+async def get_perevals(
+    ids: str = Query(..., description="ID через запятую"),
+    fields: Optional[str] = Query(None, description="блоки через запятую: user, level, coords, images"),
+):
+    """Документы перевалов в порядке ids одним запросом к БД; ненайденные ID — в missing"""
+    try:
+        id_list = [int(part) for part in ids.split(",") if part.strip()]
+    except ValueError:
+        id_list = None
+    field_list = None
+    if fields is not None:
+        field_list = [part.strip() for part in fields.split(",") if part.strip()]
+    if id_list is None or (field_list is not None and not set(field_list) <= set(get_args(PerevalBlock))):
+        return JSONResponse(
+            status_code=400,
+            content={"status": 400, "message": "Bad Request: некорректные ids или fields"}
+        )
+    if not id_list:
+        return JSONResponse(
+            status_code=400,
+            content={"status": 400, "message": "Bad Request: недостаточно данных"}
+        )
+    return await _get_perevals(id_list, field_list)
+
+
+@app.post(
+    "/perevals", summary="Get many perevals by ID (long lists)", response_model=PerevalList,
+    dependencies=[Depends(admission.read)]
+)
+async def post_perevals(request: PerevalIds):
+    """То же, что GET /perevals, для длинных списков ID"""
+    return await _get_perevals(request.ids, request.fields)
+
+
+@app.get(
+    "/perevals/nearby", summary="Perevals near a point", response_model=List[PerevalNearby],
+    dependencies=[Depends(admission.read)]
+)
+async def get_perevals_nearby(
+    lat: float = Query(..., ge=-90, le=90),
+    lon: float = Query(..., ge=-180, le=180),
+    radius_km: float = Query(..., gt=0, le=20000),
+    limit: int = Query(50, ge=1, le=500),
+    offset: int = Query(0, ge=0),
+):
+    """Перевалы в радиусе radius_km, отсортированные по расстоянию (distance_km)"""
+    try:
+        db = database.AsyncDatabase()
+        return FastJSONResponse(await db.get_perevals_nearby(lat, lon, radius_km, limit, offset))
+    except Exception as e:
+        logger.error(f"API error: {e}")
+        return JSONResponse(
+            status_code=500,
+            content={"status": 500, "message": "Внутренняя ошибка сервера"}
+        )
+
+
+@app.get(
+    "/perevals/bbox", summary="Perevals inside a bounding box", response_model=List[PerevalNearby],
+    dependencies=[Depends(admission.read)]
+)
+async def get_perevals_in_bbox(
+    min_lat: float = Query(..., ge=-90, le=90),
+    min_lon: float = Query(..., ge=-180, le=180),
+    max_lat: float = Query(..., ge=-90, le=90),
+    max_lon: float = Query(..., ge=-180, le=180),
+    limit: int = Query(50, ge=1, le=500),
+    offset: int = Query(0, ge=0),
+):
+    """Перевалы в прямоугольнике по расстоянию от его центра; min_lon > max_lon — через 180°"""
+    if min_lat > max_lat:
+        return JSONResponse(status_code=400, content={"status": 400, "message": "min_lat больше max_lat"})
+    try:
+        db = database.AsyncDatabase()
+        return FastJSONResponse(await db.get_perevals_in_bbox(min_lat, min_lon, max_lat, max_lon, limit, offset))
+    except Exception as e:
+        logger.error(f"API error: {e}")
+        return JSONResponse(
+            status_code=500,
+            content={"status": 500, "message": "Внутренняя ошибка сервера"}
+        )
+
+
+@app.get(
+    "/perevals/search", summary="Fuzzy search perevals by title", response_model=List[PerevalSearchHit],
+    dependencies=[Depends(admission.read)]
+)
+async def search_perevals(
+    q: str = Query(..., min_length=2, max_length=255),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+):
+    """Поиск по названиям без учёта регистра и с допуском опечаток; score — степень совпадения"""
+    try:
+        db = database.AsyncDatabase()
+        return FastJSONResponse(await db.search_perevals(q, limit, offset, SEARCH_THRESHOLD))
+    except Exception as e:
+        logger.error(f"API error: {e}")
+        return JSONResponse(
+            status_code=500,
+            content={"status": 500, "message": "Внутренняя ошибка сервера"}
+        )
+
+
+@app.post("/moderation/claim", summary="Claim new perevals for moderation", dependencies=[Depends(admission.write)])
+async def claim_perevals(claim: ModerationClaim):
+    """Переводит до limit самых старых записей из 'new' в 'pending' за этим модератором.
+
+    Параллельные запросы разных модераторов никогда не получают одну и ту же запись.
+    """
+    try:
+        db = database.AsyncDatabase()
+        perevals = await db.claim_perevals(claim.moderator, claim.limit)
+        for pereval in perevals:
+            await _invalidate_pereval(pereval["id"])
+        return perevals
+    except Exception as e:
+        logger.error(f"API error: {e}")
+        return JSONResponse(
+            status_code=500,
+            content={"status": 500, "message": "Внутренняя ошибка сервера"}
+        )
+
+
+async def _moderate(decision: ModerationDecision, status: str):
+    try:
+        db = database.AsyncDatabase()
+        updated = await db.moderate_perevals(decision.moderator, decision.ids, status)
+        for pereval_id in updated:
+            await _invalidate_pereval(pereval_id)
+        return {
+            "status": 200,
+            "message": f"Обновлено {len(updated)} из {len(decision.ids)}",
+            "updated": updated
+        }
+    except Exception as e:
+        logger.error(f"API error: {e}")
+        return JSONResponse(
+            status_code=500,
+            content={"status": 500, "message": "Внутренняя ошибка сервера", "updated": []}
+        )
+
+
+@app.post("/moderation/accept", summary="Accept claimed perevals", dependencies=[Depends(admission.write)])
+async def accept_perevals(decision: ModerationDecision):
+    """Принимает записи, выданные этому модератору; остальные ID пропускаются"""
+    return await _moderate(decision, "accepted")
+
+
+@app.post("/moderation/reject", summary="Reject claimed perevals", dependencies=[Depends(admission.write)])
+async def reject_perevals(decision: ModerationDecision):
+    """Отклоняет записи, выданные этому модератору; остальные ID пропускаются"""
+    return await _moderate(decision, "rejected")
+
+
+@app.get("/jobs/{job_id}", summary="Get async submission status", dependencies=[Depends(admission.read)])
+async def get_job(job_id: int):
+    """queued — ждёт воркера, done — перевал сохранён (pereval_id), failed — см. error"""
+    try:
+        db = database.AsyncDatabase()
+        job = await db.get_job(job_id)
+        if not job:
+            return JSONResponse(
+                status_code=404,
+                content={"status": 404, "message": "Задание не найдено", "id": job_id}
+            )
+        return job
+    except Exception as e:
+        logger.error(f"API error: {e}")
+        return JSONResponse(
+            status_code=500,
+            content={"status": 500, "message": "Внутренняя ошибка сервера", "id": job_id}
+        )
+
+
+@app.get("/metrics", summary="Prometheus metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/cache/stats", summary="Pereval cache hit/miss counters")
+async def cache_stats():
+    return cache.get_cache().stats()
+
+
+def _parse_range(header: str, size: int):
+    """Разбирает Range с одним диапазоном байт.
+
+    Возвращает (start, end) включительно или None, если заголовок нужно
+    проигнорировать и отдать файл целиком; ValueError — диапазон невыполним.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    match = re.fullmatch(r'(\d*)-(\d*)', spec.strip())
+    if not match or match.group(0) == '-':
+        return None
+    start = int(match.group(1)) if match.group(1) else None
+    end = int(match.group(2)) if match.group(2) else None
+    if start is not None and end is not None and end < start:
+        # Синтаксически неверный диапазон (RFC 9110): заголовок игнорируется
+        return None
+    if start is None:
+        # bytes=-N — последние N байт
+        if end == 0 or size == 0:
+            raise ValueError("Range Not Satisfiable")
+        return max(size - end, 0), size - 1
+    if end is None:
+        end = size - 1
+    if start >= size:
+        raise ValueError("Range Not Satisfiable")
+    return start, min(end, size - 1)
+
+
+@app.get("/images/{image_id}", summary="Get image bytes", dependencies=[Depends(admission.read)])
+async def get_image(image_id: int, request: Request):
+    try:
+        db = database.AsyncDatabase()
+        image = await db.get_image(image_id)
+        store = storage.get_store()
+        if image and image['img'] is None and not store.exists(image['sha256']):
+            logger.error(f"Image {image_id} is missing from storage")
+            image = None
+    except Exception as e:
+        logger.error(f"API error: {e}")
+        return JSONResponse(
+            status_code=500,
+            content={"status": 500, "message": "Внутренняя ошибка сервера", "id": image_id}
+        )
+    if not image:
+        return JSONResponse(
+            status_code=404,
+            content={"status": 404, "message": "Изображение не найдено", "id": image_id}
+        )
+
+    # Содержимое по id не меняется, поэтому хеш годится в качестве сильного ETag
+    etag = f'"{image["sha256"]}"'
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "public, max-age=31536000, immutable",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+
+    size = image['size']
+    start, end = 0, size - 1
+    status_code = 200
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range.strip() == etag):
+        try:
+            byte_range = _parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        if byte_range:
+            start, end = byte_range
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    metrics.IMAGE_BYTES.inc(end - start + 1, direction="out")
+
+    if image['img'] is not None:
+        body = iter([image['img'][start:end + 1]])
+    else:
+        body = store.iter_bytes(image['sha256'], start, end)
+    return StreamingResponse(
+        body,
+        status_code=status_code,
+        media_type=image['content_type'] or "application/octet-stream",
+        headers=headers
+    )
+
+
+@app.get("/images/{image_id}/thumbnail", summary="Get a resized image", dependencies=[Depends(admission.read)])
+async def get_thumbnail(
+    image_id: int,
+    request: Request,
+    size: int = Query(thumbnails.SIZES[0]),
+    format: Literal['jpeg', 'webp', 'png'] = 'jpeg',
+):
+    """Уменьшенная копия изображения (size — длинная сторона, из FSTR_THUMBNAIL_SIZES).
+
+    Первый запрос строит миниатюру в пуле процессов, следующие берут её из кеша на диске.
+    """
+    if size not in thumbnails.SIZES:
+        return JSONResponse(
+            status_code=400,
+            content={"status": 400, "message": f"Bad Request: size — один из {list(thumbnails.SIZES)}", "id": image_id}
+        )
+    try:
+        db = database.AsyncDatabase()
+        image = await db.get_image(image_id)
+    except Exception as e:
+        logger.error(f"API error: {e}")
+        return JSONResponse(
+            status_code=500,
+            content={"status": 500, "message": "Внутренняя ошибка сервера", "id": image_id}
+        )
+    if not image:
+        return JSONResponse(
+            status_code=404,
+            content={"status": 404, "message": "Изображение не найдено", "id": image_id}
+        )
+
+    etag = f'"{image["sha256"]}-{size}.{format}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+
+    async def load() -> bytes:
+        if image['img'] is not None:
+            return image['img']
+        return await run_in_threadpool(storage.get_store().read, image['sha256'])
+
+    try:
+        data = await thumbnails.get_thumbnail(image['sha256'], size, format, load)
+    except thumbnails.ThumbnailsUnavailable as e:
+        return JSONResponse(status_code=501, content={"status": 501, "message": str(e), "id": image_id})
+    except FileNotFoundError:
+        logger.error(f"Image {image_id} is missing from storage")
+        return JSONResponse(
+            status_code=404,
+            content={"status": 404, "message": "Изображение не найдено", "id": image_id}
+        )
+    except OSError as e:
+        # Pillow не смог разобрать файл
+        logger.error(f"Thumbnail error for image {image_id}: {e}")
+        return JSONResponse(
+            status_code=415,
+            content={"status": 415, "message": "Не удалось построить миниатюру", "id": image_id}
+        )
+    except Exception as e:
+        logger.error(f"API error: {e}")
+        return JSONResponse(
+            status_code=500,
+            content={"status": 500, "message": "Внутренняя ошибка сервера", "id": image_id}
+        )
+    metrics.IMAGE_BYTES.inc(len(data), direction="out")
+    return Response(content=data, media_type=thumbnails.FORMATS[format], headers=headers)
+
+
+@app.patch("/submitData/{pereval_id}", summary="Update pereval data", dependencies=[Depends(admission.write)])
 async def update_pereval(pereval_id: int, update_data: PerevalUpdate):
     try:
         # Преобразуем данные для обновления
@@ -125,8 +949,11 @@ async def update_pereval(pereval_id: int, update_data: PerevalUpdate):
                 content={"status": 0, "message": "Нет данных для обновления", "id": pereval_id}
             )
 
-        db = database.Database()
-        success = db.update_pereval(pereval_id, update_dict)
+        db = database.AsyncDatabase()
+        try:
+            success = await db.update_pereval(pereval_id, update_dict)
+        finally:
+            await _invalidate_pereval(pereval_id)
 
         if success:
             return {"status": 1, "message": "Запись успешно обновлена", "id": pereval_id}
@@ -140,15 +967,235 @@ async def update_pereval(pereval_id: int, update_data: PerevalUpdate):
         return {"status": 0, "message": "Внутренняя ошибка сервера", "id": pereval_id}
 
 
-@app.get("/submitDataByEmail", summary="Get perevals by user email")
-async def get_pereval_by_email(user_email: str):
+def _encode_cursor(key: tuple) -> str:
+    add_time, pereval_id = key
+    raw = f"{add_time.isoformat()}|{pereval_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> tuple:
+    """Разбирает курсор из _encode_cursor; ValueError, если он повреждён"""
     try:
-        db = database.Database()
-        perevals = db.get_pereval_by_email(user_email)
-        return perevals
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        add_time, _, pereval_id = raw.partition("|")
+        return datetime.fromisoformat(add_time), int(pereval_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError("Некорректный курсор") from e
+
+
+@app.get(
+    "/submitDataByEmail", summary="Get perevals by user email", response_model=List[PerevalSummary],
+    dependencies=[Depends(admission.read)]
+)
+async def get_pereval_by_email(
+    user_email: str,
+    limit: int = Query(100, ge=1, le=1000),
+    after: Optional[str] = None,
+    status: Optional[Literal['new', 'pending', 'accepted', 'rejected']] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+):
+    """Постраничный список; курсор следующей страницы — в заголовке X-Next-Cursor"""
+    try:
+        after_key = _decode_cursor(after) if after else None
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"status": 400, "message": str(e)})
+    try:
+        db = database.AsyncDatabase()
+        perevals, next_key = await db.get_pereval_by_email(
+            user_email, limit, after_key, status, date_from, date_to
+        )
+        headers = {"X-Next-Cursor": _encode_cursor(next_key)} if next_key else None
+        return FastJSONResponse(content=perevals, headers=headers)
     except Exception as e:
         logger.error(f"API error: {e}")
         return JSONResponse(
             status_code=500,
             content={"status": 500, "message": "Внутренняя ошибка сервера"}
-        )
\ No newline at end of file
+        )
+
+
+
+# Колонки CSV-выгрузки в порядке вывода (images — JSON-строкой, только с include_images)
+EXPORT_COLUMNS = [
+    "id", "beauty_title", "title", "other_titles", "connect", "add_time", "updated_at", "status",
+    "level_winter", "level_summer", "level_autumn", "level_spring",
+    "latitude", "longitude", "height",
+    "user_email", "user_fam", "user_name", "user_otc", "user_phone",
+]
+
+
+class _ClosingStreamingResponse(StreamingResponse):
+    """StreamingResponse, вызывающий on_close при любом завершении, в том числе когда клиент ушёл.
+
+    BackgroundTask после обрыва соединения не запускается.
+    """
+
+    def __init__(self, *args, on_close, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.on_close()
+
+
+def _locked_chunks(chunks, lock: threading.Lock):
+    """Порции выгрузки; next() под lock, чтобы _close_export не закрыл генератор посреди чтения"""
+    while True:
+        with lock:
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+def _close_export(chunks, lock: threading.Lock):
+    # Закрытый генератор закрывает серверный курсор и возвращает соединение в пул
+    with lock:
+        chunks.close()
+
+
+def _ndjson_chunks(chunks):
+    for chunk in chunks:
+        yield b"".join(serialization.dumps(row) + b"\n" for row in chunk)
+
+
+def _csv_chunks(chunks, include_images: bool):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS + (["images"] if include_images else []))
+    writer.writeheader()
+    for chunk in chunks:
+        for row in chunk:
+            if include_images:
+                row["images"] = serialization.dumps(row["images"]).decode("utf-8")
+            writer.writerow(row)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        # Только заголовок: выборка пуста
+        yield buffer.getvalue().encode("utf-8")
+
+
+@app.get("/export", summary="Stream the whole catalogue as NDJSON or CSV")
+async def export_perevals(
+    format: Literal['ndjson', 'csv'] = 'ndjson',
+    status: Optional[Literal['new', 'pending', 'accepted', 'rejected']] = None,
+    updated_since: Optional[datetime] = None,
+    include_images: bool = False,
+):
+    """Все перевалы с пользователем и координатами, по строке на перевал, в порядке id.
+
+    Ответ отдаётся по мере чтения из БД порциями по FSTR_EXPORT_CHUNK_SIZE строк,
+    так что память сервера не зависит от размера каталога.
+    """
+    await admission.EXPORTS.acquire()
+    chunks = database.Database().export_perevals(status, updated_since, include_images, EXPORT_CHUNK_SIZE)
+    lock = threading.Lock()
+
+    async def close():
+        try:
+            await run_in_threadpool(_close_export, chunks, lock)
+        finally:
+            admission.EXPORTS.release()
+
+    try:
+        # Первую порцию читаем до ответа: ошибки запроса ещё можно вернуть как 500
+        first = await run_in_threadpool(next, chunks, None)
+    except Exception as e:
+        logger.error(f"API error: {e}")
+        await close()
+        return JSONResponse(
+            status_code=500,
+            content={"status": 500, "message": "Внутренняя ошибка сервера"}
+        )
+    rows = itertools.chain([first] if first else [], _locked_chunks(chunks, lock))
+    if format == 'csv':
+        body, media_type = _csv_chunks(rows, include_images), "text/csv; charset=utf-8"
+    else:
+        body, media_type = _ndjson_chunks(rows), "application/x-ndjson"
+    return _ClosingStreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="perevals.{format}"'},
+        on_close=close
+    )
+
+
+class PerevalChange(BaseModel):
+    seq: int
+    pereval_id: int
+    op: Literal['insert', 'update']
+    status: str
+    changed_at: str = Field(..., examples=["2021-09-22 13:18:13"])
+
+
+def _resync_response(e: changes.ResyncRequired) -> JSONResponse:
+    return JSONResponse(status_code=410, content={"status": 410, "message": str(e)})
+
+
+@app.get(
+    "/changes", summary="Pereval changes after a sequence number", response_model=List[PerevalChange],
+    dependencies=[Depends(admission.read)]
+)
+async def get_changes(
+    after: int = Query(..., ge=0, description="seq последнего полученного изменения"),
+    limit: int = Query(100, ge=1),
+):
+    """Изменения с seq больше after по возрастанию; для догоняющего чтения без SSE"""
+    try:
+        db = database.AsyncDatabase()
+        await changes.check_position(db, after)
+        return FastJSONResponse(await db.get_changes(after, min(limit, CHANGES_MAX_LIMIT)))
+    except changes.ResyncRequired as e:
+        return _resync_response(e)
+    except Exception as e:
+        logger.error(f"API error: {e}")
+        return JSONResponse(
+            status_code=500,
+            content={"status": 500, "message": "Внутренняя ошибка сервера"}
+        )
+
+
+async def _sse_events(events):
+    # Клиент переподключается через 3 с и сам присылает Last-Event-ID
+    yield b"retry: 3000\n\n"
+    async for event in events:
+        if event is None:
+            yield b": ping\n\n"
+        else:
+            yield b"id: %d\nevent: change\ndata: %s\n\n" % (event["seq"], serialization.dumps(event))
+
+
+@app.get("/changes/stream", summary="Live feed of pereval changes (Server-Sent Events)")
+async def stream_changes(request: Request, after: Optional[int] = Query(None, ge=0)):
+    """Новые и изменённые перевалы по мере фиксации, событиями SSE с id = seq.
+
+    Продолжение после обрыва — с after или заголовка Last-Event-ID; без них
+    только новые изменения. 410 — позиция устарела, нужна полная синхронизация.
+    """
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id is not None:
+        try:
+            after = int(last_event_id)
+        except ValueError:
+            return JSONResponse(status_code=400, content={"status": 400, "message": "Некорректный Last-Event-ID"})
+    try:
+        if after is not None:
+            await changes.check_position(database.AsyncDatabase(), after)
+    except changes.ResyncRequired as e:
+        return _resync_response(e)
+    except Exception as e:
+        logger.error(f"API error: {e}")
+        return JSONResponse(
+            status_code=500,
+            content={"status": 500, "message": "Внутренняя ошибка сервера"}
+        )
+    return StreamingResponse(
+        _sse_events(changes.follow(after)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
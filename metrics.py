@@ -0,0 +1,203 @@
+import bisect
+import threading
+import time
+from typing import Callable
+
+# Границы корзин гистограмм: секунды для задержек, байты для размеров
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry = []
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    """Метрика в текстовом формате Prometheus; значения — по наборам меток"""
+
+    kind = None
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Значение снимается при каждом чтении /metrics функцией collect.
+
+    collect возвращает число (метрика без меток) или словарь
+    {кортеж значений меток: число}.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), collect: Callable = None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def render(self) -> list:
+        if self.collect is not None:
+            values = self.collect()
+            with self._lock:
+                self._values = dict(values) if isinstance(values, dict) else {(): values}
+        return super().render()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [счётчики по корзинам + корзина +Inf, сумма]
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    """Все метрики процесса в текстовом формате Prometheus"""
+    lines = []
+    for metric in _registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Время обработки HTTP-запроса", ("method", "route", "status")
+)
+HTTP_REQUEST_BYTES = Histogram(
+    "http_request_body_bytes", "Размер тела HTTP-запроса", ("method", "route"), SIZE_BUCKETS
+)
+HTTP_RESPONSE_BYTES = Histogram(
+    "http_response_body_bytes", "Размер тела HTTP-ответа", ("method", "route", "status"), SIZE_BUCKETS
+)
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "Время выполнения SQL-запроса", ("query",)
+)
+DB_POOL_WAIT = Histogram(
+    "db_pool_wait_seconds", "Ожидание свободного соединения в пуле"
+)
+DB_QUERY_ERRORS = Counter(
+    "db_query_errors_total", "SQL-запросы, завершившиеся ошибкой", ("query",)
+)
+IMAGE_BYTES = Counter(
+    "image_bytes_total", "Байты изображений: in — записано в хранилище, out — отдано клиентам", ("direction",)
+)
+DB_READS = Counter(
+    "db_reads_total", "Чтения через Database: replica — с реплики, primary — с основного сервера", ("target",)
+)
+ADMISSION_REJECTED = Counter(
+    "admission_rejected_total", "Запросы, отклонённые с 503: queue_full — очередь полна, timeout — не дождались",
+    ("budget", "reason")
+)
+DB_STATEMENT_PREPARES = Counter(
+    "db_statement_prepares_total", "PREPARE горячих запросов на соединениях пула", ("statement",)
+)
+
+
+class MetricsMiddleware:
+    """ASGI-middleware: задержка и размеры тел запросов по шаблону маршрута и статусу.
+
+    Маршрут берётся из endpoint, который роутер кладёт в scope, так что
+    /submitData/1 и /submitData/2 попадают в одну серию /submitData/{pereval_id}.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._routes = None
+
+    def _route(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if self._routes is None:
+            self._routes = {
+                getattr(route, "endpoint", None): route.path
+                for route in scope["app"].routes if hasattr(route, "path")
+            }
+        return self._routes.get(endpoint, "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        state = {"status": 500, "request_bytes": 0, "response_bytes": 0}
+
+        async def counting_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                state["request_bytes"] += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                state["response_bytes"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            method, route, status = scope["method"], self._route(scope), str(state["status"])
+            HTTP_REQUEST_DURATION.observe(time.perf_counter() - started, method=method, route=route, status=status)
+            HTTP_REQUEST_BYTES.observe(state["request_bytes"], method=method, route=route)
+            HTTP_RESPONSE_BYTES.observe(state["response_bytes"], method=method, route=route, status=status)
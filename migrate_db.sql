@@ -0,0 +1,116 @@
+-- Обновление существующей БД до схемы init_db.sql.
+-- Скрипт можно запускать повторно: уже сделанные шаги пропускаются.
+-- Запускать через psql без -1/--single-transaction: CREATE INDEX CONCURRENTLY
+-- не работает внутри транзакции, зато не блокирует запись в таблицы.
+-- Если построение индекса прервалось, он остаётся INVALID: удалите его
+-- (DROP INDEX CONCURRENTLY ...) и запустите скрипт ещё раз.
+\set ON_ERROR_STOP on
+
+-- Нечёткий поиск по названиям перевалов (триграммы)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- 2. Координаты: поиск по местоположению
+CREATE INDEX CONCURRENTLY IF NOT EXISTS coords_point_idx ON coords USING gist (point(longitude::float8, latitude::float8));
+
+-- 3. Перевалы: модерация, время изменения и текст для поиска.
+-- Значения search_text для существующих строк PostgreSQL вычисляет сам при
+-- добавлении колонки (таблица перезаписывается под блокировкой — запускайте
+-- в тихое время)
+ALTER TABLE pereval_added
+    ADD COLUMN IF NOT EXISTS moderator VARCHAR(255),
+    ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP WITHOUT TIME ZONE,
+    ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    ADD COLUMN IF NOT EXISTS search_text TEXT GENERATED ALWAYS AS (
+        beauty_title || ' ' || title || ' ' || coalesce(other_titles, '')
+    ) STORED;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pereval_added_coord_idx ON pereval_added (coord_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pereval_added_search_idx ON pereval_added USING gin (search_text gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pereval_added_user_time_idx ON pereval_added (user_id, add_time, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pereval_added_user_status_time_idx ON pereval_added (user_id, status, add_time, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pereval_added_updated_idx ON pereval_added (updated_at);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pereval_added_moderation_idx ON pereval_added (add_time, id) WHERE status = 'new';
+
+-- 4. Изображения: содержимое новых записей — в хранилище файлов, в БД только хеш.
+-- Старые записи сохраняют img и отдаются как раньше
+ALTER TABLE pereval_images
+    ALTER COLUMN img DROP NOT NULL,
+    ADD COLUMN IF NOT EXISTS sha256 CHAR(64),
+    ADD COLUMN IF NOT EXISTS size BIGINT,
+    ADD COLUMN IF NOT EXISTS content_type VARCHAR(100);
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'pereval_images_check') THEN
+        -- NOT VALID + VALIDATE: проверка старых строк не блокирует запись
+        ALTER TABLE pereval_images
+            ADD CONSTRAINT pereval_images_check CHECK (img IS NOT NULL OR sha256 IS NOT NULL) NOT VALID;
+        ALTER TABLE pereval_images VALIDATE CONSTRAINT pereval_images_check;
+    END IF;
+END;
+$$;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pereval_images_sha256_idx ON pereval_images (sha256);
+
+-- 5. Связи перевалов и изображений
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pereval_image_links_image_idx ON pereval_image_links (image_id);
+
+-- 6. Очередь асинхронной загрузки
+CREATE TABLE IF NOT EXISTS ingest_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    status VARCHAR(10) NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'done', 'failed')),
+    payload JSONB NOT NULL,
+    pereval_id INTEGER REFERENCES pereval_added(id) ON DELETE SET NULL,
+    error TEXT,
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP WITHOUT TIME ZONE
+);
+
+CREATE INDEX IF NOT EXISTS ingest_jobs_queued_idx ON ingest_jobs (id) WHERE status = 'queued';
+
+-- 7. Лента изменений перевалов. Изменения до обновления в ленту не попадают:
+-- клиенты начинают с полной выгрузки (GET /export)
+CREATE TABLE IF NOT EXISTS pereval_changes (
+    seq BIGSERIAL PRIMARY KEY,
+    pereval_id INTEGER NOT NULL,
+    op VARCHAR(10) NOT NULL CHECK (op IN ('insert', 'update')),
+    status VARCHAR(20) NOT NULL,
+    changed_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT clock_timestamp()
+);
+
+CREATE INDEX IF NOT EXISTS pereval_changes_changed_idx ON pereval_changes (changed_at);
+
+CREATE OR REPLACE FUNCTION pereval_changes_publish() RETURNS trigger AS $$
+BEGIN
+    -- Триггер отложенный и срабатывает при COMMIT, а блокировка держится до его конца:
+    -- номера seq выдаются в порядке фиксации, и подписчик, продолжающий с seq,
+    -- не пропустит транзакцию, которая получила номер раньше, а зафиксировалась позже
+    PERFORM pg_advisory_xact_lock(hashtext('pereval_changes'));
+    INSERT INTO pereval_changes (pereval_id, op, status) VALUES (NEW.id, lower(TG_OP), NEW.status);
+    -- Одинаковые уведомления в транзакции сливаются в одно
+    PERFORM pg_notify('pereval_changes', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS pereval_added_changes ON pereval_added;
+CREATE CONSTRAINT TRIGGER pereval_added_changes
+    AFTER INSERT OR UPDATE ON pereval_added
+    DEFERRABLE INITIALLY DEFERRED
+    FOR EACH ROW EXECUTE FUNCTION pereval_changes_publish();
+
+-- 8. Ключи идемпотентности POST /submitData
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key VARCHAR(255) PRIMARY KEY,
+    request_hash BYTEA NOT NULL,
+    pereval_id INTEGER,
+    job_id BIGINT,
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idempotency_keys_created_idx ON idempotency_keys (created_at);
+
+
+-- Права на новые таблицы и последовательности
+GRANT ALL PRIVILEGES ON ALL TABLES IN SCHEMA public TO pereval_user;
+GRANT ALL PRIVILEGES ON ALL SEQUENCES IN SCHEMA public TO pereval_user;
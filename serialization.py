@@ -0,0 +1,40 @@
+import json
+from decimal import Decimal
+from datetime import date
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # без orjson — тот же JSON через стандартный модуль, только медленнее
+    orjson = None
+
+
+def _default(value):
+    """Типы, которых нет в JSON: Decimal из NUMERIC и даты"""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def dumps(content, sort_keys: bool = False) -> bytes:
+    """Компактный JSON в UTF-8 без экранирования кириллицы; sort_keys — канонический порядок ключей"""
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(
+        content, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys, default=_default
+    ).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON-ответ через orjson.
+
+    Возвращённый из эндпоинта экземпляр FastAPI отдаёт как есть, минуя
+    jsonable_encoder: содержимое должно состоять из dict, list, str, чисел
+    и None — так его и собирают методы Database.
+    """
+
+    def render(self, content) -> bytes:
+        return dumps(content)
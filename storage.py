@@ -0,0 +1,246 @@
+import os
+import hashlib
+import importlib
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from typing import BinaryIO, Iterator, NamedTuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CHUNK_SIZE = 64 * 1024
+
+
+class BlobTooLarge(ValueError):
+    """Объект превысил допустимый размер при потоковой записи"""
+
+
+class StoredBlob(NamedTuple):
+    sha256: str
+    size: int
+    content_type: str
+
+
+# Сигнатуры форматов изображений, которые присылают клиенты
+_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff'),
+)
+
+
+def sniff_content_type(head: bytes) -> str:
+    """Определяет Content-Type изображения по первым байтам"""
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head[4:12] in (b'ftypheic', b'ftypheix', b'ftypmif1'):
+        return 'image/heic'
+    for signature, content_type in _SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    return 'application/octet-stream'
+
+
+class BlobStore(ABC):
+    """Хранилище двоичных объектов, адресуемых по sha256 содержимого.
+
+    Наследники реализуют put/put_stream/open/delete/exists; iter_bytes по
+    умолчанию читает объект через open(). Хранилище с listable = True ещё
+    перечисляет объекты (iter_blobs, delete_if_older) — тогда уборщик удаляет
+    и файлы-сироты, иначе только строки без перевалов.
+    """
+    listable = False
+
+    @abstractmethod
+    def put(self, data: bytes) -> StoredBlob:
+        ...
+
+    @abstractmethod
+    def put_stream(self, stream: BinaryIO, max_size: int = None,
+                   chunk_size: int = CHUNK_SIZE) -> StoredBlob:
+        """Записывает объект из файлового потока кусками, не держа его целиком в памяти"""
+
+    @abstractmethod
+    def open(self, sha256: str) -> BinaryIO:
+        ...
+
+    @abstractmethod
+    def delete(self, sha256: str):
+        ...
+
+    @abstractmethod
+    def exists(self, sha256: str) -> bool:
+        ...
+
+    def iter_blobs(self, older_than: float) -> Iterator[str]:
+        """sha256 объектов, не записывавшихся и не обновлявшихся с момента older_than (time.time()).
+
+        Только при listable; по умолчанию объектов не видно.
+        """
+        return iter(())
+
+    def delete_if_older(self, sha256: str, older_than: float) -> bool:
+        """Удаляет объект, только если его по-прежнему не обновляли с older_than; True — удалён.
+
+        Повторная загрузка того же содержимого обновляет время объекта, так что
+        файл, на который только что сослалась новая строка, не удаляется.
+        Только при listable; по умолчанию ничего не удаляет.
+        """
+        return False
+
+    def iter_bytes(self, sha256: str, start: int = 0, end: int = None,
+                   chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        """Отдаёт байты [start, end] объекта кусками по chunk_size"""
+        with self.open(sha256) as f:
+            f.seek(start)
+            remaining = None if end is None else end - start + 1
+            while remaining is None or remaining > 0:
+                chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def read(self, sha256: str) -> bytes:
+        with self.open(sha256) as f:
+            return f.read()
+
+
+class LocalBlobStore(BlobStore):
+    """Файлы в каталоге root, разложенные по первым байтам хеша: ab/cd/abcd..."""
+    listable = True
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, sha256: str) -> str:
+        if len(sha256) != 64 or not all(c in '0123456789abcdef' for c in sha256):
+            raise ValueError("Некорректный хеш изображения")
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def _touch(self, path: str) -> bool:
+        """Обновляет mtime уже записанного файла, чтобы уборщик сирот не удалил его
+        между повторной загрузкой и записью ссылки в БД"""
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def put(self, data: bytes) -> StoredBlob:
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self._path(sha256)
+        if not self._touch(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Пишем во временный файл и переименовываем, чтобы читатели не видели частичных данных
+            fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.upload-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        return StoredBlob(sha256, len(data), sniff_content_type(data[:16]))
+
+    def put_stream(self, stream: BinaryIO, max_size: int = None,
+                   chunk_size: int = CHUNK_SIZE) -> StoredBlob:
+        hasher = hashlib.sha256()
+        size = 0
+        head = b''
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if max_size is not None and size > max_size:
+                        raise BlobTooLarge(f"Изображение больше {max_size} байт")
+                    if len(head) < 16:
+                        head += chunk[:16 - len(head)]
+                    hasher.update(chunk)
+                    f.write(chunk)
+            sha256 = hasher.hexdigest()
+            path = self._path(sha256)
+            if self._touch(path):
+                os.unlink(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return StoredBlob(sha256, size, sniff_content_type(head))
+
+    def open(self, sha256: str) -> BinaryIO:
+        return open(self._path(sha256), 'rb')
+
+    def delete(self, sha256: str):
+        try:
+            os.unlink(self._path(sha256))
+        except FileNotFoundError:
+            pass
+
+    def exists(self, sha256: str) -> bool:
+        return os.path.exists(self._path(sha256))
+
+    def delete_if_older(self, sha256: str, older_than: float) -> bool:
+        path = self._path(sha256)
+        # Сначала убираем файл с его пути, потом смотрим на время: _touch,
+        # успевший до переименования, виден в mtime, а после — не найдёт файл
+        # и запишет его заново
+        doomed = os.path.join(os.path.dirname(path), f'.delete-{sha256}-{os.getpid()}-{threading.get_ident()}')
+        try:
+            os.rename(path, doomed)
+        except FileNotFoundError:
+            return False
+        if os.stat(doomed).st_mtime < older_than:
+            os.unlink(doomed)
+            return True
+        os.replace(doomed, path)
+        return False
+
+    def iter_blobs(self, older_than: float) -> Iterator[str]:
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                # Временные файлы незавершённых загрузок (.upload-*) не трогаем
+                if len(name) != 64 or name.startswith('.'):
+                    continue
+                try:
+                    if os.stat(os.path.join(dirpath, name)).st_mtime < older_than:
+                        yield name
+                except FileNotFoundError:
+                    pass
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> BlobStore:
+    """Возвращает хранилище изображений процесса.
+
+    FSTR_STORAGE_BACKEND — 'local' (по умолчанию) или путь к своему классу
+    вида 'package.module:ClassName'; конструктор получает FSTR_STORAGE_DIR.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            backend = os.getenv('FSTR_STORAGE_BACKEND', 'local')
+            root = os.getenv('FSTR_STORAGE_DIR', 'media')
+            if backend == 'local':
+                _store = LocalBlobStore(root)
+            else:
+                module_name, _, class_name = backend.partition(':')
+                _store = getattr(importlib.import_module(module_name), class_name)(root)
+        return _store
@@ -0,0 +1,114 @@
+import os
+import logging
+import threading
+import time
+import database
+import storage
+
+logger = logging.getLogger(__name__)
+
+
+def sweep(db: database.Database, store: storage.BlobStore, grace: float, batch_size: int = 1000) -> tuple:
+    """Один проход уборки; возвращает (удалено строк pereval_images, удалено файлов).
+
+    Файлы моложе grace секунд не трогаются: их могли только что записать,
+    а строка со ссылкой на них ещё не закоммичена.
+    """
+    rows = 0
+    while True:
+        deleted = db.delete_orphan_images(batch_size)
+        rows += deleted
+        if deleted < batch_size:
+            break
+
+    files = 0
+    if not store.listable:
+        # Хранилище не умеет перечислять объекты — убираем только строки
+        return rows, files
+    cutoff = time.time() - grace
+    batch = []
+    for sha256 in store.iter_blobs(cutoff):
+        batch.append(sha256)
+        if len(batch) == batch_size:
+            files += _delete_unreferenced(db, store, batch, cutoff)
+            batch = []
+    if batch:
+        files += _delete_unreferenced(db, store, batch, cutoff)
+    return rows, files
+
+
+def _delete_unreferenced(db: database.Database, store: storage.BlobStore, hashes: list, cutoff: float) -> int:
+    # Между проверкой ссылок и удалением тот же файл могли загрузить заново:
+    # такая загрузка обновила его время, и delete_if_older его не тронет
+    return sum(store.delete_if_older(sha256, cutoff) for sha256 in db.unreferenced_blobs(hashes))
+
+
+class OrphanSweeper(threading.Thread):
+    """Фоновый поток, раз в interval секунд убирающий изображения без перевалов.
+
+    Заодно удаляет из ленты изменений записи старше changes_retention секунд (0 — не удалять)
+    и просроченные Idempotency-Key.
+    """
+
+    def __init__(self, db: database.Database, store: storage.BlobStore, interval: float, grace: float,
+                 changes_retention: float = 0):
+        super().__init__(name='sweeper', daemon=True)
+        self.db = db
+        self.store = store
+        self.interval = interval
+        self.grace = grace
+        self.changes_retention = changes_retention
+        self._stopping = threading.Event()
+
+    def run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                rows, files = sweep(self.db, self.store, self.grace)
+                if rows or files:
+                    logger.info(f"Orphan sweep: {rows} image rows, {files} files removed")
+                if self.changes_retention > 0:
+                    purged = self.db.purge_changes(self.changes_retention)
+                    if purged:
+                        logger.info(f"Change feed: {purged} old changes removed")
+                purged = self.db.purge_idempotency_keys()
+                if purged:
+                    logger.info(f"Idempotency keys: {purged} expired keys removed")
+            except Exception as e:
+                logger.error(f"Sweeper error: {e}")
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+
+
+_sweeper = None
+
+
+def start_sweeper():
+    """Запускает уборщик, если FSTR_SWEEP_INTERVAL больше нуля"""
+    global _sweeper
+    interval = float(os.getenv('FSTR_SWEEP_INTERVAL', '3600'))
+    grace = float(os.getenv('FSTR_SWEEP_GRACE', '3600'))
+    retention = float(os.getenv('FSTR_CHANGES_RETENTION', str(7 * 24 * 3600)))
+    if interval > 0:
+        _sweeper = OrphanSweeper(database.Database(), storage.get_store(), interval, grace, retention)
+        _sweeper.start()
+
+
+def stop_sweeper():
+    global _sweeper
+    if _sweeper is not None:
+        _sweeper.stop()
+        _sweeper = None
+
+
+if __name__ == '__main__':
+    # Разовая уборка, например из cron: python sweeper.py
+    logging.basicConfig(level=logging.INFO)
+    database.init_pool()
+    try:
+        rows, files = sweep(database.Database(), storage.get_store(),
+                            float(os.getenv('FSTR_SWEEP_GRACE', '3600')))
+        print(f"Удалено строк изображений: {rows}, файлов: {files}")
+    finally:
+        database.close_pool()
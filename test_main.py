@@ -1,11 +1,24 @@
+import asyncio
+import base64
+import json
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import httpx
 import pytest
 from fastapi.testclient import TestClient
 from main import app
+import admission
+import cache
+import changes
+import database
 import os
 import psycopg2
 from dotenv import load_dotenv
 
 load_dotenv()
+os.environ.setdefault('FSTR_STORAGE_DIR', tempfile.mkdtemp(prefix='pereval-media-'))
 
 
 @pytest.fixture
@@ -24,6 +37,9 @@ def clear_database():
         password=os.getenv('FSTR_DB_PASS')
     )
     with conn.cursor() as cursor:
+        cursor.execute("DELETE FROM ingest_jobs;")
+        cursor.execute("DELETE FROM idempotency_keys;")
+        cursor.execute("DELETE FROM pereval_changes;")
         cursor.execute("DELETE FROM pereval_image_links;")
         cursor.execute("DELETE FROM pereval_images;")
         cursor.execute("DELETE FROM pereval_added;")
@@ -66,6 +82,16 @@ def test_data():
     }
 
 
+def test_ids_beyond_int4_not_found(client, test_data):
+    # PREPARE не должен выводить для id тип integer: такого id просто нет
+    big = 2 ** 31 + 1
+    assert client.get(f"/submitData/{big}").status_code == 404
+    assert client.get(f"/submitData/{big}", params={"include_data": True}).status_code == 404
+    assert client.get(f"/images/{big}").status_code == 404
+    response = client.patch(f"/submitData/{big}", json={"title": "Новое"})
+    assert response.json() == {"status": 0, "message": "Запись не найдена", "id": big}
+
+
 def test_full_flow(client, test_data):
     # 1. Создание перевала
     response = client.post("/submitData", json=test_data)
@@ -81,6 +107,12 @@ def test_full_flow(client, test_data):
     data = response.json()
     assert data["title"] == "Тестовый перевал"
     assert data["user"]["email"] == "test@example.com"
+    assert data["coords"] == {"latitude": 45.0, "longitude": 90.0, "height": 1500}
+    assert data["level"]["summer"] == "1A"
+    assert [img["url"] for img in data["images"]] == [f"/images/{data['images'][0]['id']}"]
+    assert "data" not in data["images"][0]
+    response = client.get(f"/submitData/{pereval_id}", params={"include_data": True})
+    assert [img["data"] for img in response.json()["images"]] == [test_data["images"][0]["data"]]
 
     # 3. Обновление данных
     update = {"title": "Обновленное название"}
@@ -123,4 +155,831 @@ def test_update_restrictions(client, test_data):
     response = client.patch(f"/submitData/{pereval_id}", json=update)
     # Проверяем, что email не изменился
     response = client.get(f"/submitData/{pereval_id}")
-    assert response.json()["user"]["email"] == "test@example.com"
\ No newline at end of file
+    assert response.json()["user"]["email"] == "test@example.com"
+
+def test_update_images_by_hash(client, test_data, monkeypatch):
+    pereval_id = client.post("/submitData", json=test_data).json()["id"]
+    kept = client.get(f"/submitData/{pereval_id}").json()["images"][0]
+    gif = base64.b64encode(b"GIF89a" + b"\x00" * 20).decode()
+
+    writes = []
+    store = database.storage.get_store()
+    original_put = store.put
+    monkeypatch.setattr(store, "put", lambda data: writes.append(data) or original_put(data))
+    images = [{"data": test_data["images"][0]["data"], "title": "Новая подпись"}, {"data": gif, "title": "Второе"}]
+    assert client.patch(f"/submitData/{pereval_id}", json={"images": images}).json()["status"] == 1
+    # Неизменившееся изображение не перезаписывается, пишется только новое
+    assert len(writes) == 1
+    updated = client.get(f"/submitData/{pereval_id}").json()["images"]
+    assert [(i["id"], i["title"]) for i in updated[:1]] == [(kept["id"], "Новая подпись")]
+    assert len(updated) == 2
+
+    assert client.patch(f"/submitData/{pereval_id}", json={"images": images[1:]}).json()["status"] == 1
+    assert [i["title"] for i in client.get(f"/submitData/{pereval_id}").json()["images"]] == ["Второе"]
+    assert client.get(f"/images/{kept['id']}").status_code == 404
+
+
+def test_orphan_sweeper(client, test_data):
+    import sweeper
+    pereval_id = client.post("/submitData", json=test_data).json()["id"]
+    referenced = client.get(f"/submitData/{pereval_id}").json()["images"][0]["sha256"]
+    store = database.storage.get_store()
+    orphan = store.put(b"GIF89a orphan")
+    with database.get_pool().connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("INSERT INTO pereval_images (sha256, size, content_type, title) VALUES (%s, 1, 'image/gif', 'x')",
+                           (orphan.sha256,))
+        conn.commit()
+
+    # Свежие файлы защищены grace-периодом, строки-сироты удаляются сразу
+    assert sweeper.sweep(database.Database(), store, grace=3600) == (1, 0)
+    assert store.exists(orphan.sha256)
+    rows, files = sweeper.sweep(database.Database(), store, grace=-1)
+    assert rows == 0 and files >= 1
+    assert not store.exists(orphan.sha256)
+    assert store.exists(referenced)
+
+
+def test_sweeper_keeps_blob_reuploaded_during_sweep(monkeypatch):
+    # Загрузка того же файла между проверкой ссылок и удалением обновляет его время — файл остаётся
+    import sweeper
+    store = database.storage.get_store()
+    blob = store.put(b"GIF89a reuploaded")
+    path = store._path(blob.sha256)
+    os.utime(path, (time.time() - 7200, time.time() - 7200))
+    unreferenced_blobs = database.Database.unreferenced_blobs
+
+    def racing(self, hashes):
+        result = unreferenced_blobs(self, hashes)
+        store.put(b"GIF89a reuploaded")
+        return result
+
+    monkeypatch.setattr(database.Database, "unreferenced_blobs", racing)
+    assert sweeper.sweep(database.Database(), store, grace=3600)[1] == 0
+    assert store.exists(blob.sha256)
+    assert not [name for name in os.listdir(os.path.dirname(path)) if name.startswith(".delete-")]
+
+    monkeypatch.setattr(database.Database, "unreferenced_blobs", unreferenced_blobs)
+    os.utime(path, (time.time() - 7200, time.time() - 7200))
+    assert sweeper.sweep(database.Database(), store, grace=3600)[1] >= 1
+    assert not store.exists(blob.sha256)
+
+
+def test_connection_pool_reuse():
+    # Соединение возвращается в пул и выдаётся повторно, а не открывается заново
+    pool = database.ConnectionPool(
+        minconn=0, maxconn=1, max_lifetime=3600, check_idle=0, timeout=0.5,
+        **database._connection_params()
+    )
+    try:
+        conn = pool.getconn()
+        pool.putconn(conn)
+        assert pool.getconn() is conn
+        with pytest.raises(database.PoolTimeout):
+            pool.getconn()
+        pool.putconn(conn, close=True)
+        assert pool.size == 0
+    finally:
+        pool.closeall()
+
+
+def test_slow_connect_does_not_block_pool(monkeypatch):
+    # Пока одно соединение открывается к медленному серверу, другие выдаются и возвращаются
+    pool = database.ConnectionPool(minconn=1, maxconn=2, check_idle=0, timeout=0.5,
+                                   **database._connection_params())
+    connect = psycopg2.connect
+    release = threading.Event()
+
+    def slow_connect(*args, **kwargs):
+        release.wait(5)
+        return connect(*args, **kwargs)
+
+    try:
+        conn = pool.getconn()
+        monkeypatch.setattr(psycopg2, "connect", slow_connect)
+        opener = threading.Thread(target=lambda: pool.putconn(pool.getconn()))
+        opener.start()
+        time.sleep(0.1)
+        started = time.monotonic()
+        pool.putconn(conn)
+        assert pool.getconn() is conn
+        assert time.monotonic() - started < 0.2
+        with pytest.raises(database.PoolTimeout):
+            pool.getconn()
+        release.set()
+        opener.join()
+        pool.putconn(conn)
+        assert pool.size == 2
+    finally:
+        release.set()
+        pool.closeall()
+
+
+def test_prepared_statements(test_data):
+    # Горячие запросы готовятся на соединении один раз и готовятся заново, если сервер их забыл
+    pool = database.ConnectionPool(minconn=0, maxconn=1, **database._connection_params())
+    plain = database.ConnectionPool(minconn=0, maxconn=1, prepare=False, **database._connection_params())
+    db = database.Database(pool=pool)
+    data = {**test_data, "add_time": "2024-01-01 10:00:00"}
+
+    def prepares():
+        return sum(database.metrics.DB_STATEMENT_PREPARES._values.values())
+
+    try:
+        first = db.submit_data(data)
+        document = db.get_pereval_by_id(first)
+        with pool.connection() as conn:
+            assert {"upsert_user", "insert_pereval", "insert_image", "pereval_document"} <= conn.prepared
+        before = prepares()
+        second = db.submit_data(data)
+        assert prepares() == before
+        assert ("submit_data:INSERT users",) in database.metrics.DB_QUERY_DURATION._values
+
+        # DISCARD ALL или пулер соединений: запрос в начале транзакции повторяется с новым PREPARE
+        with pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("DEALLOCATE ALL")
+            conn.commit()
+        assert db.get_pereval_by_id(second)["id"] == second
+        assert db.submit_data(data) > second
+        assert prepares() > before
+
+        # Без подготовки — тот же результат, и на сервере ничего не готовится
+        assert database.Database(pool=plain).get_pereval_by_id(first) == document
+        with plain.connection() as conn:
+            assert conn.prepared is None
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT count(*) FROM pg_prepared_statements")
+                assert cursor.fetchone()[0] == 0
+    finally:
+        pool.closeall()
+        plain.closeall()
+
+
+def test_read_replica_routing(client, test_data, monkeypatch):
+    # «Реплика» — та же тестовая БД: она не в режиме восстановления и позицию сессии подтвердить не может
+    dead = database.ConnectionPool(minconn=0, maxconn=1, dsn="host=127.0.0.1 port=1 connect_timeout=1")
+    alive = database.ConnectionPool(minconn=0, maxconn=2, **database._connection_params())
+    replicas = database.ReplicaSet([dead, alive], eject_time=60)
+    primary = database.ConnectionPool(minconn=0, maxconn=2, **database._connection_params())
+    db = database.Database(pool=primary, replicas=replicas)
+
+    def reads():
+        return {target: value for (target,), value in database.metrics.DB_READS._values.items()}
+
+    try:
+        pereval_id = db.submit_data({**test_data, "add_time": "2024-01-01 10:00:00"})
+        assert alive.size == 0  # запись — только на основной сервер
+        for _ in range(3):
+            assert db.get_pereval_by_id(pereval_id)["title"] == test_data["title"]
+        assert not replicas.available(0) and replicas.available(1)
+        assert alive.size == 1
+
+        # Запрос с токеном сессии читает с основного сервера, пока реплика не подтвердит позицию
+        monkeypatch.setattr(database, "_replicas", replicas)
+        response = client.patch(f"/submitData/{pereval_id}", json={"title": "Новое название"})
+        token = response.headers["x-session-token"]
+        before = reads()
+        params = {"user_email": test_data["user"]["email"]}
+        assert client.get("/submitDataByEmail", params=params, headers={"X-Session-Token": token}).status_code == 200
+        assert reads()["primary"] - before.get("primary", 0) == 1
+        client.get("/submitDataByEmail", params=params)
+        assert reads()["replica"] - before.get("replica", 0) == 1
+
+        # Документ для кеша — с реплики, догнавшей основной сервер; такой нет — с основного
+        before = reads()
+        assert db.get_pereval_by_id(pereval_id, current=True)["title"] == "Новое название"
+        assert reads()["primary"] - before.get("primary", 0) == 1
+        monkeypatch.setattr(database.ReplicaSet, "_fresh", lambda self, index, conn, min_lsn: min_lsn is not None)
+        assert db.get_pereval_by_id(pereval_id, current=True)["title"] == "Новое название"
+        assert reads()["replica"] - before.get("replica", 0) == 1
+    finally:
+        for pool in (dead, alive, primary):
+            pool.closeall()
+
+
+def test_slow_queries_do_not_block_event_loop(monkeypatch):
+    # Медленные запросы к БД выполняются параллельно, а не друг за другом
+    def slow_get(self, pereval_id, include_data=False, current=False):
+        time.sleep(0.5)
+        return None
+
+    monkeypatch.setattr(database.Database, "get_pereval_by_id", slow_get)
+    monkeypatch.setattr(cache, "_cache", cache.NullCache())
+
+    async def fire():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            started = time.monotonic()
+            responses = await asyncio.gather(*(ac.get(f"/submitData/{i}") for i in range(4)))
+            return time.monotonic() - started, responses
+
+    elapsed, responses = asyncio.run(fire())
+    assert all(r.status_code == 404 for r in responses)
+    assert elapsed < 1.5
+
+
+def test_admission_cancel_then_release():
+    # Клиент ушёл из очереди, и слот освободился раньше, чем его задача проснулась
+    async def scenario():
+        limiter = admission.Limiter("test", limit=1, queue_size=1, timeout=5)
+        await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        limiter.release()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert (limiter.active, limiter.waiting) == (0, 0)
+        await asyncio.wait_for(limiter.acquire(), 1)
+
+    asyncio.run(scenario())
+
+
+def test_admission_control_bounds_latency(monkeypatch):
+    # Сверх лимита и очереди запросы сразу получают 503, а ждущие — не дольше таймаута очереди
+    def slow_get(self, pereval_id, include_data=False, current=False):
+        time.sleep(0.5)
+        return None
+
+    monkeypatch.setattr(database.Database, "get_pereval_by_id", slow_get)
+    monkeypatch.setattr(cache, "_cache", cache.NullCache())
+    monkeypatch.setattr(admission.READS, "limit", 2)
+    monkeypatch.setattr(admission.READS, "queue_size", 2)
+    monkeypatch.setattr(admission.READS, "timeout", 0.2)
+
+    def rejected():
+        return {reason: value for (budget, reason), value in admission.metrics.ADMISSION_REJECTED._values.items()
+                if budget == "read"}
+
+    async def fire():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            async def timed(i):
+                started = time.monotonic()
+                response = await ac.get(f"/submitData/{i}")
+                return response, time.monotonic() - started
+            return await asyncio.gather(*(timed(i) for i in range(12)))
+
+    before = rejected()
+    results = asyncio.run(fire())
+    statuses = sorted(response.status_code for response, _ in results)
+    assert statuses == [404] * 2 + [503] * 10
+    assert max(elapsed for _, elapsed in results) < 0.9
+    for response, elapsed in results:
+        if response.status_code == 503:
+            assert response.headers["retry-after"] == str(admission.RETRY_AFTER)
+            assert response.json()["status"] == 503
+            assert elapsed < 0.4
+    after = rejected()
+    assert after["queue_full"] - before.get("queue_full", 0) == 8
+    assert after["timeout"] - before.get("timeout", 0) == 2
+    assert admission.READS.active == 0 and admission.READS.waiting == 0
+
+
+def test_image_endpoint(client, test_data):
+    pereval_id = client.post("/submitData", json=test_data).json()["id"]
+    image = client.get(f"/submitData/{pereval_id}").json()["images"][0]
+    raw = base64.b64decode(test_data["images"][0]["data"])
+    assert image["content_type"] == "image/png"
+    assert image["size"] == len(raw)
+
+    response = client.get(image["url"])
+    assert response.status_code == 200
+    assert response.content == raw
+    assert response.headers["content-type"] == "image/png"
+    etag = response.headers["etag"]
+
+    response = client.get(image["url"], headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    response = client.get(image["url"], headers={"Range": "bytes=0-7"})
+    assert response.status_code == 206
+    assert response.content == raw[:8]
+    assert response.headers["content-range"] == f"bytes 0-7/{len(raw)}"
+
+    response = client.get(image["url"], headers={"Range": "bytes=-4"})
+    assert response.content == raw[-4:]
+
+    response = client.get(image["url"], headers={"Range": f"bytes={len(raw)}-"})
+    assert response.status_code == 416
+
+    # Неверный синтаксис игнорируется — файл целиком
+    for header in ("bytes=5-2", "bytes=-", "bytes=0-1,4-5", "bytes=a-"):
+        response = client.get(image["url"], headers={"Range": header})
+        assert (response.status_code, response.content) == (200, raw)
+
+    assert client.get("/images/0").status_code == 404
+
+
+def test_legacy_image_rows(client, test_data):
+    # Изображения, сохранённые до выноса файлов, лежат в колонке img
+    pereval_id = client.post("/submitData", json=test_data).json()["id"]
+    raw = base64.b64decode(test_data["images"][0]["data"])
+    with database.get_pool().connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("INSERT INTO pereval_images (img, title) VALUES (%s, 'old') RETURNING id", (raw,))
+            image_id = cursor.fetchone()[0]
+            cursor.execute("INSERT INTO pereval_image_links VALUES (%s, %s)", (pereval_id, image_id))
+        conn.commit()
+
+    db = database.Database()
+    image = db.get_pereval_by_id(pereval_id)["images"][1]
+    assert (image["id"], image["size"], "data" in image) == (image_id, len(raw), False)
+    assert db.get_perevals_by_ids([pereval_id])[pereval_id]["images"][1]["size"] == len(raw)
+    image = db.get_pereval_by_id(pereval_id, include_data=True)["images"][1]
+    assert image["data"] == test_data["images"][0]["data"]
+    assert client.get(f"/images/{image_id}").content == raw
+
+
+def test_thumbnails(client, test_data, monkeypatch, tmp_path):
+    import io
+    import thumbnails
+    from PIL import Image
+
+    photo = io.BytesIO()
+    Image.radial_gradient("L").convert("RGB").resize((1600, 1200)).save(photo, format="JPEG", quality=95)
+    data = {**test_data, "images": [{"data": base64.b64encode(photo.getvalue()).decode(), "title": "Фото"}]}
+    pereval_id = client.post("/submitData", json=data).json()["id"]
+    image = client.get(f"/submitData/{pereval_id}").json()["images"][0]
+
+    response = client.get(image["thumbnail_url"], params={"size": 320, "format": "webp"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/webp"
+    preview = Image.open(io.BytesIO(response.content))
+    assert preview.size == (320, 240)
+    assert len(response.content) * 10 < image["size"]
+
+    # Повторный запрос — из кеша на диске, без пула процессов
+    monkeypatch.setattr(thumbnails, "get_executor", lambda: pytest.fail("thumbnail was rendered twice"))
+    again = client.get(image["thumbnail_url"], params={"size": 320, "format": "webp"})
+    assert again.content == response.content
+    assert client.get(image["thumbnail_url"], headers={"If-None-Match": again.headers["etag"]},
+                      params={"size": 320, "format": "webp"}).status_code == 304
+    assert client.get(image["thumbnail_url"], params={"size": 321}).status_code == 400
+
+
+def test_derivative_cache_evicts_least_recently_used(tmp_path):
+    import thumbnails
+    cache = thumbnails.DerivativeCache(str(tmp_path), max_bytes=250)
+    cache.put("aa-1", b"x" * 100)
+    time.sleep(0.01)
+    cache.put("bb-1", b"x" * 100)
+    time.sleep(0.01)
+    assert cache.get("aa-1") is not None  # теперь bb-1 — самый давний
+    time.sleep(0.01)
+    cache.put("cc-1", b"x" * 100)
+    assert cache.get("bb-1") is None
+    assert cache.get("aa-1") is not None and cache.get("cc-1") is not None
+
+
+def test_multipart_upload(client, test_data, monkeypatch):
+    metadata = {k: v for k, v in test_data.items() if k != "images"}
+    raw = base64.b64decode(test_data["images"][0]["data"])
+    big = b"\xff\xd8\xff" + b"\0" * 5000
+    files = [("images", ("a.png", raw, "image/png")), ("images", ("b.jpg", big, "image/jpeg"))]
+
+    response = client.post(
+        "/submitData/upload",
+        data={"metadata": json.dumps(metadata), "titles": ["Седловина", "Вид на юг"]},
+        files=files,
+    )
+    assert response.json()["status"] == 200
+    pereval_id = response.json()["id"]
+
+    images = client.get(f"/submitData/{pereval_id}").json()["images"]
+    assert [(i["title"], i["size"], i["content_type"]) for i in images] == [
+        ("Седловина", len(raw), "image/png"),
+        ("Вид на юг", len(big), "image/jpeg"),
+    ]
+    assert client.get(images[1]["url"]).content == big
+
+    # Лимит на размер одного изображения
+    monkeypatch.setattr("main.UPLOAD_MAX_IMAGE_BYTES", 1000)
+    response = client.post("/submitData/upload", data={"metadata": json.dumps(metadata)}, files=files)
+    assert response.status_code == 413
+    assert response.json()["message"] == "Изображение больше 1000 байт"
+
+    # Без метаданных
+    response = client.post("/submitData/upload", files=files)
+    assert response.status_code == 400
+
+    # Лимит на весь запрос действует и без Content-Length (chunked)
+    monkeypatch.setattr("main.UPLOAD_MAX_REQUEST_BYTES", 3000)
+    body = httpx.Request("POST", "/", data={"metadata": json.dumps(metadata)}, files=files).read()
+    boundary = body.split(b"\r\n", 1)[0][2:].decode()
+    response = client.post("/submitData/upload", content=iter([body[:1024], body[1024:]]),
+                           headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+    assert response.status_code == 413
+    assert response.json()["message"] == "Запрос больше 3000 байт"
+
+
+def test_batch_submit(client, test_data):
+    second = {**test_data, "title": "Второй", "coords": {"latitude": "45.1", "longitude": "90.1", "height": "1600"}}
+    invalid = {k: v for k, v in test_data.items() if k != "user"}
+    too_long = {**test_data, "title": "x" * 300}
+    payload = [test_data, second, invalid, {**test_data, "title": "Третий"}, too_long]
+
+    response = client.post("/submitData/batch", json=payload)
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [r["status"] for r in results] == [200, 200, 400, 200, 400]
+    ids = [r["id"] for r in results if r["status"] == 200]
+    assert len(set(ids)) == 3
+
+    # Один пользователь и две точки на всю пачку
+    perevals = client.get("/submitDataByEmail", params={"user_email": "test@example.com"}).json()
+    assert sorted(p["id"] for p in perevals) == sorted(ids)
+    first, third = client.get(f"/submitData/{ids[0]}").json(), client.get(f"/submitData/{ids[2]}").json()
+    assert first["coords"] == third["coords"]
+    assert len(first["images"]) == 1
+
+
+def test_async_ingest_queue(client, test_data):
+    too_long = {**test_data, "title": "x" * 300}
+    jobs = []
+    for item in (test_data, too_long, {**test_data, "title": "Второй"}):
+        response = client.post("/submitData", json=item, headers={"Prefer": "respond-async"})
+        assert response.status_code == 202
+        assert response.headers["location"] == f"/jobs/{response.json()['job_id']}"
+        jobs.append(response.json()["job_id"])
+    assert client.get(f"/jobs/{jobs[0]}").json()["status"] == "queued"
+
+    # Воркеры в тестах не запущены — разбираем очередь сами; пачка с ошибкой делится по заданиям
+    assert database.Database().process_ingest_batch(10) == 3
+    assert database.Database().process_ingest_batch(10) == 0
+    done, failed, second = (client.get(f"/jobs/{job_id}").json() for job_id in jobs)
+    assert (done["status"], failed["status"], second["status"]) == ("done", "failed", "done")
+    assert failed["pereval_id"] is None and failed["error"]
+    pereval = client.get(f"/submitData/{done['pereval_id']}").json()
+    assert pereval["title"] == test_data["title"]
+    assert len(pereval["images"]) == 1
+    assert client.get(f"/images/{pereval['images'][0]['id']}").status_code == 200
+    assert client.get("/jobs/999999").status_code == 404
+
+
+def test_moderation_queue(client, test_data):
+    ids = [r["id"] for r in client.post("/submitData/batch", json=[test_data] * 3).json()["results"]]
+    client.get(f"/submitData/{ids[0]}")  # документ попадает в кеш
+
+    claimed = client.post("/moderation/claim", json={"moderator": "anna", "limit": 2}).json()
+    assert [p["id"] for p in claimed] == ids[:2]
+    assert client.get(f"/submitData/{ids[0]}").json()["status"] == "pending"
+
+    # Чужие и не выданные записи не меняются
+    assert client.post("/moderation/accept", json={"moderator": "boris", "ids": ids}).json()["updated"] == []
+    assert client.post("/moderation/accept", json={"moderator": "anna", "ids": ids}).json()["updated"] == ids[:2]
+    assert client.post("/moderation/reject", json={"moderator": "anna", "ids": ids[:1]}).json()["updated"] == []
+    assert client.get(f"/submitData/{ids[0]}").json()["status"] == "accepted"
+    assert client.post("/moderation/claim", json={"moderator": "boris"}).json()[0]["id"] == ids[2]
+
+
+def test_concurrent_claims_never_overlap(client, test_data):
+    client.post("/submitData/batch", json=[test_data] * 200)
+    db = database.Database()
+
+    def drain(moderator):
+        claimed = []
+        while True:
+            batch = db.claim_perevals(moderator, 7)
+            if not batch:
+                return claimed
+            claimed += [p["id"] for p in batch]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(drain, [f"moderator-{n}" for n in range(8)]))
+    claimed = [pereval_id for ids in results for pereval_id in ids]
+    assert len(claimed) == 200
+    assert len(set(claimed)) == 200
+
+
+def test_change_feed(client, test_data):
+    pereval_id = client.post("/submitData", json=test_data).json()["id"]
+    low, _ = database.Database().change_bounds()
+    listed = client.get("/changes", params={"after": low - 1}).json()
+    assert [(c["pereval_id"], c["op"], c["status"]) for c in listed] == [(pereval_id, "insert", "new")]
+    client.patch(f"/submitData/{pereval_id}", json={"title": "Новое название"})
+
+    async def receive():
+        # Продолжение после вставки: правка — из таблицы, взятие на модерацию — уже живым событием
+        received = []
+        feed = changes.follow(after=listed[0]["seq"], heartbeat=0.1)
+        async for event in feed:
+            if event is None:
+                if len(received) == 1:
+                    await asyncio.to_thread(database.Database().claim_perevals, "moderator", 1)
+                continue
+            received.append(event)
+            if len(received) == 2:
+                break
+        await feed.aclose()
+        return received
+
+    received = asyncio.run(asyncio.wait_for(receive(), 10))
+    assert [(e["op"], e["status"]) for e in received] == [("update", "new"), ("update", "pending")]
+    assert received[0]["seq"] < received[1]["seq"]
+    assert client.get("/changes", params={"after": received[1]["seq"] + 100}).status_code == 410
+    assert client.get("/changes/stream", headers={"Last-Event-ID": str(received[1]["seq"] + 100)}).status_code == 410
+
+
+def test_export_streams_catalogue(client, test_data, monkeypatch):
+    import main
+    monkeypatch.setattr(main, "EXPORT_CHUNK_SIZE", 2)
+    ids = [r["id"] for r in client.post("/submitData/batch", json=[test_data] * 5).json()["results"]]
+
+    response = client.get("/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [r["id"] for r in rows] == ids
+    assert rows[0]["user_email"] == "test@example.com"
+    assert rows[0]["latitude"] == 45.0
+    assert "images" not in rows[0]
+
+    client.patch(f"/submitData/{ids[1]}", json={"title": "Изменённый"})
+    patched = [json.loads(line) for line in client.get("/export").text.splitlines()][1]
+    assert patched["updated_at"] > rows[1]["updated_at"]
+    changed = client.get("/export", params={"updated_since": patched["updated_at"]}).text.splitlines()
+    assert [json.loads(line)["title"] for line in changed] == ["Изменённый"]
+
+    client.post("/moderation/claim", json={"moderator": "anna", "limit": 1})
+    pending = client.get("/export", params={"status": "pending", "include_images": True}).text.splitlines()
+    assert [json.loads(line)["id"] for line in pending] == ids[:1]
+    assert json.loads(pending[0])["images"][0]["url"].startswith("/images/")
+
+    response = client.get("/export", params={"format": "csv"})
+    assert response.headers["content-type"].startswith("text/csv")
+    lines = response.text.splitlines()
+    assert lines[0].startswith("id,beauty_title,title")
+    assert len(lines) == 6
+    assert client.get("/export", params={"format": "csv", "status": "rejected"}).text.splitlines() == [lines[0]]
+    assert client.get("/export", params={"format": "xml"}).status_code == 400
+
+
+def test_export_budget_released_when_client_leaves(client, test_data, monkeypatch):
+    # Выгрузки ограничены своим лимитом; ушедший посреди ответа клиент отдаёт слот и соединение
+    import main
+    monkeypatch.setattr(main, "EXPORT_CHUNK_SIZE", 2)
+    monkeypatch.setattr(admission.EXPORTS, "limit", 1)
+    monkeypatch.setattr(admission.EXPORTS, "queue_size", 0)
+    client.post("/submitData/batch", json=[test_data] * 5)
+    pool = database.get_pool()
+
+    async def abandoned():
+        scope = {
+            "type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "http_version": "1.1",
+            "method": "GET", "scheme": "http", "path": "/export", "raw_path": b"/export", "root_path": "",
+            "query_string": b"", "headers": [], "server": ("test", 80), "client": ("test", 1),
+        }
+
+        async def receive():
+            await asyncio.sleep(60)
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                assert admission.EXPORTS.active == 1
+                assert client.get("/export").status_code == 503
+                raise OSError("client went away")
+
+        in_use = pool.size - pool.idle
+        with pytest.raises(Exception):
+            await app(scope, receive, send)
+        return in_use
+
+    in_use = asyncio.run(abandoned())
+    assert admission.EXPORTS.active == 0
+    assert pool.size - pool.idle == in_use
+    assert len(client.get("/export").text.splitlines()) == 5
+
+
+def test_metrics_endpoint(client, test_data, monkeypatch, caplog):
+    pereval_id = client.post("/submitData", json=test_data).json()["id"]
+    client.get(f"/submitData/{pereval_id}")
+    monkeypatch.setattr(database, "SLOW_QUERY_MS", 0.000001)
+    with caplog.at_level("WARNING", logger="database"):
+        client.get("/perevals/search", params={"q": "Тестовый"})
+    assert any("Slow query search_perevals:SELECT pereval_added" in r.getMessage() for r in caplog.records)
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    assert 'http_request_duration_seconds_count{method="GET",route="/submitData/{pereval_id}",status="200"}' in text
+    assert 'http_request_body_bytes_bucket{method="POST",route="/submitData",le="+Inf"} ' in text
+    assert 'db_query_duration_seconds_count{query="submit_data:INSERT users"}' in text
+    assert 'db_pool_connections{state="in_use"}' in text
+    assert 'image_bytes_total{direction="in"}' in text
+
+
+def test_multi_get(client, test_data):
+    ids = [r["id"] for r in client.post("/submitData/batch", json=[test_data] * 3).json()["results"]]
+
+    response = client.get("/perevals", params={"ids": f"{ids[2]},999999,{ids[0]},{ids[2]}"})
+    assert response.status_code == 200
+    body = response.json()
+    assert [p["id"] for p in body["perevals"]] == [ids[2], ids[0]]
+    assert body["missing"] == [999999]
+    assert body["perevals"][0] == client.get(f"/submitData/{ids[2]}").json()
+
+    trimmed = client.get("/perevals", params={"ids": str(ids[0]), "fields": "coords"}).json()["perevals"][0]
+    assert "coords" in trimmed and not {"user", "level", "images"} & trimmed.keys()
+    assert trimmed["title"] == test_data["title"]
+
+    def multiget_queries():
+        return sum(sum(counts) for (label,), (counts, _) in
+                   database.metrics.DB_QUERY_DURATION._values.items() if label.startswith("get_perevals_by_ids:"))
+
+    before = multiget_queries()
+    body = client.post("/perevals", json={"ids": ids, "fields": ["images"]}).json()
+    assert [len(p["images"]) for p in body["perevals"]] == [1, 1, 1]
+    assert multiget_queries() - before == 1  # один запрос на любое число ID
+    assert client.get("/perevals", params={"ids": "1,x"}).status_code == 400
+    assert client.get("/perevals", params={"ids": "1", "fields": "secret"}).status_code == 400
+    assert client.post("/perevals", json={"ids": list(range(1000))}).status_code == 400
+
+
+def test_list_responses_match_response_models(client, test_data):
+    # Списки отдаются мимо проверки FastAPI, поэтому сверяем их с моделями ответов сами
+    from main import PerevalList, PerevalNearby, PerevalSearchHit, PerevalSummary
+
+    item = {**test_data, "add_time": "2024-03-01 09:05:07"}
+    pereval_id = client.post("/submitData", json=item).json()["id"]
+
+    by_email = client.get("/submitDataByEmail", params={"user_email": "test@example.com"})
+    assert by_email.headers["content-type"] == "application/json"
+    summary = PerevalSummary.model_validate(by_email.json()[0])
+    assert summary.add_time == "2024-03-01 09:05:07"
+    assert summary.level.summer == "1A"
+
+    nearby = client.get("/perevals/nearby", params={"lat": 45.0, "lon": 90.0, "radius_km": 1}).json()
+    assert PerevalNearby.model_validate(nearby[0]).coords.latitude == 45.0
+    assert isinstance(nearby[0]["coords"]["latitude"], float)
+    PerevalSearchHit.model_validate(client.get("/perevals/search", params={"q": "тестовый"}).json()[0])
+    documents = PerevalList.model_validate(client.get("/perevals", params={"ids": str(pereval_id)}).json())
+    assert documents.perevals[0].add_time == "2024-03-01 09:05:07"
+    # Кириллица не экранируется в \uXXXX
+    assert test_data["title"].encode("utf-8") in client.get(f"/submitData/{pereval_id}").content
+
+
+def test_concurrent_submits_same_user_and_coords(test_data, monkeypatch):
+    # Параллельные отправки от одного пользователя с одной точкой не должны падать на UNIQUE.
+    # Лимит записей снят, чтобы все 20 запросов действительно шли в БД одновременно
+    monkeypatch.setattr(admission.WRITES, "limit", 0)
+
+    async def fire():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            return await asyncio.gather(*(ac.post("/submitData", json=test_data) for _ in range(20)))
+
+    responses = asyncio.run(fire())
+    assert [r.json()["status"] for r in responses] == [200] * 20
+    assert len({r.json()["id"] for r in responses}) == 20
+
+
+def test_idempotency_key(client, test_data, monkeypatch):
+    store = database.storage.get_store()
+    writes = []
+    original_put = store.put
+    monkeypatch.setattr(store, "put", lambda data: writes.append(data) or original_put(data))
+
+    def count(table):
+        with database.get_pool().connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(f"SELECT count(*) FROM {table}")
+                return cursor.fetchone()[0]
+
+    headers = {"Idempotency-Key": "retry-1"}
+    first = client.post("/submitData", json=test_data, headers=headers)
+    assert first.json()["status"] == 200 and "idempotent-replayed" not in first.headers
+    # Повтор — тот же ответ, без новых строк и без повторной записи изображений
+    retry = client.post("/submitData", json=test_data, headers=headers)
+    assert retry.json() == first.json()
+    assert retry.headers["idempotent-replayed"] == "true"
+    assert len(writes) == 1
+    assert count("pereval_added") == 1 and count("pereval_images") == 1
+
+    other = {**test_data, "title": "Другой перевал"}
+    response = client.post("/submitData", json=other, headers=headers)
+    assert response.status_code == 422
+    assert client.post("/submitData", json=test_data, headers={"Idempotency-Key": ""}).status_code == 400
+
+    # Параллельные дубли ждут первую попытку, а не вставляют перевал ещё раз
+    async def fire():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            return await asyncio.gather(*(
+                ac.post("/submitData", json=other, headers={"Idempotency-Key": "retry-2"}) for _ in range(5)
+            ))
+
+    responses = asyncio.run(fire())
+    assert len({r.json()["id"] for r in responses}) == 1
+    assert sorted(r.headers.get("idempotent-replayed", "") for r in responses) == [""] + ["true"] * 4
+    assert count("pereval_added") == 2
+
+    # Асинхронная загрузка: повтор возвращает то же задание
+    async_headers = {"Idempotency-Key": "retry-3", "Prefer": "respond-async"}
+    job = client.post("/submitData", json={**test_data, "title": "В очередь"}, headers=async_headers)
+    assert job.status_code == 202
+    retry = client.post("/submitData", json={**test_data, "title": "В очередь"}, headers=async_headers)
+    assert retry.status_code == 202 and retry.json()["job_id"] == job.json()["job_id"]
+    assert count("ingest_jobs") == 1
+
+
+def test_email_pagination(client, test_data):
+    ids = []
+    for n in range(5):
+        item = {**test_data, "add_time": f"2024-01-0{n + 1} 10:00:00"}
+        ids.append(client.post("/submitData", json=item).json()["id"])
+
+    seen, cursor = [], None
+    while True:
+        params = {"user_email": "test@example.com", "limit": 2}
+        if cursor:
+            params["after"] = cursor
+        response = client.get("/submitDataByEmail", params=params)
+        assert response.status_code == 200
+        seen += [p["id"] for p in response.json()]
+        cursor = response.headers.get("x-next-cursor")
+        if not cursor:
+            break
+    assert seen == ids
+
+    response = client.get("/submitDataByEmail", params={
+        "user_email": "test@example.com", "date_from": "2024-01-02T00:00:00", "date_to": "2024-01-04T00:00:00"
+    })
+    assert [p["id"] for p in response.json()] == ids[1:3]
+    response = client.get("/submitDataByEmail", params={"user_email": "test@example.com", "status": "accepted"})
+    assert response.json() == []
+    response = client.get("/submitDataByEmail", params={"user_email": "test@example.com", "after": "мусор"})
+    assert response.status_code == 400
+
+
+def test_pereval_cache_and_etag(client, test_data, monkeypatch):
+    pereval_id = client.post("/submitData", json=test_data).json()["id"]
+    first = client.get(f"/submitData/{pereval_id}")
+    etag = first.headers["etag"]
+
+    # Повторный запрос и If-None-Match обслуживаются из кеша, без БД
+    def no_db(*args, **kwargs):
+        raise AssertionError("database must not be queried")
+
+    monkeypatch.setattr(database.Database, "get_pereval_by_id", no_db)
+    hits = client.get("/cache/stats").json()["hits"]
+    assert client.get(f"/submitData/{pereval_id}").json() == first.json()
+    assert client.get(f"/submitData/{pereval_id}", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/cache/stats").json()["hits"] == hits + 2
+    monkeypatch.undo()
+
+    # PATCH сбрасывает запись в кеше
+    client.patch(f"/submitData/{pereval_id}", json={"title": "Новое"})
+    response = client.get(f"/submitData/{pereval_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["title"] == "Новое"
+    assert response.headers["etag"] != etag
+
+
+def test_nearby_and_bbox(client, test_data):
+    points = {"near": ("45.0100", "90.0000"), "far": ("45.5000", "90.0000"), "east": ("45.0000", "179.9900")}
+    ids = {}
+    for name, (lat, lon) in points.items():
+        item = {**test_data, "title": name, "coords": {"latitude": lat, "longitude": lon, "height": "1000"}}
+        ids[name] = client.post("/submitData", json=item).json()["id"]
+
+    response = client.get("/perevals/nearby", params={"lat": 45.0, "lon": 90.0, "radius_km": 100})
+    found = response.json()
+    assert [p["id"] for p in found] == [ids["near"], ids["far"]]
+    assert found[0]["distance_km"] == pytest.approx(1.112, abs=0.01)
+    assert found[1]["distance_km"] == pytest.approx(55.6, abs=0.1)
+
+    response = client.get("/perevals/nearby", params={"lat": 45.0, "lon": 90.0, "radius_km": 10})
+    assert [p["id"] for p in response.json()] == [ids["near"]]
+
+    response = client.get("/perevals/nearby", params={"lat": 45.0, "lon": 90.0, "radius_km": 100, "offset": 1})
+    assert [p["id"] for p in response.json()] == [ids["far"]]
+
+    # Через линию перемены дат
+    response = client.get("/perevals/nearby", params={"lat": 45.0, "lon": -179.99, "radius_km": 10})
+    assert [p["id"] for p in response.json()] == [ids["east"]]
+    response = client.get("/perevals/bbox", params={"min_lat": 44, "min_lon": 170, "max_lat": 46, "max_lon": -170})
+    assert [p["id"] for p in response.json()] == [ids["east"]]
+
+    response = client.get("/perevals/bbox", params={"min_lat": 44.9, "min_lon": 89, "max_lat": 45.2, "max_lon": 91})
+    assert [p["id"] for p in response.json()] == [ids["near"]]
+
+
+def test_fuzzy_title_search(client, test_data):
+    ids = {}
+    for beauty, title, other in [("пер.", "Пхия", "Триев"), ("", "пер. Пхия", ""), ("пер.", "Донгуз-Орун", "")]:
+        item = {**test_data, "beauty_title": beauty, "title": title, "other_titles": other}
+        ids[title] = client.post("/submitData", json=item).json()["id"]
+
+    # Без учёта регистра и с опечаткой
+    for q in ["ПХИЯ", "пхиа"]:
+        found = client.get("/perevals/search", params={"q": q}).json()
+        assert {p["id"] for p in found} == {ids["Пхия"], ids["пер. Пхия"]}
+        assert found[0]["score"] >= found[-1]["score"]
+
+    found = client.get("/perevals/search", params={"q": "триев"}).json()
+    assert [p["id"] for p in found] == [ids["Пхия"]]
+    found = client.get("/perevals/search", params={"q": "пхия", "limit": 1, "offset": 1}).json()
+    assert len(found) == 1
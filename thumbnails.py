@@ -0,0 +1,204 @@
+import os
+import io
+import asyncio
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Допустимые размеры миниатюр (по длинной стороне, px) и форматы
+SIZES = tuple(int(s) for s in os.getenv('FSTR_THUMBNAIL_SIZES', '160,320,640').split(','))
+FORMATS = {'jpeg': 'image/jpeg', 'webp': 'image/webp', 'png': 'image/png'}
+QUALITY = int(os.getenv('FSTR_THUMBNAIL_QUALITY', '80'))
+
+
+class ThumbnailsUnavailable(RuntimeError):
+    """Pillow не установлен"""
+
+
+def render(data: bytes, size: int, fmt: str, quality: int = QUALITY) -> bytes:
+    """Уменьшает изображение до size по длинной стороне и кодирует в fmt.
+
+    Выполняется в дочернем процессе, поэтому Pillow импортируется здесь.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        # JPEG декодируется сразу в уменьшенном масштабе — в разы быстрее полного
+        image.draft('RGB', (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        if fmt == 'jpeg' and image.mode not in ('RGB', 'L'):
+            # Прозрачность в JPEG не поддерживается — кладём на белый фон
+            background = Image.new('RGB', image.size, 'white')
+            rgba = image.convert('RGBA')
+            background.paste(rgba, mask=rgba.getchannel('A'))
+            image = background
+        elif image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGBA')
+        out = io.BytesIO()
+        image.save(out, format=fmt.upper(), quality=quality, optimize=fmt != 'webp')
+        return out.getvalue()
+
+
+class DerivativeCache:
+    """Кеш готовых миниатюр на диске с ограничением по размеру и LRU-вытеснением.
+
+    Время последнего чтения — mtime файла, поэтому порядок вытеснения
+    переживает перезапуск и общий для процессов, работающих с одним каталогом.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self._bytes = sum(size for _, size, _ in self._files())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def _files(self) -> list:
+        """(путь, размер, mtime) всех файлов кеша"""
+        files = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((path, stat.st_size, stat.st_mtime))
+        return files
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        with self._lock:
+            self._bytes += len(data)
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Пересчитываем по диску: каталог могут заполнять и другие процессы
+        files = sorted(self._files(), key=lambda f: f[2])
+        total = sum(size for _, size, _ in files)
+        # Освобождаем с запасом, чтобы не сканировать каталог на каждой записи
+        target = self.max_bytes * 0.9
+        for path, size, _ in files:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        self._bytes = total
+
+
+_executor = None
+_cache = None
+_init_lock = threading.Lock()
+_inflight = {}  # ключ -> asyncio.Future, чтобы одну миниатюру не считать дважды
+
+
+def _available() -> bool:
+    try:
+        import PIL  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def get_cache() -> DerivativeCache:
+    """Кеш миниатюр: FSTR_THUMBNAIL_DIR, FSTR_THUMBNAIL_CACHE_BYTES.
+
+    По умолчанию — каталог рядом с хранилищем (media-thumbnails), а не внутри
+    него: уборщик обходит корень хранилища, и миниатюрам там не место.
+    """
+    global _cache
+    with _init_lock:
+        if _cache is None:
+            root = os.getenv('FSTR_THUMBNAIL_DIR') or os.path.normpath(os.getenv('FSTR_STORAGE_DIR', 'media')) + '-thumbnails'
+            _cache = DerivativeCache(root, int(os.getenv('FSTR_THUMBNAIL_CACHE_BYTES', str(512 * 1024 * 1024))))
+        return _cache
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """Пул процессов для ресайза (FSTR_THUMBNAIL_WORKERS, по умолчанию число CPU)"""
+    global _executor
+    with _init_lock:
+        if _executor is None:
+            if not _available():
+                raise ThumbnailsUnavailable("Для миниатюр установите пакет Pillow")
+            workers = int(os.getenv('FSTR_THUMBNAIL_WORKERS', '0')) or os.cpu_count() or 1
+            _executor = ProcessPoolExecutor(max_workers=workers)
+        return _executor
+
+
+def shutdown_executor():
+    global _executor
+    with _init_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+async def get_thumbnail(sha256: str, size: int, fmt: str, load) -> bytes:
+    """Миниатюра из кеша; при промахе load() отдаёт оригинал, ресайз — в пуле процессов.
+
+    Параллельные запросы одной и той же миниатюры ждут один общий расчёт.
+    """
+    key = f"{sha256}-{size}.{fmt}"
+    loop = asyncio.get_running_loop()
+    cache = get_cache()
+    data = await loop.run_in_executor(None, cache.get, key)
+    if data is not None:
+        return data
+
+    pending = _inflight.get(key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    future = loop.create_future()
+    _inflight[key] = future
+    try:
+        original = await load()
+        data = await loop.run_in_executor(get_executor(), render, original, size, fmt)
+        await loop.run_in_executor(None, cache.put, key, data)
+        future.set_result(data)
+        return data
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        # Исключение уже передано ожидающим; если их нет, не шумим в логе
+        future.exception()
+        raise
+    finally:
+        del _inflight[key]